@@ -1,51 +1,118 @@
 # Ref: https://github.com/miguelgrinberg/Flask-SocketIO/issues/65
+# The node runs on a single gevent event loop: HTTP server, peer RPCs, replicators and Raft timers are all greenlets
 from gevent import monkey
 monkey.patch_all()
 
 import sys
+import socket
 import os
-from flask import Flask, request, jsonify
+from gevent.pywsgi import WSGIServer
+from flask import Flask, Response, request, jsonify, g
+import requests
 import logging
 import json
-from raft.cluster import Cluster
+import time
+from raft.cluster import Cluster, PEER_POOL_MAXSIZE, FORWARD_TIMEOUT
 from raft.timer_thread import TimerThread
+from raft.client import Peers
+from raft.MessageQueue import CREATE_TOPIC, PUT_MESSAGE, GET_MESSAGE, PUT_MESSAGES, GET_MESSAGES
+from raft import codec
+from raft import logger
+from raft import metrics
+from raft.Leader import Leader
 
 logging.basicConfig(format='%(asctime)s-%(levelname)s: %(message)s', datefmt='%H:%M:%S', level=logging.INFO)
 
 app = Flask(__name__)
 
+FORWARDED_HEADER = 'X-Raft-Forwarded' # set on a client request forwarded to the Leader of its topic's group
+
 ###### Functions for communication among Server nodes
-@app.route('/raft/vote', methods=['POST'])
-def request_vote():
+@app.route('/raft/<int:group>/vote', methods=['POST'])
+def request_vote(group):
     '''
     When a Follower timeout, it becomes a Candidate and starts election by POSTing vote requests to other nodes
     Candidate node -> request_vote() -> Follower nodes
     '''
-    candidate_vote_request = request.get_json()
-    result = timer_thread.vote(json.loads(candidate_vote_request)) # timer_thread=Follower thread to vote
-    return jsonify(result) # return voting result to Candidate
+    candidate_vote_request = codec.decode_vote_request(request.get_data())
+    result = timer_threads[group].vote(candidate_vote_request) # timer_thread=Follower thread to vote
+    return Response(codec.encode_vote_result(result), mimetype=codec.MIMETYPE) # return voting result to Candidate
 
-@app.route('/raft/heartbeat', methods=['POST'])
-def heartbeat():
+@app.route('/raft/<int:group>/heartbeat', methods=['POST'])
+def heartbeat(group):
     '''
     When a node becomes Leader, it will POST heartbeat requests to other nodes
     Leader node -> heartbeat() -> Follower nodes
     '''
-    append_entries_request = request.get_json()
-    result = timer_thread.append_entries(json.loads(append_entries_request))
-    return jsonify(result)
+    append_entries_request = codec.decode_append_entries_request(request.get_data())
+    result = timer_threads[group].append_entries(append_entries_request)
+    return Response(codec.encode_append_entries_result(result), mimetype=codec.MIMETYPE)
+
+@app.route('/raft/<int:group>/snapshot', methods=['POST'])
+def install_snapshot(group):
+    '''
+    When a Follower lags behind the entries Leader has compacted away, Leader POSTs its snapshot in chunks
+    Leader node -> install_snapshot() -> Follower node
+    '''
+    install_snapshot_request = codec.decode_install_snapshot_request(request.get_data())
+    result = timer_threads[group].install_snapshot(install_snapshot_request)
+    return Response(codec.encode_install_snapshot_result(result), mimetype=codec.MIMETYPE)
+
 
+@app.route('/raft/<int:group>/timeout_now', methods=['POST'])
+def timeout_now(group):
+    '''
+    Leader hands the group's leadership over to its preferred Leader
+    Leader node -> timeout_now() -> preferred Leader node
+    '''
+    timer_threads[group].timeout_now(codec.decode_timeout_now_request(request.get_data()))
+    return Response(status=204)
 
 
 ###### Functions for communication between Server and Client
+# Topics are sharded across Raft groups (see Cluster.group_of). A node that leads at least one group serves clients:
+# requests for a topic of a group it does not lead are forwarded to that group's Leader.
+# With a single group, this is the plain single Leader setup.
 @app.route('/topic', methods=['GET'])
 def get_all_topics():
+    '''
+    Topics of every group, or only of ?group=<int>
+    A bounded-staleness read also returns 'index': the index it was served at in each group listed, in order
+    '''
+    groups = [request.args.get('group', type=int)] if 'group' in request.args else cluster.groups
+
+    if is_stale_read():
+        # ?min_index is given once for every group, or once per group
+        min_indexes = request.args.getlist('min_index', type=int) or [None]
+        if len(min_indexes) == 1:
+            min_indexes = min_indexes * len(groups)
+        topic_list, indexes = [], []
+        for group, min_index in zip(groups, min_indexes):
+            result = timer_threads[group].read_stale_MQ(min_index, request.args.get('max_staleness', type=float))
+            if result is None:
+                return jsonify({'success': False, 'topics': []})
+            topics, index = result
+            topic_list += list(topics.topics.keys())
+            indexes.append(index)
+        return jsonify({'success': True, 'topics': topic_list, 'index': indexes})
+
     if not_leader():
         return jsonify({'success': False, 'topics': []})
-    
-    topics = json.loads(timer_thread.fetch_MQ())
 
-    topic_list = list(topics.keys())
+    topic_list = []
+    for group in groups:
+        timer_thread = timer_threads[group]
+        if not timer_thread.is_leader():
+            result = forward(timer_thread, path=f'/topic?group={group}')
+            if result is None or not result['success']:
+                return jsonify({'success': False, 'topics': []})
+            topic_list += result['topics']
+            continue
+
+        topics = timer_thread.read_MQ() # linearizable read, no log entry
+        if topics is None:
+            return jsonify({'success': False, 'topics': []})
+        topic_list += list(topics.topics.keys())
 
     statement = {'success': True, 'topics': topic_list}
     return jsonify(statement)
@@ -56,18 +123,16 @@ def add_new_topic():
     if not_leader():
         return jsonify({'success': False})
 
-    topics = json.loads(timer_thread.fetch_MQ())
-
     client_request = request.get_json()
     new_topic = client_request['topic']
 
-    if new_topic in topics:
-        return jsonify({'success': False})
-    
-    topics[new_topic] = []
-    # add to Leader's local log
-    timer_thread.client_append_entries(json.dumps(topics))
-    return jsonify({'success': True})
+    timer_thread = route(new_topic)
+    if not timer_thread.is_leader():
+        return jsonify(forward(timer_thread) or {'success': False})
+
+    # add to Leader's local log, creating a topic that exists already fails when the entry is applied
+    result = timer_thread.client_append_entries({'op': CREATE_TOPIC, 'topic': new_topic})
+    return jsonify({'success': result['success']})
 
 
 @app.route('/message', methods=['PUT'])
@@ -75,19 +140,16 @@ def add_message():
     if not_leader():
         return jsonify({'success': False})
 
-    topics = json.loads(timer_thread.fetch_MQ())
-
     client_request = request.get_json()
     topic = client_request['topic']
 
-    if topic not in topics:
-        return jsonify({'success': False})
-    
-    topics[topic].append(client_request['message'])
+    timer_thread = route(topic)
+    if not timer_thread.is_leader():
+        return jsonify(forward(timer_thread) or {'success': False})
 
-    # add to Leader's local log
-    timer_thread.client_append_entries(json.dumps(topics))
-    return jsonify({'success': True})
+    # add to Leader's local log, the message is only added if the topic exists when the entry is applied
+    result = timer_thread.client_append_entries({'op': PUT_MESSAGE, 'topic': topic, 'message': client_request['message']})
+    return jsonify({'success': result['success']})
 
 
 
@@ -96,17 +158,100 @@ def get_message(topic):
     if not_leader():
         return jsonify({'success': False})
 
-    topics = json.loads(timer_thread.fetch_MQ())
+    timer_thread = route(topic)
+    if not timer_thread.is_leader():
+        return jsonify(forward(timer_thread) or {'success': False})
 
-    if topic not in topics or len(topics[topic]) == 0:
+    # add to Leader's local log, the message is the one dequeued when the entry is applied (if any)
+    result = timer_thread.client_append_entries({'op': GET_MESSAGE, 'topic': topic})
+    if not result['success']:
         return jsonify({'success': False})
-    
-    message = topics[topic][0]
-    topics[topic] = topics[topic][1:]
-    # add to Leader's local log
-    timer_thread.client_append_entries(json.dumps(topics))
-    return jsonify({'success': True, 'message': message})
-    
+    return jsonify({'success': True, 'message': result['message']})
+
+
+
+@app.route('/messages', methods=['PUT'])
+def add_messages():
+    '''
+    Produce a batch of messages, to one or more topics, with a single log entry per group
+    Request: {'messages': [{'topic': <str>, 'message': <str>}, ...]}
+    All or nothing within a group: a group's part of the batch fails if any of its topics does not exist
+    '''
+    if not_leader():
+        return jsonify({'success': False})
+
+    messages = request.get_json()['messages']
+    if not messages:
+        return jsonify({'success': False})
+
+    batches = {} # group -> its part of the batch, in order
+    for message in messages:
+        batches.setdefault(cluster.group_of(message['topic']), []).append({'topic': message['topic'], 'message': message['message']})
+
+    success = True
+    for group, batch in batches.items():
+        timer_thread = timer_threads[group]
+        if not timer_thread.is_leader():
+            result = forward(timer_thread, json={'messages': batch})
+            success = success and result is not None and result['success']
+            continue
+
+        # add to Leader's local log, the group's part fails when applied if any of its topics does not exist
+        result = timer_thread.client_append_entries({'op': PUT_MESSAGES, 'messages': batch})
+        success = success and result['success']
+    return jsonify({'success': success})
+
+
+@app.route('/messages/<topic>', methods=['GET'])
+def get_messages(topic):
+    '''
+    Consume up to ?count=<int> messages (default 1) from a topic with a single log entry
+    Return: {'success': <bool>, 'messages': [<str>, ...]}, in FIFO order
+    '''
+    if not_leader():
+        return jsonify({'success': False})
+
+    count = request.args.get('count', 1, type=int)
+    if count < 1:
+        return jsonify({'success': False})
+
+    timer_thread = route(topic)
+    if not timer_thread.is_leader():
+        return jsonify(forward(timer_thread) or {'success': False})
+
+    # add to Leader's local log, the messages are the ones dequeued when the entry is applied (if any)
+    result = timer_thread.client_append_entries({'op': GET_MESSAGES, 'topic': topic, 'count': count})
+    if not result['success']:
+        return jsonify({'success': False})
+    return jsonify({'success': True, 'messages': result['message']})
+
+
+@app.route('/message/<topic>/peek', methods=['GET'])
+def peek_message(topic):
+    '''
+    Return the head message of a topic without consuming it, no log entry
+    '''
+    timer_thread = route(topic)
+    if is_stale_read():
+        result = timer_thread.read_stale_MQ(
+            min_index=request.args.get('min_index', type=int),
+            max_staleness=request.args.get('max_staleness', type=float)
+        )
+        if result is None or result[0].peek(topic) is None:
+            return jsonify({'success': False})
+        topics, index = result
+        return jsonify({'success': True, 'message': topics.peek(topic), 'index': index})
+
+    if not_leader():
+        return jsonify({'success': False})
+
+    if not timer_thread.is_leader():
+        return jsonify(forward(timer_thread) or {'success': False})
+
+    topics = timer_thread.read_MQ() # linearizable read
+    if topics is None or topics.peek(topic) is None:
+        return jsonify({'success': False})
+    return jsonify({'success': True, 'message': topics.peek(topic)})
 
 
 @app.route('/status', methods=['GET'])
@@ -115,13 +260,55 @@ def get_status():
     Return: {'role': <str>, 'term': <int>}
     role options: Leader, Candidate, Follower
     term: the node's current term as an integer
+    With several Raft groups, role is Leader if the node leads any group (it then serves clients), role and term
+    are otherwise group 0's, and 'groups' lists {'role', 'term'} of every group
     '''
-    node_state = timer_thread.node_state
-    role = type(node_state).__name__
-    term = node_state.current_term
-    response = {'role': role, 'term': term}
+    statuses = [
+        {'role': type(timer_thread.node_state).__name__, 'term': timer_thread.node_state.current_term}
+        for timer_thread in timer_threads
+    ]
+    response = dict(statuses[0])
+    if len(statuses) > 1:
+        if not not_leader():
+            response['role'] = 'Leader'
+        response['groups'] = statuses
     return jsonify(response)
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    '''
+    Metrics of the node in the Prometheus text format, see raft.metrics
+    Gauges of the groups (term, leadership, followers' replication lag) are read at scrape time
+    '''
+    metrics.FOLLOWER_LAG.clear()
+    for timer_thread in timer_threads:
+        node_state = timer_thread.node_state
+        metrics.TERM.set(node_state.current_term, group=timer_thread.group)
+        metrics.ROLE.set(int(type(node_state) == Leader), group=timer_thread.group)
+        if type(node_state) == Leader:
+            log_length = node_state.log.last_log_index + 1
+            for follower, match_index in node_state.match_index.items():
+                metrics.FOLLOWER_LAG.set(log_length - match_index, group=timer_thread.group, follower=follower)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started_at = time.monotonic()
+
+@app.after_request
+def count_client_request(response):
+    '''
+    Rate and duration of client requests, by endpoint (the route, e.g. /message/<topic>, not the topic)
+    '''
+    if request.url_rule is None or request.path.startswith('/raft/') or request.path == '/metrics':
+        return response
+    endpoint = request.url_rule.rule
+    metrics.CLIENT_REQUESTS.inc(method=request.method, endpoint=endpoint, status=response.status_code)
+    metrics.CLIENT_REQUEST_DURATION.observe(time.monotonic() - g.request_started_at, method=request.method, endpoint=endpoint)
+    return response
+
+
 ###### Helper functions
 def load_conf(filename, node_id, key="addresses"):
     try:
@@ -131,9 +318,57 @@ def load_conf(filename, node_id, key="addresses"):
     except FileNotFoundError:
         logging.warning('Config file NOT Found!')
 
+def load_option(filename, option, default=None):
+    '''
+    Optional setting from the config file, e.g. "lease_reads": true
+    '''
+    try:
+        with open(filename, 'r') as f:
+            config = json.load(f)
+        return config.get(option, default)
+    except FileNotFoundError:
+        return default
+
+def is_stale_read():
+    '''
+    Bounded-staleness read, opted in by the client with ?min_index=<int> and/or ?max_staleness=<seconds>:
+    any node may serve it, and the response reports the index it was served at
+    '''
+    return 'min_index' in request.args or 'max_staleness' in request.args
+
+def route(topic):
+    '''
+    TimerThread of the Raft group the topic belongs to
+    '''
+    return timer_threads[cluster.group_of(topic)]
+
+def forward(timer_thread, path=None, json=None):
+    '''
+    Forward the client request to the Leader of timer_thread's group
+    Args:
+        path: optional, path and query string to request instead of the client's
+        json: optional, body to send instead of the client's
+    Return:
+        Leader's JSON response, None if the Leader is unknown, unreachable or the request was forwarded already
+    '''
+    leader_uri = timer_thread.leader_uri()
+    if request.headers.get(FORWARDED_HEADER) or leader_uri is None or leader_uri == timer_thread.node.uri:
+        return None
+    try:
+        response = requests.request(
+            request.method, leader_uri + (path or request.full_path),
+            json=json if json is not None else request.get_json(silent=True),
+            headers={FORWARDED_HEADER: '1'}, timeout=FORWARD_TIMEOUT
+        )
+        return response.json()
+    except (requests.exceptions.RequestException, ValueError):
+        return None
+
 def not_leader():
-    role = type(timer_thread.node_state).__name__
-    return role != 'Leader'
+    '''
+    True if the node leads no group at all
+    '''
+    return not any(timer_thread.is_leader() for timer_thread in timer_threads)
 
 
 ## node.py: Receives RPC from client.py
@@ -144,13 +379,28 @@ if __name__ == '__main__':
         node_id = int(sys.argv[2].strip()) # 0
 
         addrs, cur_addr = load_conf(json_filename, node_id)
-        cluster = Cluster(addrs)
+        logger.configure(load_option(json_filename, 'logging', {})) # levels, sampling and truncation, see raft.logger
+        num_groups = load_option(json_filename, 'groups', 1) # number of Raft groups topics are sharded across
+        cluster = Cluster(addrs, num_groups)
 
         node = cluster[node_id] # this line is not used
 
-        timer_thread = TimerThread(node_id, cluster)
-        timer_thread.start()
-        
-        app.run(host=cur_addr['ip'], port=cur_addr['port'])
+        # connections to the other nodes are shared by all the groups
+        peers = Peers([peer for peer in cluster if peer != node], pool_maxsize=PEER_POOL_MAXSIZE * num_groups)
+        lease_reads = load_option(json_filename, 'lease_reads', False)
+        timer_threads = [
+            TimerThread(node_id, cluster, group=group, peers=peers, lease_reads=lease_reads)
+            for group in cluster.groups
+        ]
+        for timer_thread in timer_threads:
+            timer_thread.start()
+
+        # event loop based server: one greenlet per connection, HTTP/1.1 keep-alive for the peers' pooled connections
+        server = WSGIServer((cur_addr['ip'], cur_addr['port']), app, log=None)
+        server.init_socket()
+        # pywsgi sends headers and body separately: without TCP_NODELAY (inherited by accepted sockets),
+        # Nagle holds the body until the client's delayed ACK, ~40ms per request on a kept-alive connection
+        server.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        server.serve_forever()
     except KeyboardInterrupt:
         pass
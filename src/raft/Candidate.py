@@ -1,10 +1,11 @@
 from .NodeState import NodeState
-import grequests
-import json
-from .client import Client
+from . import codec
+from .cluster import ELECTION_TIMEOUT_MIN
+from .logger import get_logger, ELECTION
 import logging
 
 logging.basicConfig(format='%(asctime)s-%(levelname)s: %(message)s', datefmt='%H:%M:%S', level=logging.INFO)
+log = get_logger(ELECTION)
 
 class VoteRequest:
     def __init__(self, candidate):
@@ -12,21 +13,21 @@ class VoteRequest:
         self.term = candidate.current_term
         self.last_log_index = candidate.log.last_log_index
         self.last_log_term = candidate.log.last_log_term
+        self.leadership_transfer = candidate.leadership_transfer
     
-    def to_json(self):
-        return json.dumps(
-            self,
-            default=lambda obj: obj.__dict__,
-            sort_keys=True,
-            indent=4
-        )
+    def to_bytes(self):
+        return codec.encode_vote_request(self)
 
 class Candidate(NodeState):
-    def __init__(self, follower):
-        super(Candidate, self).__init__(follower.node, follower.cluster)
-        self.current_term = follower.current_term
-        self.vote_for = self.id # Candidate always votes itself
-        self.save()
+    def __init__(self, core, leadership_transfer=False):
+        '''
+        Args:
+            leadership_transfer: bool. election started on Leader's TimeoutNow request,
+                voters holding a lease grant their vote anyway (see TimerThread.vote())
+        '''
+        super(Candidate, self).__init__(core)
+        self.leadership_transfer = leadership_transfer
+        self.election_term = None # term of the election, set by elect()
         self.votes = []
         self.followers = [peer for peer in self.cluster if peer != self.node]
         
@@ -39,26 +40,63 @@ class Candidate(NodeState):
             step 3: send vote request to each peer node concurrently
             step 4: return when timeout
         '''
+        vote_request = self.start_election()
+        requests_in_flight = [self.runtime.spawn(self.canvass, peer, vote_request) for peer in self.followers]
+        for request_in_flight in requests_in_flight:
+            request_in_flight.join()
+
+    def start_election(self):
+        '''
+        Steps 1 and 2 of elect()
+        Return:
+            encoded vote request, to send to each peer
+        '''
         self.current_term += 1
-        self.votes.append(self.node) # vote itself
+        self.vote_for = self.id # Candidate always votes itself
         self.save()
-        logging.info(f'{self} sending vote requests to peers...')
-        client = Client() # init an http client
-        with client as session:
-            posts = [
-                grequests.post(f'{peer.uri}/raft/vote', json=VoteRequest(self).to_json(), session=session)
-                for peer in self.followers
-            ]
-            for response in grequests.imap(posts):
-                result = response.json()
-                logging.info(f'{self} received vote result: {response.status_code}: {result}')
-                if result[0]: # result['vote_granted'] == True
-                    self.votes.append(result[2]) # append vote_granted node id
+        self.election_term = self.current_term
+        self.votes.append(self.node) # vote itself
+        log.info('vote requests sent', node=self)
+        return VoteRequest(self).to_bytes()
+
+    def receive_vote(self, result):
+        '''
+        Count a peer's VoteResult, None if the peer did not answer
+        '''
+        if result is None:
+            return
+        log.info('vote result received', node=self, result=result)
+        if result[1] > self.current_term: # a peer is in a later term: adopt it, the election is lost
+            self.current_term = result[1]
+            self.vote_for = None
+            self.save()
+            return
+        if result[0]: # result['vote_granted'] == True
+            self.votes.append(result[2]) # append vote_granted node id
+
+    def canvass(self, peer, vote_request):
+        '''
+        Request peer's vote, and count it as soon as it comes in
+        '''
+        self.receive_vote(self.request_vote(peer, vote_request))
+
+    def request_vote(self, peer, vote_request):
+        '''
+        Send the vote request to peer
+        Return:
+            VoteResult, None if peer does not answer
+        '''
+        response = self.transport.call(peer, 'vote', vote_request, ELECTION_TIMEOUT_MIN)
+        try:
+            return None if response is None else codec.decode_vote_result(response)
+        except ValueError:
+            return None
 
 
     def win(self):
-        logging.warning(f'win: votes {len(self.votes)}; total: {len(self.cluster)}')
-        return len(self.votes) > len(self.cluster) / 2
+        log.info('election counted', node=self, votes=len(self.votes), nodes=len(self.cluster))
+        # votes only count for the election's term: a higher term seen meanwhile voids them
+        return self.current_term == self.election_term and len(self.votes) > len(self.cluster) / 2
     
     def __repr__(self):
         return f'{type(self).__name__}, id={self.node.id}, term={self.current_term}'
@@ -4,12 +4,8 @@ import logging
 logging.basicConfig(format='%(asctime)s-%(levelname)s: %(message)s', datefmt='%H:%M:%S', level=logging.INFO)
 
 class Follower(NodeState):
-    def __init__(self, node, cluster):
-        super(Follower, self).__init__(node, cluster)
-        self.commit_index = 0
-        self.last_applied_index = 0
-        self.vote_for = None # once node becomes Follower, reset vote_for=None
-        self.save()
+    def __init__(self, core):
+        super(Follower, self).__init__(core)
         self.leader = None
         
     
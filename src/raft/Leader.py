@@ -1,14 +1,16 @@
-import time
-from random import randrange
-import json
-import grequests
 from .NodeState import NodeState
-from .client import Client
-from .cluster import HEARTBEAT_INTERVAL, ELECTION_TIMEOUT_MAX
+from . import codec
+from .MessageQueue import NO_OP
+from .logger import get_logger, ELECTION, REPLICATION, SNAPSHOT
+from .metrics import APPEND_ENTRIES_RTT
+from .cluster import HEARTBEAT_INTERVAL, ELECTION_TIMEOUT_MAX, PIPELINE_WINDOW, MAX_APPEND_ENTRIES, MAX_APPEND_BYTES, SNAPSHOT_CHUNK_SIZE, LEASE_DURATION
 import logging
 
 
 logging.basicConfig(format='%(asctime)s-%(levelname)s: %(message)s', datefmt='%H:%M:%S', level=logging.INFO)
+election_log = get_logger(ELECTION)
+replication_log = get_logger(REPLICATION)
+snapshot_log = get_logger(SNAPSHOT)
 
 class AppenEntriesRequest:
     def __init__(self, leader, follower_id):
@@ -16,74 +18,334 @@ class AppenEntriesRequest:
         self.leader_id = leader.id
         self.prev_log_index = leader.next_index[follower_id] - 1
         self.prev_log_term = leader.log.get_log_term(leader.next_index[follower_id]-1)
-        self.entries = leader.log.get_entries(leader.next_index[follower_id])
+        # bounded batch: a lagging follower catches up in chunks, heartbeats to healthy followers stay small
+        self.entries = leader.log.get_entries(leader.next_index[follower_id], MAX_APPEND_ENTRIES, MAX_APPEND_BYTES)
+        # entries as raw WAL records, shipped without re-encoding
+        self.records = leader.log.get_records(self.prev_log_index + 1, self.prev_log_index + 1 + len(self.entries))
         self.leader_commit = leader.commit_index
+        self.read_round = leader.read_round # an acknowledgement confirms leadership for ReadIndex rounds up to this one
+        self.sent_at = leader.runtime.monotonic() # an acknowledgement extends Leader's lease from this time
     
-    def to_json(self):
-        return json.dumps(
-            self,
-            default=lambda obj: obj.__dict__,
-            sort_keys=True,
-            indent=4
-        )
+    def to_bytes(self):
+        return codec.encode_append_entries_request(self)
 
 
+class InstallSnapshotRequest:
+    def __init__(self, leader, snapshot_data, offset):
+        self.term = leader.current_term
+        self.leader_id = leader.id
+        self.last_included_index = leader.snapshot.last_included_index
+        self.last_included_term = leader.snapshot.last_included_term
+        self.offset = offset
+        self.data = snapshot_data[offset:offset + SNAPSHOT_CHUNK_SIZE]
+        self.done = offset + SNAPSHOT_CHUNK_SIZE >= len(snapshot_data)
+
+    def to_bytes(self):
+        return codec.encode_install_snapshot_request(self)
+
 
 class Leader(NodeState):
-    def __init__(self, candidate):
-        super(Leader, self).__init__(candidate.node, candidate.cluster)
-        self.current_term = candidate.current_term
-        self.vote_for = None # once node becomes Leader, reset vote_for=None
-        self.save()
+    def __init__(self, core):
+        super(Leader, self).__init__(core)
+        self.term = self.current_term # the term this node leads in, the core's may move on before Leader is stopped
+        # Commit a no-op entry at the start of term, so that entries from previous terms get committed
+        with self.log.lock:
+            self.log.append_entries(self.log.last_log_index, [{"command": {"op": NO_OP}, "term": self.term}])
+        self.term_start_index = self.log.last_log_index # index of the no-op
         self.stopped = False
+        self.replicate_cond = self.runtime.Condition() # notified when Leader's log grows or Leader stops
         self.followers = [peer for peer in self.cluster if peer != self.node]
         self.next_index = {peer.id: self.log.last_log_index + 1 for peer in self.followers}
         self.match_index = {peer.id: 0 for peer in self.followers}
+        # ReadIndex: each read that needs leadership confirmed starts a new round of heartbeats,
+        # acked_round[follower] is the latest round the follower acknowledged Leader's term in
+        self.read_round = 0
+        self.acked_round = {peer.id: 0 for peer in self.followers}
+        # Lease: acked_at[follower] is when the latest request the follower acknowledged Leader's term for was sent
+        self.acked_at = {peer.id: float('-inf') for peer in self.followers}
+        self.lease_valid = True # cleared when Leader steps down
+        self.transferring = False # leadership is being handed over to the group's preferred Leader
 
 
     def heartbeat(self):
+        '''
+        Start one replicator per follower, return once Leader stops
+        '''
+        self.update_commit_index() # single node cluster commits on its own
+        replicators = [self.runtime.spawn(self.replicate, peer) for peer in self.followers]
+        for replicator in replicators:
+            replicator.join()
+
+    def replicate(self, peer):
+        '''
+        Replicator of one follower:
+        sends AppendEntries as soon as Leader's log has entries the follower lacks,
+        otherwise sends an empty heartbeat every HEARTBEAT_INTERVAL
+        Requests are pipelined: up to PIPELINE_WINDOW of them are in flight at once,
+        next_index is advanced optimistically when a request is sent and rolled back if it is rejected
+        '''
+        window = self.runtime.Semaphore(PIPELINE_WINDOW)
+        sent_round = 0 # latest ReadIndex round sent to the follower
+        while not self.stopped:
+            backoff = self.transport.backoff(peer)
+            if backoff > 0: # follower unreachable
+                self.runtime.sleep(backoff)
+            window.acquire()
+            if self.stopped:
+                break
+            if self.next_index[peer.id] <= self.log.snapshot_index:
+                # entries the follower lacks are compacted away: ship the snapshot instead
+                self.send_snapshot(peer)
+                window.release()
+                continue
+
+            append_entries_request = self.next_append_entries_request(peer.id)
+            sent_round = append_entries_request.read_round
+            self.runtime.spawn(self.send_append_entries, peer, append_entries_request, window)
+
+            with self.replicate_cond:
+                self.replicate_cond.wait_for(
+                    lambda: self.stopped or self.next_index[peer.id] <= self.log.last_log_index or self.read_round > sent_round,
+                    timeout=HEARTBEAT_INTERVAL
+                )
+
+    def next_append_entries_request(self, follower_id):
+        '''
+        AppendEntries request for the entries the follower lacks, next_index is advanced past them optimistically
+        '''
+        replication_log.sampled(logging.DEBUG, 'append entries sent', node=self, follower=follower_id)
+        append_entries_request = AppenEntriesRequest(self, follower_id)
+        self.next_index[follower_id] = append_entries_request.prev_log_index + 1 + len(append_entries_request.entries)
+        return append_entries_request
+
+    def send_append_entries(self, peer, append_entries_request, window):
+        try:
+            response = self.transport.call(peer, 'heartbeat', append_entries_request.to_bytes(), HEARTBEAT_INTERVAL)
+            result = None if response is None else codec.decode_append_entries_result(response)
+        except ValueError:
+            result = None
+        finally:
+            window.release()
+
+        if result is None:
+            self.handle_append_entries_failure(append_entries_request, peer.id)
+        else:
+            APPEND_ENTRIES_RTT.observe(self.runtime.monotonic() - append_entries_request.sent_at, group=self.group, follower=peer.id)
+            replication_log.sampled(logging.DEBUG, 'append entries result received', node=self, result=result)
+            self.handle_append_entries_result(append_entries_request, result)
+        with self.replicate_cond:
+            self.replicate_cond.notify_all()
+
+    def handle_append_entries_failure(self, append_entries_request, follower_id):
+        '''
+        The follower did not answer: its entries were not acknowledged, send them again once the follower is back
+        '''
+        replication_log.sampled(logging.INFO, 'follower unreachable', node=self, follower=follower_id)
+        self.next_index[follower_id] = min(self.next_index[follower_id], append_entries_request.prev_log_index + 1)
+
+    def send_snapshot(self, peer):
+        '''
+        InstallSnapshot RPC: send the snapshot to the follower chunk by chunk, in order
+        '''
+        snapshot_data = self.snapshot.data
+        last_included_index = self.snapshot.last_included_index
+        snapshot_log.info('snapshot sent', node=self, index=last_included_index, follower=peer.id)
+        offset = 0
         while not self.stopped:
-            logging.info(f'{self} sending heartbeat to followers...')
-            logging.info('====================================================>')
-            client = Client()
-            with client as session:
-                posts = [
-                    grequests.post(f'{peer.uri}/raft/heartbeat', json=AppenEntriesRequest(self, peer.id).to_json(), session=session)
-                    for peer in self.followers
-                ]
-                for response in grequests.map(posts, gtimeout=HEARTBEAT_INTERVAL):
-                    if response is not None:
-                        result = response.json()
-                        logging.info(f'{self} received heartbeat response from follower: {result}')
-                        if result[0]: # result['success'] == True
-                            self.match_index[result[2]] = self.next_index.get(result[2])
-                            self.next_index[result[2]] = self.log.last_log_index + 1
-                        else:
-                            self.next_index[result[2]] -= 1
-                            self.next_index[result[2]] = max(0, self.next_index[result[2]])
-
-                    else:
-                        logging.info(f'{self} received heartbeat response from follower: None')
-
-            logging.info('=====================================================')
-            
-            
-            ## Update Leader's commit index
-            ## if update, commit index points to the next position of the latest commited log
-            if not self.followers: # Edge case: If only Leader node exists, directly incremenet commit_index
-                self.commit_index = self.log.last_log_index + 1
-                logging.info(f'{self} alone commits, commit index: {self.commit_index}')
-
-            N = self.commit_index + 1
-            count = 0
-            for id in self.match_index:
-                if self.match_index[id] >= N:
-                    count += 1
-                if count >= len(self.followers) // 2:
-                    self.commit_index = N
-                    logging.info(f'{self} commits, commit index: {self.commit_index}')
-                    break
-            time.sleep(HEARTBEAT_INTERVAL)
+            install_snapshot_request = InstallSnapshotRequest(self, snapshot_data, offset)
+            response = self.transport.call(peer, 'snapshot', install_snapshot_request.to_bytes(), HEARTBEAT_INTERVAL)
+            try:
+                result = None if response is None else codec.decode_install_snapshot_result(response)
+            except ValueError:
+                result = None
+            if result is None:
+                snapshot_log.info('install snapshot failed: follower unreachable', node=self, follower=peer.id)
+                return
+            if not result.success:
+                snapshot_log.info('install snapshot rejected', node=self, result=result)
+                if result.term > self.current_term:
+                    self.step_down(result.term)
+                return
+            if install_snapshot_request.done:
+                break
+            offset += len(install_snapshot_request.data)
+        else:
+            return
+        self.handle_snapshot_installed(peer.id, last_included_index)
+
+    def handle_snapshot_installed(self, follower_id, last_included_index):
+        '''
+        Once installed, the follower's log is known to match Leader's up to the snapshot
+        '''
+        self.match_index[follower_id] = max(self.match_index[follower_id], last_included_index + 1)
+        self.next_index[follower_id] = max(self.next_index[follower_id], last_included_index + 1)
+        self.update_commit_index()
+
+    def maybe_transfer_leadership(self, follower_id):
+        '''
+        Multi-Raft: hand leadership over to the group's preferred Leader (see Cluster.preferred_leader)
+        once its log is up to date, so that the groups' Leaders stay spread across nodes
+        The preferred Leader is told to start an election right away (TimeoutNow), its higher term makes Leader step down
+        Voters grant that election their vote even while they hold a lease, so Leader gives its lease up first
+        (for the rest of its term: the TimeoutNow request may arrive even if its response is lost)
+        '''
+        preferred_leader = self.cluster.preferred_leader(self.group)
+        if len(self.cluster.groups) == 1 or self.transferring or self.stopped or preferred_leader.id != follower_id:
+            return
+        if self.match_index[follower_id] != self.log.last_log_index + 1:
+            return
+        self.transferring = True
+        self.invalidate_lease()
+        self.runtime.spawn(self.send_timeout_now, preferred_leader)
+
+    def send_timeout_now(self, peer):
+        election_log.info('leadership transfer started', node=self, to=peer.id)
+        response = self.transport.call(peer, 'timeout_now', codec.encode_timeout_now_request(self.current_term, self.id), HEARTBEAT_INTERVAL)
+        if response is None:
+            election_log.info('leadership transfer failed', node=self, to=peer.id)
+            self.transferring = False # try again on the next acknowledgement
+
+    def handle_append_entries_result(self, append_entries_request, result):
+        if self.stopped: # stepped down: the shared log and term may belong to the new Leader already
+            return
+        if result[1] > self.current_term:
+            self.step_down(result[1])
+            return
+        follower_id = result[2]
+        if result[1] == self.current_term: # follower still recognizes Leader's term, whether or not logs match
+            self.acked_round[follower_id] = max(self.acked_round[follower_id], append_entries_request.read_round)
+            self.acked_at[follower_id] = max(self.acked_at[follower_id], append_entries_request.sent_at)
+        if result[0]: # result['success'] == True
+            # follower's log matches Leader's log up to the last entry sent
+            matched = append_entries_request.prev_log_index + 1 + len(append_entries_request.entries)
+            self.match_index[follower_id] = max(self.match_index[follower_id], matched)
+            self.next_index[follower_id] = max(self.next_index[follower_id], matched)
+            self.update_commit_index()
+            self.maybe_transfer_leadership(follower_id)
+        elif append_entries_request.prev_log_index >= self.match_index[follower_id]:
+            # roll back next_index, including the optimistic advance of requests sent after this one
+            # (a rejection below match_index is stale and ignored)
+            rollback = self.backtrack(append_entries_request, result)
+            self.next_index[follower_id] = max(self.match_index[follower_id], min(self.next_index[follower_id], rollback))
+
+    def backtrack(self, append_entries_request, result):
+        '''
+        Where to resume replication after a rejection, using Follower's conflict hints:
+            - Leader has entries of conflict_term: right after its last entry of that term
+            - otherwise: conflict_index, skipping the whole conflicting term (or the missing tail) at once
+        Without hints (e.g. rejected for stale term), back up by one entry
+        '''
+        conflict_term, conflict_index = result[3], result[4]
+        if conflict_index < 0:
+            return max(0, append_entries_request.prev_log_index)
+        if conflict_term >= 0:
+            last_index = self.log.get_last_index_of_term(conflict_term)
+            if last_index >= 0:
+                return last_index + 1
+        return conflict_index
+
+    def client_append_entries(self, client_request):
+        '''
+        Append client's command to Leader's log, then wake replicators up to ship it right away
+        '''
+        result = super(Leader, self).client_append_entries(client_request)
+        if not result['success']:
+            return result
+        self.update_commit_index() # single node cluster commits on its own
+        with self.replicate_cond:
+            self.replicate_cond.notify_all()
+        return result
+
+    def leading(self, term):
+        '''
+        True while this Leader has not stepped down and the node is still in term, the term it leads in
+        '''
+        return not self.stopped and self.current_term == self.term == term
+
+    def read_index(self, timeout):
+        '''
+        ReadIndex: commit index a linearizable read may be served at, once the MQ is applied up to it
+            1. the no-op of Leader's term is committed, so that commit_index covers every entry committed before
+            2. record commit_index as the read index
+            3. confirm Leader is still Leader with a round of heartbeats acknowledged by a majority
+        Nothing is written to the log
+        Return:
+            read index, None if Leader cannot confirm its leadership within timeout
+        '''
+        if not self.wait_for_apply(self.term_start_index, timeout):
+            return None
+        read_index = self.commit_index
+        if not self.confirm_leadership(timeout):
+            return None
+        return read_index
+
+    def lease_read_index(self):
+        '''
+        Lease read: read index available without any network round trip,
+        as long as a majority (Leader included) acknowledged a heartbeat sent within the last LEASE_DURATION seconds
+        Return:
+            commit index, None if the lease has expired (fall back to read_index())
+        '''
+        if not self.lease_valid or self.last_applied_index <= self.term_start_index:
+            return None
+        now = self.runtime.monotonic()
+        acked_at = sorted([now] + list(self.acked_at.values()), reverse=True)
+        if now >= acked_at[len(self.cluster) // 2] + LEASE_DURATION:
+            return None
+        return self.commit_index
+
+    def invalidate_lease(self):
+        self.lease_valid = False
+
+    def confirm_leadership(self, timeout):
+        '''
+        Start a new round of heartbeats, sent right away, and wait until a majority (Leader included) acknowledged it
+        Concurrent reads share rounds
+        '''
+        with self.replicate_cond:
+            self.read_round += 1
+            read_round = self.read_round
+            self.replicate_cond.notify_all()
+            return self.replicate_cond.wait_for(
+                lambda: self.stopped or sum(acked >= read_round for acked in self.acked_round.values()) + 1 > len(self.cluster) // 2,
+                timeout=timeout
+            ) and not self.stopped
+
+    def step_down(self, term):
+        '''
+        A follower answered with a higher term: adopt it and stop,
+        TimerThread turns the node into a Follower once heartbeat() returns
+        '''
+        election_log.info('higher term seen: steps down', node=self, term=term)
+        if term > self.current_term:
+            self.current_term = term
+            self.vote_for = None
+            self.save()
+        self.invalidate_lease()
+        self.stop()
+
+    def stop(self):
+        '''
+        Stop replicators when Leader steps down
+        '''
+        with self.replicate_cond:
+            self.stopped = True
+            self.replicate_cond.notify_all()
+
+    def update_commit_index(self):
+        '''
+        Leader Rule 4: commit the largest N replicated on a majority (Leader's own log included)
+        Only an entry from current term is committed by counting replicas,
+        earlier entries are committed indirectly with it
+        commit index points to the next position of the latest commited log
+        '''
+        if self.stopped:
+            return
+        matched = sorted([self.log.last_log_index + 1] + list(self.match_index.values()), reverse=True)
+        N = matched[len(self.cluster) // 2]
+        if N > self.commit_index and self.log.get_log_term(N - 1) == self.current_term:
+            self.commit_index = N
+            replication_log.debug('committed', node=self, commit_index=self.commit_index)
     
     def __repr__(self):
         return f'{type(self).__name__}, id={self.node.id}, term={self.current_term}'
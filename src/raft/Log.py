@@ -1,51 +1,283 @@
 import os
 import json
+import struct
+import zlib
+from .metrics import LOG_SAVE_DURATION
+from .runtime import Runtime
+
+# Write-ahead log record: [payload length: uint32][crc32 of payload: uint32][payload: JSON-encoded entry]
+# The first record of the file is a header: {"snapshot_index": <int>, "snapshot_term": <int>}
+RECORD_HEADER = struct.Struct('>II')
 
 class Log:
-    def __init__(self, filename):
+    '''
+    Append-only write-ahead log
+        - append writes only the new records, O(entry) instead of rewriting the whole file
+        - a conflicting suffix is cut off in place by truncating the file at the record's offset
+        - on open, records are replayed until the first torn/corrupt one, which is truncated away
+        - entries up to snapshot_index are compacted away once a snapshot covers them,
+          entries[0] is the entry at index snapshot_index + 1. All indexes below are absolute log indexes
+        - writes and fsyncs run on a worker thread (see Runtime.run_blocking()), new entries only show up once durable
+    Whoever changes the log holds self.lock, the other tasks keep running while it waits for the disk
+    '''
+    def __init__(self, filename, runtime=None, group=0):
         self.filename = filename
+        self.runtime = runtime or Runtime()
+        self.group = group # Raft group of the log, the label of its metrics
+        self.lock = self.runtime.Semaphore(1) # held across the checks and writes of an append, see NodeState.append_entries()
         self.entries = []
+        self.offsets = [] # offsets[i]: file offset where the record of entries[i] starts
+        self.size = 0 # file offset right after the last valid record
+        self.snapshot_index = -1 # index of the last entry compacted into a snapshot
+        self.snapshot_term = -1
+
+        self.file = None
+        if self.recover():
+            self.file = open(self.filename, 'a+b') # appends always go to the end, records are read back with pread
+        else:
+            self.rewrite(-1, -1, [], b'')
+
+    def recover(self):
+        '''
+        Crash recovery: load every complete record, drop a partially written tail
+        Return:
+            False if there is no log file yet (or not even a complete header)
+        '''
+        if not os.path.exists(self.filename):
+            return False
+        with open(self.filename, 'rb') as f:
+            data = f.read()
+
+        offset = 0
+        header = None
+        while offset + RECORD_HEADER.size <= len(data):
+            length, checksum = RECORD_HEADER.unpack_from(data, offset)
+            start = offset + RECORD_HEADER.size
+            payload = data[start:start + length]
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                break
+            if header is None:
+                header = json.loads(payload)
+            else:
+                self.entries.append(json.loads(payload))
+                self.offsets.append(offset)
+            offset = start + length
 
-        if os.path.exists(self.filename):
-            with open(self.filename, 'r') as f:
-                self.entries = json.load(f)
+        if header is None:
+            return False
+        self.snapshot_index = header["snapshot_index"]
+        self.snapshot_term = header["snapshot_term"]
+        self.size = offset
+        if offset < len(data):
+            os.truncate(self.filename, offset)
+        return True
 
 
+    @property
+    def start_index(self):
+        '''
+        Index of entries[0]
+        '''
+        return self.snapshot_index + 1
+
     @property
     def last_log_index(self):
-        return len(self.entries) - 1
-    
+        return self.snapshot_index + len(self.entries)
+
     @property
     def last_log_term(self):
         return self.get_log_term(self.last_log_index)
-    
+
     def get_log_term(self, log_index):
-        if log_index < 0 or log_index >= len(self.entries):
+        if log_index == self.snapshot_index:
+            return self.snapshot_term
+        if log_index < self.start_index or log_index > self.last_log_index:
             return -1
         else:
-            return self.entries[log_index]["term"]
-        
+            return self.entries[log_index - self.start_index]["term"]
 
-    def get_log_message(self, log_index):
-        if log_index < 0 or log_index >= len(self.entries):
-            empty = {}
-            return json.dumps(empty)
+
+    def get_first_index_of_term(self, log_index):
+        '''
+        First index of the term that the entry at log_index belongs to (as far as the log still holds it)
+        '''
+        term = self.get_log_term(log_index)
+        while log_index > self.start_index and self.entries[log_index - 1 - self.start_index]["term"] == term:
+            log_index -= 1
+        return log_index
+
+    def get_last_index_of_term(self, term):
+        '''
+        Last index of an entry with the given term, -1 if there is none
+        '''
+        for i in range(len(self.entries) - 1, -1, -1):
+            log_term = self.entries[i]["term"]
+            if log_term == term:
+                return self.start_index + i
+            if log_term < term:
+                return -1
+        return self.snapshot_index if self.snapshot_term == term else -1
+
+    def get_log_command(self, log_index):
+        if log_index < self.start_index or log_index > self.last_log_index:
+            return None
         else:
-            return self.entries[log_index]["message"]
-        
-    def get_entries(self, next_index):
-        return self.entries[max(0, next_index):]
-    
+            return self.entries[log_index - self.start_index]["command"]
+
+    def get_entries(self, next_index, max_entries=None, max_bytes=None):
+        '''
+        Entries from next_index on, at most max_entries of them and at most max_bytes of encoded records
+        (the first entry is always included, however large it is)
+        '''
+        next_index = max(self.start_index, next_index)
+        end = self.last_log_index + 1
+        if max_entries is not None:
+            end = min(end, next_index + max_entries)
+        if max_bytes is not None and next_index < end:
+            # record sizes come for free from the file offsets
+            limit = self.offsets[next_index - self.start_index] + max_bytes
+            last = next_index + 1
+            while last < end and self.get_record_end(last) <= limit:
+                last += 1
+            end = last
+        return self.entries[next_index - self.start_index:end - self.start_index]
+
+    def get_records(self, start, end):
+        '''
+        Raw records of the entries at [start, end), read straight from the file
+        '''
+        if start >= end:
+            return b''
+        self.file.flush()
+        offset = self.offsets[start - self.start_index]
+        return os.pread(self.file.fileno(), self.get_record_end(end - 1) - offset, offset)
+
+    def get_record_end(self, log_index):
+        '''
+        File offset right after the record of the entry at log_index
+        '''
+        i = log_index - self.start_index
+        if i + 1 < len(self.entries):
+            return self.offsets[i + 1]
+        return self.size
+
     def delete_entries(self, prev_log_index):
-        if prev_log_index < 0 or prev_log_index >= len(self.entries):
+        if prev_log_index < self.start_index or prev_log_index > self.last_log_index:
             return
-        self.entries = self.entries[:max(0, prev_log_index)]
-        self.save()
-    
-    def append_entries(self, prev_log_index, new_entries):
-        self.entries = self.entries[:max(0, prev_log_index + 1)] + new_entries
+        self.truncate(prev_log_index)
         self.save()
-    
+
+    def append_entries(self, prev_log_index, new_entries, payloads=None):
+        '''
+        Entries already in the log (same index and term) are skipped,
+        the log is truncated at the first conflicting entry and only the remaining ones are written
+        payloads: optional, already encoded new_entries (e.g. received from Leader), written as they are
+        '''
+        start = prev_log_index + 1
+        for i, entry in enumerate(new_entries):
+            index = start + i
+            if index < self.start_index:
+                continue # already compacted into the snapshot
+            if index <= self.last_log_index and self.get_log_term(index) == entry["term"]:
+                continue
+            self.truncate(index)
+            self.write(new_entries[i:], payloads[i:] if payloads is not None else None)
+            break
+
+    def truncate(self, index):
+        '''
+        Drop the entries from index on by cutting the file at the offset of the entry at index
+        '''
+        if index > self.last_log_index:
+            return
+        i = index - self.start_index
+        self.size = self.offsets[i]
+        self.file.truncate(self.size)
+        del self.entries[i:]
+        del self.offsets[i:]
+
+    def write(self, new_entries, payloads=None):
+        '''
+        Append records for new_entries to the end of the file, in a single write, and make them durable
+        The entries are added to the log once durable: Leader counts its own log towards the commit index
+        '''
+        if payloads is None:
+            payloads = [json.dumps(entry, separators=(',', ':')).encode() for entry in new_entries]
+        records = bytearray()
+        offsets = []
+        for payload in payloads:
+            offsets.append(self.size + len(records))
+            records += encode_record(payload)
+        self.runtime.run_blocking(self.sync, bytes(records))
+        self.offsets += offsets
+        self.entries += new_entries
+        self.size += len(records)
+
     def save(self):
-        with open(self.filename, 'w') as f:
-            json.dump(self.entries, f, indent=4)
\ No newline at end of file
+        '''
+        Make every written record durable
+        '''
+        self.runtime.run_blocking(self.sync)
+
+    def sync(self, records=b''):
+        '''
+        Write records, then flush and fsync the file. Blocks on the disk, see Runtime.run_blocking()
+        '''
+        with LOG_SAVE_DURATION.time(group=self.group):
+            self.file.write(records)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def compact(self, snapshot_index, snapshot_term):
+        '''
+        Drop the entries up to snapshot_index, now covered by a snapshot
+        Only the remaining tail is copied to a new file, which then atomically replaces the log file
+        '''
+        if snapshot_index <= self.snapshot_index:
+            return
+        if snapshot_index >= self.last_log_index:
+            self.rewrite(snapshot_index, snapshot_term, [], b'')
+            return
+        keep = snapshot_index + 1
+        records = self.get_records(keep, self.last_log_index + 1)
+        self.rewrite(snapshot_index, snapshot_term, self.entries[keep - self.start_index:], records)
+
+    def reset(self, snapshot_index, snapshot_term):
+        '''
+        Discard the whole log, which is superseded by a snapshot received from Leader
+        '''
+        self.rewrite(snapshot_index, snapshot_term, [], b'')
+
+    def rewrite(self, snapshot_index, snapshot_term, entries, records):
+        '''
+        Replace the log file with a new one holding the header and the given (already encoded) entries
+        '''
+        header = encode_record(json.dumps({"snapshot_index": snapshot_index, "snapshot_term": snapshot_term}).encode())
+        tmp_filename = self.filename + '.tmp'
+        self.runtime.run_blocking(write_file, tmp_filename, header + records)
+        os.replace(tmp_filename, self.filename)
+
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.filename, 'a+b')
+        kept_offsets = self.offsets[len(self.offsets) - len(entries):] if entries else []
+        shift = kept_offsets[0] - len(header) if entries else 0
+        self.offsets = [offset - shift for offset in kept_offsets]
+        self.entries = list(entries)
+        self.size = len(header) + len(records)
+        self.snapshot_index = snapshot_index
+        self.snapshot_term = snapshot_term
+
+
+def encode_record(payload):
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def write_file(filename, data):
+    '''
+    Write data to a new file and make it durable. Blocks on the disk, see Runtime.run_blocking()
+    '''
+    with open(filename, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
@@ -0,0 +1,98 @@
+import collections
+
+## Commands carried by log entries
+CREATE_TOPIC = 'create_topic'
+PUT_MESSAGE = 'put_message'
+GET_MESSAGE = 'get_message'
+PUT_MESSAGES = 'put_messages' # batch of messages, to one or more topics, in a single entry
+GET_MESSAGES = 'get_messages' # up to count messages from a topic, in a single entry
+NO_OP = 'no_op' # appended by a new Leader at the start of its term
+
+
+class MessageQueue:
+    '''
+    State machine replicated by Raft: topic -> FIFO queue of messages
+    Each log entry carries one small command instead of the whole MQ:
+        - {'op': 'create_topic', 'topic': <str>}
+        - {'op': 'put_message', 'topic': <str>, 'message': <str>}
+        - {'op': 'get_message', 'topic': <str>}
+        - {'op': 'put_messages', 'messages': [{'topic': <str>, 'message': <str>}, ...]}
+        - {'op': 'get_messages', 'topic': <str>, 'count': <int>}
+        - {'op': 'no_op'}
+    Commands are deterministic, so applying the same committed prefix on any node yields the same MQ
+    '''
+    def __init__(self):
+        self.topics = {} # topic -> deque of messages, in creation order
+
+    def apply(self, command):
+        '''
+        Apply one command to the MQ
+        Return:
+            (success, message): message is only set for a successful get_message,
+            it is the list of dequeued messages for a successful get_messages
+        '''
+        op = command['op']
+        if op == NO_OP:
+            return True, None
+
+        if op == PUT_MESSAGES:
+            # all or nothing: the batch fails if any of its topics does not exist
+            if any(message['topic'] not in self.topics for message in command['messages']):
+                return False, None
+            for message in command['messages']:
+                self.topics[message['topic']].append(message['message'])
+            return True, None
+
+        topic = command['topic']
+        if op == CREATE_TOPIC:
+            if topic in self.topics:
+                return False, None
+            self.topics[topic] = collections.deque()
+            return True, None
+
+        if op == PUT_MESSAGE:
+            if topic not in self.topics:
+                return False, None
+            self.topics[topic].append(command['message'])
+            return True, None
+
+        if op == GET_MESSAGE:
+            if not self.topics.get(topic):
+                return False, None
+            return True, self.topics[topic].popleft()
+
+        if op == GET_MESSAGES:
+            queue = self.topics.get(topic)
+            if not queue:
+                return False, None
+            return True, [queue.popleft() for _ in range(min(command['count'], len(queue)))]
+
+        raise ValueError(f'Unknown MQ command: {op}')
+
+    def peek(self, topic):
+        '''
+        Return the head message of a topic without consuming it, None if there is none
+        '''
+        queue = self.topics.get(topic)
+        return queue[0] if queue else None
+
+    def to_dict(self):
+        '''
+        Return the MQ as plain JSON-serializable data, for snapshots: topic -> list of messages
+        '''
+        return {topic: list(queue) for topic, queue in self.topics.items()}
+
+    @classmethod
+    def from_dict(cls, topics):
+        '''
+        Rebuild an MQ from to_dict()'s output
+        '''
+        mq = cls()
+        mq.topics = {topic: collections.deque(messages) for topic, messages in topics.items()}
+        return mq
+
+    def __contains__(self, topic):
+        return topic in self.topics
+
+    def __repr__(self):
+        return f'{type(self).__name__}, topics={list(self.topics.keys())}'
@@ -0,0 +1,179 @@
+import os
+import json
+from .cluster import SNAPSHOT_THRESHOLD, APPLY_RESULTS_MAX
+from .Log import Log
+from .Snapshot import Snapshot
+from .runtime import Runtime
+from .group_commit import GroupCommit
+from .MessageQueue import MessageQueue
+from .logger import get_logger, SNAPSHOT
+from .metrics import STATE_SAVE_DURATION
+import logging
+
+logging.basicConfig(format='%(asctime)s-%(levelname)s: %(message)s', datefmt='%H:%M:%S', level=logging.INFO)
+log = get_logger(SNAPSHOT)
+
+STORAGE_PATH = './data'
+
+class NodeCore:
+    '''
+    State of the node's member of one Raft group that outlives role changes:
+    hard state (current_term, vote_for), log, snapshot and the MQ applied from the committed entries
+    It is loaded from disk once, when the node starts; Follower, Candidate and Leader are views over it
+    that only add their own volatile state, so a role change does no I/O and does not depend on the log size
+    '''
+    def __init__(self, node, cluster, transport=None, group=0, storage_path=STORAGE_PATH, runtime=None):
+        self.cluster = cluster
+        self.node = node # Node(id, uri)
+        self.transport = transport # Transport: how RPCs reach the other nodes
+        self.id = node.id
+        self.group = group # Raft group this state belongs to, see Cluster
+        self.runtime = runtime or Runtime() # time and concurrency primitives the roles run on
+
+        ## Volatile state
+        self.commit_cond = self.runtime.Condition() # notified whenever commit_index advances, once the entries are applied
+
+        ## Persistent state
+        if not os.path.exists(storage_path):
+            os.makedirs(storage_path)
+
+        self.states_filename = os.path.join(storage_path, f'{self.id}_{self.group}_states.json')
+        self.current_term = 0
+        self.vote_for = None # Candidate ID that me as Follower voted
+        self.load()
+        log_filename = os.path.join(storage_path, f'{self.id}_{self.group}_log.wal')
+        self.log = Log(log_filename, self.runtime, self.group) # log_entries[]
+        self.group_commit = GroupCommit(self.log, self.runtime) # batches client appends into one fsync
+        snapshot_filename = os.path.join(storage_path, f'{self.id}_{self.group}_snapshot.json')
+        self.snapshot = Snapshot(snapshot_filename) # MQ as of the entries compacted out of the log
+        self.compact_log() # in case of a crash between saving a snapshot and compacting the log
+
+        # State machine: MQ with every committed entry up to last_applied_index applied, rebuilt from the snapshot
+        # (which only holds committed entries), then kept up to date by apply_committed()
+        self.mq = MessageQueue.from_dict(self.snapshot.mq)
+        self.last_applied_index = self.snapshot.last_included_index + 1
+        self.apply_results = {} # log index -> (term, (success, message)) of the applied entry, popped by the client waiting for it
+        self.snapshotting = False # a snapshot is being taken in the background, see take_snapshot()
+        self.commit_index = self.snapshot.last_included_index + 1
+
+    @property
+    def commit_index(self):
+        '''
+        Number of committed entries, i.e. the next position of the latest committed log
+        '''
+        return self._commit_index
+
+    @commit_index.setter
+    def commit_index(self, value):
+        with self.commit_cond:
+            self._commit_index = value
+            self.apply_committed()
+            self.commit_cond.notify_all()
+
+    def apply_committed(self):
+        '''
+        Apply loop: apply the committed entries that are not applied yet to the MQ, in log order
+        Last applied index is the next position of the latest applied log, like commit_index
+        '''
+        while self.last_applied_index < self._commit_index:
+            command = self.log.get_log_command(self.last_applied_index)
+            if command is None: # not in the log yet
+                break
+            term = self.log.get_log_term(self.last_applied_index)
+            self.apply_results[self.last_applied_index] = (term, self.mq.apply(command))
+            self.apply_results.pop(self.last_applied_index - APPLY_RESULTS_MAX, None) # nobody waits that long
+            self.last_applied_index += 1
+        self.maybe_snapshot()
+
+    def wait_for_apply(self, log_index, timeout):
+        '''
+        Block until the entry at log_index is applied to the MQ
+        Return:
+            True if applied, False if timeout expires first
+        '''
+        with self.commit_cond:
+            return self.commit_cond.wait_for(lambda: self.last_applied_index > log_index, timeout=timeout)
+
+    def pop_apply_result(self, log_index, term):
+        '''
+        Return:
+            (success, message) of applying the entry at log_index, None if it is not known (any more)
+            or if the entry applied there is not of term: another Leader's entry replaced the one proposed
+        '''
+        if self.apply_results.get(log_index, (None, None))[0] != term:
+            return None
+        return self.apply_results.pop(log_index)[1]
+
+    def load(self):
+        '''
+        Read persistent states from storage:
+            - current_term
+            - vote_for
+        '''
+        if os.path.exists(self.states_filename):
+            with open(self.states_filename, 'r') as f:
+                data = json.load(f)
+            self.current_term = data['current_term']
+            self.vote_for = data['vote_for']
+        else:
+            self.save()
+
+    def save(self):
+        '''
+        Save persistent states from storage:
+            - current_term
+            - vote_for
+        '''
+        data = {
+            'current_term': self.current_term,
+            'vote_for': self.vote_for
+        }
+        with STATE_SAVE_DURATION.time(group=self.group), open(self.states_filename, 'w') as f:
+            json.dump(data, f, indent=4)
+
+    def maybe_snapshot(self):
+        '''
+        Start taking a snapshot once SNAPSHOT_THRESHOLD applied entries follow the last snapshot
+        It runs in the background: the apply loop (and the Follower's AppendEntries handler it runs in) does not wait for it
+        '''
+        if self.snapshotting or self.last_applied_index - 1 - self.snapshot.last_included_index < SNAPSHOT_THRESHOLD:
+            return
+        self.snapshotting = True
+        self.runtime.spawn(self.take_snapshot)
+
+    def take_snapshot(self):
+        '''
+        Snapshot the MQ as of the last applied entry, then compact the log
+        Only copying the MQ holds the other tasks up: encoding and fsyncing the copy run on a worker thread
+        (see Runtime.run_blocking()), while entries keep being committed and applied
+        '''
+        try:
+            last_included_index = self.last_applied_index - 1
+            last_included_term = self.log.get_log_term(last_included_index)
+            mq = self.mq.to_dict()
+            data = self.runtime.run_blocking(self.snapshot.prepare, last_included_index, last_included_term, mq)
+            if last_included_index <= self.snapshot.last_included_index: # Leader's snapshot was installed meanwhile
+                return
+            self.snapshot.commit(data, last_included_index, last_included_term, mq)
+            self.compact_log()
+            log.info('snapshot taken', node=self, index=last_included_index, term=last_included_term)
+        finally:
+            self.snapshotting = False
+
+    def compact_log(self):
+        '''
+        Drop the log entries covered by the snapshot
+        If the log does not hold the snapshot's last included entry, the whole log is superseded by the snapshot
+        '''
+        last_included_index = self.snapshot.last_included_index
+        last_included_term = self.snapshot.last_included_term
+        with self.log.lock: # the log file is replaced, not while a write is in progress
+            if last_included_index <= self.log.snapshot_index:
+                return
+            if self.log.get_log_term(last_included_index) == last_included_term:
+                self.log.compact(last_included_index, last_included_term)
+            else:
+                self.log.reset(last_included_index, last_included_term)
+
+    def __repr__(self):
+        return f'{type(self).__name__}, id={self.id}, group={self.group}, term={self.current_term}'
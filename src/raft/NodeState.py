@@ -1,68 +1,66 @@
 import collections
 
-import os
-import json
-from .cluster import Cluster
-from .Log import Log
+from .MessageQueue import MessageQueue
+from .logger import get_logger, ELECTION, REPLICATION, SNAPSHOT, CLIENT
 import logging
 
 logging.basicConfig(format='%(asctime)s-%(levelname)s: %(message)s', datefmt='%H:%M:%S', level=logging.INFO)
+election_log = get_logger(ELECTION)
+replication_log = get_logger(REPLICATION)
+snapshot_log = get_logger(SNAPSHOT)
+client_log = get_logger(CLIENT)
 
 VoteResult = collections.namedtuple('VoteResult', ['vote_granted', 'term', 'id'])
-AppendEntriesResult = collections.namedtuple('AppendEntriesResult', ['success', 'term', 'id'])
+# conflict_term/conflict_index: hints of a rejected AppendEntries for Leader to back next_index up in one step
+#   - conflict_term: term of Follower's entry at prev_log_index, -1 if Follower's log is too short
+#   - conflict_index: first index of conflict_term in Follower's log, or Follower's log length
+AppendEntriesResult = collections.namedtuple('AppendEntriesResult', ['success', 'term', 'id', 'conflict_term', 'conflict_index'], defaults=(-1, -1))
+InstallSnapshotResult = collections.namedtuple('InstallSnapshotResult', ['success', 'term', 'id'])
+
+def core_attribute(name):
+    '''
+    Attribute of the role that lives in its NodeCore, so that it is shared by every role the node takes
+    '''
+    return property(lambda self: getattr(self.core, name), lambda self, value: setattr(self.core, name, value))
 
-STORAGE_PATH = './data'
 
 class NodeState:
-    def __init__(self, node=None, cluster=None):
-        self.cluster = cluster
-        self.node = node # Node(id, uri)
-        self.id = node.id
-        
-        ## Volatile state
-        self.commit_index = 0
-        self.last_applied_index = 0
-
-        ## Persistent state
-        if not os.path.exists(STORAGE_PATH):
-            os.makedirs(STORAGE_PATH)
-
-        self.current_term = 0
-        self.vote_for = None # Candidate ID that me as Follower voted
-        self.load()
-        log_filename = os.path.join(STORAGE_PATH, f'{self.id}_log.json')
-        self.log = Log(log_filename) # log_entries[]
-    
-    def load(self):
-        '''
-        Read persistent states from storage:
-            - current_term 
-            - vote_for
-        '''
-        filename = os.path.join(STORAGE_PATH, f'{self.id}_states.json')
-        if os.path.exists(filename):
-            with open(filename, 'r') as f:
-                data = json.load(f)
-            self.current_term = data['current_term']
-            self.vote_for = data['vote_for']
-        else:
-            self.save()
-    
+    '''
+    Role of the node in one Raft group: Follower, Candidate or Leader
+    A role only holds its own volatile state, the rest is read from and written to the node's long-lived NodeCore
+    '''
+    node = core_attribute('node')
+    cluster = core_attribute('cluster')
+    transport = core_attribute('transport')
+    runtime = core_attribute('runtime')
+    id = core_attribute('id')
+    group = core_attribute('group')
+    commit_cond = core_attribute('commit_cond')
+    current_term = core_attribute('current_term')
+    vote_for = core_attribute('vote_for')
+    log = core_attribute('log')
+    group_commit = core_attribute('group_commit')
+    snapshot = core_attribute('snapshot')
+    mq = core_attribute('mq')
+    last_applied_index = core_attribute('last_applied_index')
+    apply_results = core_attribute('apply_results')
+    commit_index = core_attribute('commit_index') # setting it applies the newly committed entries
+
+    def __init__(self, core):
+        self.core = core # NodeCore
+
+    def wait_for_apply(self, log_index, timeout):
+        return self.core.wait_for_apply(log_index, timeout)
+
+    def pop_apply_result(self, log_index, term):
+        return self.core.pop_apply_result(log_index, term)
+
     def save(self):
-        '''
-        Save persistent states from storage:
-            - current_term 
-            - vote_for
-        '''
-        data = {
-            'current_term': self.current_term,
-            'vote_for': self.vote_for
-        }
-        filename = os.path.join(STORAGE_PATH, f'{self.id}_states.json')
-        with open(filename, 'w') as f:
-            json.dump(data, f, indent=4)
+        self.core.save()
+
+    def compact_log(self):
+        self.core.compact_log()
 
-    
     def vote(self, vote_request):
         '''
         Me as Follower node reacting to Candidate node's vote request
@@ -78,40 +76,39 @@ class NodeState:
             id: current node's id
         Rules:
             1. False if candidate_term < current_term
-            2. True if (vote_for is None or vote_for == candidate_id) and candidate's log is newer
+            2. True if (vote_for is None or vote_for == candidate_id) and candidate's log is at least as up-to-date:
+               its last entry has a higher term, or the same term at an index at least as high
+            A higher candidate_term is adopted first (All Servers Rule 2), whether or not the vote is granted
         '''
         candidate_term = vote_request['term']
         candidate_id = vote_request['candidate_id']
         candidate_last_log_index = vote_request['last_log_index']
         candidate_last_log_term = vote_request['last_log_term']
 
-        if candidate_term > self.current_term:
-            logging.info(f'{self} accepts vote request as Candidate term: {candidate_term} > {self.current_term}')
-            self.vote_for = candidate_id
-            self.current_term = candidate_term
-            self.save()
-            return VoteResult(True, self.current_term, self.id)
-
-        if candidate_term < self.current_term:
-            logging.info(f'{self} rejects vote request as Candidate term: {candidate_term} < {self.current_term}')
-            return VoteResult(False, self.current_term, self.id)
+        with self.log.lock: # the log is not compared while an append waits for the disk
+            if candidate_term < self.current_term:
+                election_log.info('vote rejected: stale term', node=self, candidate=candidate_id, candidate_term=candidate_term)
+                return VoteResult(False, self.current_term, self.id)
 
-        # RequestVote RPC Rule 2
-        if self.vote_for is None or self.vote_for == candidate_id:
-            # Check if the candidate's log is newer than receiver's
-            if candidate_last_log_index >= self.log.last_log_index and candidate_last_log_term >= self.log.last_log_term:
-                logging.info(f'{self} accepts vote request as Candidate log is newer')
-                self.vote_for = candidate_id
-                self.save()
-                return VoteResult(True, self.current_term, self.id)
-            else:
-                logging.info(f'{self} rejects vote request as Candidate log too old')
+            if candidate_term > self.current_term:
+                election_log.info('term updated from Candidate', node=self, candidate=candidate_id, candidate_term=candidate_term)
+                self.current_term = candidate_term
                 self.vote_for = None
                 self.save()
+
+            # RequestVote RPC Rule 2
+            if self.vote_for is not None and self.vote_for != candidate_id:
+                election_log.info('vote rejected: already voted', node=self, candidate=candidate_id, vote_for=self.vote_for)
                 return VoteResult(False, self.current_term, self.id)
 
-        logging.info(f'{self} rejects vote request as vote_for id: {self.vote_for} != {candidate_id}')
-        return VoteResult(False, self.current_term, self.id)
+            if (candidate_last_log_term, candidate_last_log_index) < (self.log.last_log_term, self.log.last_log_index):
+                election_log.info('vote rejected: log too old', node=self, candidate=candidate_id)
+                return VoteResult(False, self.current_term, self.id)
+
+            election_log.info('vote granted', node=self, candidate=candidate_id)
+            self.vote_for = candidate_id
+            self.save()
+            return VoteResult(True, self.current_term, self.id)
     
     def win(self):
         '''
@@ -128,20 +125,42 @@ class NodeState:
             If command received from client: append entry to local log, 
             respond after entry applied to state machine
         Arg:
-            client_request: str
+            client_request: dict. MQ command, see MessageQueue
         '''
-        new_entry = {"message": client_request, "term": self.current_term}
-        self.log.append_entries(self.log.last_log_index, [new_entry])
-        logging.info(f'{self} append new entry to local log from client request: {client_request}')
-        return {'success': True}
+        term = self.current_term
+        new_entry = {"command": client_request, "term": term}
+        index = self.group_commit.propose(new_entry, lambda: self.leading(term))
+        if index is None:
+            client_log.info('entry not appended', node=self, term=term)
+            return {'success': False}
+        client_log.debug('entry appended', node=self, index=index, command=client_request)
+        return {'success': True, 'index': index, 'term': term}
+
+    def leading(self, term):
+        '''
+        Only Leader appends client entries, see Leader.leading()
+        '''
+        return False
     
+    def read_index(self, timeout):
+        '''
+        Only Leader serves linearizable reads, see Leader.read_index()
+        '''
+        return None
+
+    def lease_read_index(self):
+        '''
+        Only Leader holds a lease, see Leader.lease_read_index()
+        '''
+        return None
+
     def fetch_MQ(self):
         '''
-        Me as Leader node reacting to client's request, fetching latest commited MQ
-        MQ info saved in self.log
+        Me as Leader node reacting to client's request, fetching latest applied MQ
+        The MQ is kept in memory by the apply loop, nothing is rebuilt or parsed here
         '''
-        return self.log.get_log_message(self.commit_index - 1)
-    
+        return self.mq
+
     def append_entries(self, append_entries_request):
         leader_term = append_entries_request['term']
         leader_prev_log_index = append_entries_request['prev_log_index']
@@ -149,34 +168,103 @@ class NodeState:
         leader_entries = append_entries_request['entries']
         leader_commit_index = append_entries_request['leader_commit']
 
+        with self.log.lock: # the log is checked and changed as one step, while the write waits for the disk
+            # All Servers Rule 2
+            if leader_term > self.current_term:
+                self.current_term = leader_term
+                self.vote_for = None
+                self.save()
+
+            if leader_term < self.current_term:
+                replication_log.info('append entries rejected: stale term', node=self, leader_term=leader_term)
+                return AppendEntriesResult(success=False, term=self.current_term, id=self.id)
+
+            last_new_index = leader_prev_log_index + 1 + len(leader_entries)
+            payloads = append_entries_request.get('payloads')
+            if leader_prev_log_index < self.log.snapshot_index:
+                # entries up to snapshot_index are committed, hence match Leader's: only check and append the rest
+                skip = min(len(leader_entries), self.log.snapshot_index - leader_prev_log_index)
+                leader_entries = leader_entries[skip:]
+                payloads = payloads[skip:] if payloads is not None else None
+                leader_prev_log_index = self.log.snapshot_index
+                leader_prev_log_term = self.log.snapshot_term
+
+            result = AppendEntriesResult(success=False, term=self.current_term, id=self.id)
+            # Append Entries Rule 2: heartbeats are checked for consistency as well
+            if leader_prev_log_term != self.log.get_log_term(leader_prev_log_index):
+                replication_log.debug('append entries rejected: log mismatch', node=self, prev_log_index=leader_prev_log_index)
+                if leader_prev_log_index > self.log.last_log_index:
+                    result = result._replace(conflict_index=self.log.last_log_index + 1)
+                else:
+                    result = result._replace(
+                        conflict_term=self.log.get_log_term(leader_prev_log_index),
+                        conflict_index=self.log.get_first_index_of_term(leader_prev_log_index)
+                    )
+                self.log.delete_entries(leader_prev_log_index)
+                return result
+
+            if not leader_entries:
+                replication_log.sampled(logging.DEBUG, 'heartbeat accepted', node=self)
+            else:
+                replication_log.debug('append entries accepted', node=self, entries=len(leader_entries))
+                self.log.append_entries(leader_prev_log_index, leader_entries, payloads)
+            result = result._replace(success=True)
+
+            # Append Entries Rule 5: reset Follower's commit index, up to the last entry known to match Leader's log
+            if leader_commit_index > self.commit_index:
+                self.commit_index = max(self.commit_index, min(leader_commit_index, last_new_index))
+                replication_log.debug('committed', node=self, commit_index=self.commit_index)
+
+            return result
+
+    def install_snapshot(self, install_snapshot_request):
+        '''
+        Me as Follower receiving a chunk of Leader's snapshot
+        Args:
+            install snapshot request from Leader:
+                - term
+                - leader_id
+                - last_included_index
+                - last_included_term
+                - offset: position of the chunk in the snapshot file
+                - done: True for the last chunk
+                - data: chunk
+        Rules:
+            1. False if leader_term < current_term
+            2. Write the chunk at offset; once done, replace the snapshot and drop the log entries it covers
+               (the whole log unless it holds the last included entry)
+        '''
+        leader_term = install_snapshot_request['term']
+        last_included_index = install_snapshot_request['last_included_index']
+
         # All Servers Rule 2
         if leader_term > self.current_term:
             self.current_term = leader_term
+            self.vote_for = None
             self.save()
 
         if leader_term < self.current_term:
-            logging.info(f'{self} rejects append entries request as Leader term: {leader_term} < {self.current_term}')
-            return AppendEntriesResult(success=False, term=self.current_term, id=self.id)
-        
-        result = AppendEntriesResult(success=False, term=self.current_term, id=self.id)
-        if not leader_entries:
-            logging.info('heartbeat')
-            result = result._replace(success=True)
-        else:
-            if leader_prev_log_term != self.log.get_log_term(leader_prev_log_index):
-                logging.info(f'{self} rejects append entries request as index not match or term not match')
-                self.log.delete_entries(leader_prev_log_index)
-            else:
-                logging.info(f'{self} accepts append entries request')
-                self.log.append_entries(leader_prev_log_index, leader_entries)
-                result = result._replace(success=True)
-        
-        # Append Entries Rule 5: reset Follower's commit index
-        if leader_commit_index > self.commit_index:
-            self.commit_index = min(leader_commit_index, self.log.last_log_index)
-            logging.info(f'{self} commits, commit index: {self.commit_index}')
-        
-        return result
+            snapshot_log.info('install snapshot rejected: stale term', node=self, leader_term=leader_term)
+            return InstallSnapshotResult(success=False, term=self.current_term, id=self.id)
+
+        if last_included_index < self.last_applied_index:
+            # already applied, hence in my own snapshot or log
+            return InstallSnapshotResult(success=True, term=self.current_term, id=self.id)
+
+        if not self.snapshot.write_chunk(install_snapshot_request['offset'], install_snapshot_request['data']):
+            snapshot_log.info('snapshot chunk rejected', node=self, offset=install_snapshot_request['offset'])
+            return InstallSnapshotResult(success=False, term=self.current_term, id=self.id)
+
+        if install_snapshot_request['done']:
+            self.snapshot.install()
+            self.compact_log()
+            with self.commit_cond:
+                self.mq = MessageQueue.from_dict(self.snapshot.mq)
+                self.last_applied_index = last_included_index + 1
+                self.commit_index = max(self.commit_index, last_included_index + 1)
+            snapshot_log.info('snapshot installed', node=self, index=last_included_index)
+
+        return InstallSnapshotResult(success=True, term=self.current_term, id=self.id)
         
 
 
@@ -0,0 +1,104 @@
+import os
+import json
+
+
+class Snapshot:
+    '''
+    Snapshot of the MQ as of a committed log index, stored as one JSON file:
+        {"last_included_index": <int>, "last_included_term": <int>, "mq": {<topic>: [<message>, ...]}}
+    Entries up to last_included_index can then be compacted out of the log.
+    The file is shipped to lagging followers as it is, in chunks (InstallSnapshot RPC)
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.last_included_index = -1 # no snapshot yet
+        self.last_included_term = -1
+        self.data = b'' # encoded snapshot file
+        self.mq = {}
+        self.received = 0 # size of the snapshot being received from Leader
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename, 'rb') as f:
+            self.data = f.read()
+        snapshot = json.loads(self.data)
+        self.last_included_index = snapshot['last_included_index']
+        self.last_included_term = snapshot['last_included_term']
+        self.mq = snapshot['mq']
+
+    def save(self, last_included_index, last_included_term, mq):
+        '''
+        Replace the snapshot, atomically
+        Args:
+            mq: dict. topic -> list of messages, see MessageQueue.to_dict()
+        '''
+        data = self.prepare(last_included_index, last_included_term, mq)
+        self.commit(data, last_included_index, last_included_term, mq)
+
+    def prepare(self, last_included_index, last_included_term, mq):
+        '''
+        First half of save(): encode the snapshot and make it durable next to the current one, which is left in place
+        Touches no attribute, so that it can run on a worker thread (see NodeCore.take_snapshot())
+        Return:
+            encoded snapshot, to commit()
+        '''
+        data = json.dumps({
+            'last_included_index': last_included_index,
+            'last_included_term': last_included_term,
+            'mq': mq
+        }, separators=(',', ':')).encode()
+        write_file(self.filename + '.new', data)
+        return data
+
+    def commit(self, data, last_included_index, last_included_term, mq):
+        '''
+        Second half of save(): replace the snapshot with the prepared one
+        '''
+        os.replace(self.filename + '.new', self.filename)
+        self.data = data
+        self.last_included_index = last_included_index
+        self.last_included_term = last_included_term
+        self.mq = mq
+
+    def write_chunk(self, offset, chunk):
+        '''
+        Me as Follower receiving a snapshot chunk from Leader, chunks arrive in order
+        Return:
+            False if the chunk does not follow the received ones (Leader restarts from offset 0)
+        '''
+        part_filename = self.filename + '.part'
+        if offset == 0:
+            self.received = 0
+            open(part_filename, 'wb').close()
+        if offset != self.received:
+            return False
+        with open(part_filename, 'ab') as f:
+            f.write(chunk)
+        self.received += len(chunk)
+        return True
+
+    def install(self):
+        '''
+        Me as Follower replacing my snapshot with the one fully received from Leader
+        '''
+        part_filename = self.filename + '.part'
+        with open(part_filename, 'rb') as f:
+            data = f.read()
+        os.remove(part_filename)
+        self.received = 0
+        self.write(data)
+
+    def write(self, data):
+        tmp_filename = self.filename + '.tmp'
+        write_file(tmp_filename, data)
+        os.replace(tmp_filename, self.filename)
+        self.load()
+
+
+def write_file(filename, data):
+    with open(filename, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
@@ -1,22 +1,124 @@
+import time
 import requests
 from urllib3.util.retry import Retry
 from requests.adapters import HTTPAdapter
+from . import codec
+from .cluster import PEER_POOL_MAXSIZE, BACKOFF_MIN, BACKOFF_MAX
 
 class Client:
-    def __init__(self, retry=0):
+    def __init__(self, retry=0, pool_maxsize=PEER_POOL_MAXSIZE):
         self.session = None
         self.retry = retry
-    
+        self.pool_maxsize = pool_maxsize
+        self.failures = 0 # consecutive failed requests
+        self.retry_at = 0 # when the peer may be contacted again after a failure
+
     def __enter__(self):
-        self.session = requests.Session()
-        retries = Retry(
-            total=self.retry,
-            backoff_factor=0.1,
-            status_forcelist=[404]
-        )
-        self.session.mount('http://', HTTPAdapter(max_retries=retries))
-        return self.session
-    
+        return self.connect()
+
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.session.close()
-        self.session = None
\ No newline at end of file
+        self.close()
+
+    def connect(self):
+        '''
+        Keep-alive session whose connection pool holds at most pool_maxsize connections,
+        extra requests wait for a free connection
+        '''
+        if self.session is None:
+            self.session = requests.Session()
+            retries = Retry(
+                total=self.retry,
+                backoff_factor=0.1,
+                status_forcelist=[404]
+            )
+            self.session.mount('http://', HTTPAdapter(max_retries=retries, pool_connections=1, pool_maxsize=self.pool_maxsize, pool_block=True))
+        return self.session
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+    def post(self, url, timeout, **kwargs):
+        '''
+        POST over the kept-alive connections
+        On failure, back off exponentially. Only the failed connection is dropped (urllib3 does not return it to the pool):
+        the other requests in flight to the peer, pipelined or of other Raft groups, keep their connections
+        '''
+        try:
+            response = self.connect().post(url, timeout=timeout, **kwargs)
+        except requests.exceptions.RequestException:
+            self.failures += 1
+            self.retry_at = time.monotonic() + min(BACKOFF_MAX, BACKOFF_MIN * 2 ** (self.failures - 1))
+            raise
+        self.failures = 0
+        return response
+
+    @property
+    def backoff(self):
+        '''
+        Seconds left before the peer may be contacted again
+        '''
+        return max(0, self.retry_at - time.monotonic())
+
+
+class Peers:
+    '''
+    Long-lived connections from this node to every other node of the cluster, one Client per peer
+    Owned by the node for its lifetime, shared by every role it takes and by every Raft group it hosts
+    '''
+    def __init__(self, peers, retry=0, pool_maxsize=PEER_POOL_MAXSIZE):
+        self.clients = {peer.id: Client(retry, pool_maxsize) for peer in peers}
+
+    def __getitem__(self, peer_id):
+        return self.clients[peer_id]
+
+    def close(self):
+        for client in self.clients.values():
+            client.close()
+
+
+class Transport:
+    '''
+    How the roles of a Raft group send their RPCs (vote, heartbeat, snapshot, timeout_now) to the other nodes:
+    HttpTransport between node processes, raft.simulation.SimTransport in a simulation
+    '''
+    def call(self, peer, rpc, data, timeout):
+        '''
+        Send an encoded RPC request to peer and wait for its encoded response
+        Args:
+            peer: Node
+            rpc: str. vote, heartbeat, snapshot or timeout_now
+            data: bytes. see codec
+            timeout: seconds
+        Return:
+            bytes, None if peer does not answer within timeout
+        '''
+        raise NotImplementedError
+
+    def backoff(self, peer):
+        '''
+        Seconds to wait before contacting peer again after it failed to answer
+        '''
+        return 0
+
+
+class HttpTransport(Transport):
+    '''
+    RPCs of one Raft group POSTed to /raft/<group>/<rpc> of the peers, over the node's long-lived connections
+    '''
+    def __init__(self, peers, group=0):
+        self.peers = peers # Peers, shared by the groups of the node
+        self.group = group
+
+    def call(self, peer, rpc, data, timeout):
+        try:
+            response = self.peers[peer.id].post(
+                f'{peer.uri}/raft/{self.group}/{rpc}', data=data, headers={'Content-Type': codec.MIMETYPE}, timeout=timeout
+            )
+        except requests.exceptions.RequestException:
+            return None
+        return response.content
+
+    def backoff(self, peer):
+        return self.peers[peer.id].backoff
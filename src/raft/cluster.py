@@ -1,16 +1,71 @@
 import collections
+import zlib
 
 Node = collections.namedtuple('Node', ['id', 'uri'])
 
 # NOTE: HEARTBEAT_INTERVAL << min(ELECTION_TIMEOUT)
 TIMEOUT_SCALER = .001
 ELECTION_TIMEOUT_MAX = 300
+ELECTION_TIMEOUT_MIN = float(ELECTION_TIMEOUT_MAX/2) * TIMEOUT_SCALER
 HEARTBEAT_INTERVAL = float(ELECTION_TIMEOUT_MAX/4) * TIMEOUT_SCALER
 
-class Cluster:
+# Max number of AppendEntries requests in flight per follower
+PIPELINE_WINDOW = 4
+
+# Peer connections: pool size per peer, and back-off bounds (seconds) after a failed request
+PEER_POOL_MAXSIZE = PIPELINE_WINDOW + 1
+BACKOFF_MIN = 10 * TIMEOUT_SCALER
+BACKOFF_MAX = HEARTBEAT_INTERVAL
+
+# Max number of entries, and of encoded bytes, shipped by one AppendEntries request
+MAX_APPEND_ENTRIES = 64
+MAX_APPEND_BYTES = 256 * 1024
+
+# Group commit: client proposals arriving within GROUP_COMMIT_MAX_DELAY seconds share one log write and fsync
+GROUP_COMMIT_MAX_DELAY = 2 * TIMEOUT_SCALER
+GROUP_COMMIT_MAX_BATCH = 64
+
+# Snapshot the MQ and compact the log once SNAPSHOT_THRESHOLD committed entries follow the last snapshot
+# Snapshots are shipped to lagging followers in chunks of SNAPSHOT_CHUNK_SIZE bytes
+SNAPSHOT_THRESHOLD = 1000
+SNAPSHOT_CHUNK_SIZE = 64 * 1024
+
+# Lease reads: Leader serves reads locally for LEASE_DURATION seconds after a majority acknowledged a heartbeat sent at time t.
+# Followers do not elect another Leader before their election timeout, at least ELECTION_TIMEOUT_MIN after that heartbeat,
+# shortened by CLOCK_DRIFT_MARGIN to cover clocks running at different rates
+CLOCK_DRIFT_MARGIN = .1
+LEASE_DURATION = ELECTION_TIMEOUT_MIN * (1 - CLOCK_DRIFT_MARGIN)
 
-    def __init__(self, addrs):
+# Results of applied entries are kept for the last APPLY_RESULTS_MAX entries, until the waiting client picks them up
+APPLY_RESULTS_MAX = 4096
+
+# Client requests fail if their entry is not committed within COMMIT_TIMEOUT seconds
+COMMIT_TIMEOUT = float(ELECTION_TIMEOUT_MAX * 3) * TIMEOUT_SCALER
+
+# Multi-Raft: a client request forwarded to the Leader of its topic's group fails after FORWARD_TIMEOUT seconds
+FORWARD_TIMEOUT = 3 * COMMIT_TIMEOUT
+
+class Cluster:
+    '''
+    Nodes of the cluster, and the Raft groups they host (Multi-Raft)
+    Topics are hash-partitioned across groups; each group is replicated on every node,
+    with its own log, term state and Leader
+    '''
+    def __init__(self, addrs, num_groups=1):
         self._nodes = [Node(id, f"http://{uri['ip']}:{uri['port']}") for id, uri in enumerate(addrs, start=0)]
+        self.groups = list(range(num_groups)) # group ids
+    
+    def group_of(self, topic):
+        '''
+        Raft group a topic belongs to, the same on every node (unlike hash(), crc32 is not salted per process)
+        '''
+        return zlib.crc32(topic.encode()) % len(self.groups)
+
+    def preferred_leader(self, group):
+        '''
+        Node that should lead the group, so that the Leaders of the groups are spread across nodes
+        '''
+        return self._nodes[group % len(self._nodes)]
     
     def __len__(self):
         return len(self._nodes)
@@ -0,0 +1,160 @@
+import json
+import struct
+import zlib
+from .Log import RECORD_HEADER
+from .NodeState import VoteResult, AppendEntriesResult, InstallSnapshotResult
+
+# Binary wire format of the internal Raft RPCs (POST /raft/<group>/vote, /raft/<group>/heartbeat, /raft/<group>/snapshot, /raft/<group>/timeout_now)
+# Every message starts with [version: uint8][message type: uint8], followed by a packed, fixed-size header.
+# AppendEntries carries its entries as raw WAL records ([length][crc32][payload]) read straight from Leader's log file,
+# and Follower writes the payloads to its own log as they are, so entries are not re-encoded on the way.
+
+WIRE_VERSION = 1
+MIMETYPE = 'application/octet-stream'
+
+VOTE_REQUEST = 1
+VOTE_RESULT = 2
+APPEND_ENTRIES_REQUEST = 3
+APPEND_ENTRIES_RESULT = 4
+INSTALL_SNAPSHOT_REQUEST = 5
+INSTALL_SNAPSHOT_RESULT = 6
+TIMEOUT_NOW_REQUEST = 7
+
+# version, type, term, candidate_id, last_log_index, last_log_term, leadership_transfer
+VOTE_REQUEST_FORMAT = struct.Struct('>BBqqqq?')
+# version, type, vote_granted, term, id
+VOTE_RESULT_FORMAT = struct.Struct('>BB?qq')
+# version, type, term, leader_id, prev_log_index, prev_log_term, leader_commit, number of entries
+APPEND_ENTRIES_REQUEST_FORMAT = struct.Struct('>BBqqqqqI')
+# version, type, success, term, id, conflict_term, conflict_index
+APPEND_ENTRIES_RESULT_FORMAT = struct.Struct('>BB?qqqq')
+# version, type, term, leader_id, last_included_index, last_included_term, offset, done, followed by the chunk
+INSTALL_SNAPSHOT_REQUEST_FORMAT = struct.Struct('>BBqqqqQ?')
+# version, type, success, term, id
+INSTALL_SNAPSHOT_RESULT_FORMAT = struct.Struct('>BB?qq')
+# version, type, term, leader_id
+TIMEOUT_NOW_REQUEST_FORMAT = struct.Struct('>BBqq')
+
+
+def encode_vote_request(vote_request):
+    return VOTE_REQUEST_FORMAT.pack(
+        WIRE_VERSION, VOTE_REQUEST,
+        vote_request.term, vote_request.candidate_id, vote_request.last_log_index, vote_request.last_log_term,
+        vote_request.leadership_transfer
+    )
+
+def decode_vote_request(data):
+    _, _, term, candidate_id, last_log_index, last_log_term, leadership_transfer = unpack(VOTE_REQUEST_FORMAT, VOTE_REQUEST, data)
+    return {
+        'term': term,
+        'candidate_id': candidate_id,
+        'last_log_index': last_log_index,
+        'last_log_term': last_log_term,
+        'leadership_transfer': leadership_transfer
+    }
+
+
+def encode_vote_result(vote_result):
+    return VOTE_RESULT_FORMAT.pack(WIRE_VERSION, VOTE_RESULT, *vote_result)
+
+def decode_vote_result(data):
+    return VoteResult(*unpack(VOTE_RESULT_FORMAT, VOTE_RESULT, data)[2:])
+
+
+def encode_append_entries_request(append_entries_request):
+    header = APPEND_ENTRIES_REQUEST_FORMAT.pack(
+        WIRE_VERSION, APPEND_ENTRIES_REQUEST,
+        append_entries_request.term, append_entries_request.leader_id,
+        append_entries_request.prev_log_index, append_entries_request.prev_log_term,
+        append_entries_request.leader_commit, len(append_entries_request.entries)
+    )
+    return header + append_entries_request.records
+
+def decode_append_entries_request(data):
+    '''
+    Return:
+        dict of the request fields, 'payloads' holds the encoded entries, ready to be written to Follower's log
+    '''
+    _, _, term, leader_id, prev_log_index, prev_log_term, leader_commit, count = unpack(APPEND_ENTRIES_REQUEST_FORMAT, APPEND_ENTRIES_REQUEST, data)
+    payloads = decode_records(data, APPEND_ENTRIES_REQUEST_FORMAT.size, count)
+    return {
+        'term': term,
+        'leader_id': leader_id,
+        'prev_log_index': prev_log_index,
+        'prev_log_term': prev_log_term,
+        'leader_commit': leader_commit,
+        'entries': [json.loads(payload) for payload in payloads],
+        'payloads': payloads
+    }
+
+
+def encode_append_entries_result(append_entries_result):
+    return APPEND_ENTRIES_RESULT_FORMAT.pack(WIRE_VERSION, APPEND_ENTRIES_RESULT, *append_entries_result)
+
+def decode_append_entries_result(data):
+    return AppendEntriesResult(*unpack(APPEND_ENTRIES_RESULT_FORMAT, APPEND_ENTRIES_RESULT, data)[2:])
+
+
+def encode_install_snapshot_request(install_snapshot_request):
+    header = INSTALL_SNAPSHOT_REQUEST_FORMAT.pack(
+        WIRE_VERSION, INSTALL_SNAPSHOT_REQUEST,
+        install_snapshot_request.term, install_snapshot_request.leader_id,
+        install_snapshot_request.last_included_index, install_snapshot_request.last_included_term,
+        install_snapshot_request.offset, install_snapshot_request.done
+    )
+    return header + install_snapshot_request.data
+
+def decode_install_snapshot_request(data):
+    _, _, term, leader_id, last_included_index, last_included_term, offset, done = unpack(INSTALL_SNAPSHOT_REQUEST_FORMAT, INSTALL_SNAPSHOT_REQUEST, data)
+    return {
+        'term': term,
+        'leader_id': leader_id,
+        'last_included_index': last_included_index,
+        'last_included_term': last_included_term,
+        'offset': offset,
+        'done': done,
+        'data': data[INSTALL_SNAPSHOT_REQUEST_FORMAT.size:]
+    }
+
+
+def encode_install_snapshot_result(install_snapshot_result):
+    return INSTALL_SNAPSHOT_RESULT_FORMAT.pack(WIRE_VERSION, INSTALL_SNAPSHOT_RESULT, *install_snapshot_result)
+
+def decode_install_snapshot_result(data):
+    return InstallSnapshotResult(*unpack(INSTALL_SNAPSHOT_RESULT_FORMAT, INSTALL_SNAPSHOT_RESULT, data)[2:])
+
+
+def encode_timeout_now_request(term, leader_id):
+    return TIMEOUT_NOW_REQUEST_FORMAT.pack(WIRE_VERSION, TIMEOUT_NOW_REQUEST, term, leader_id)
+
+def decode_timeout_now_request(data):
+    _, _, term, leader_id = unpack(TIMEOUT_NOW_REQUEST_FORMAT, TIMEOUT_NOW_REQUEST, data)
+    return {'term': term, 'leader_id': leader_id}
+
+
+def unpack(message_format, message_type, data):
+    if len(data) < message_format.size:
+        raise ValueError(f'Truncated message: {len(data)} bytes')
+    fields = message_format.unpack_from(data)
+    if fields[0] != WIRE_VERSION:
+        raise ValueError(f'Unsupported wire version: {fields[0]}')
+    if fields[1] != message_type:
+        raise ValueError(f'Unexpected message type: {fields[1]} != {message_type}')
+    return fields
+
+def decode_records(data, offset, count):
+    '''
+    Split raw WAL records into their payloads, checking each checksum
+    '''
+    payloads = []
+    for _ in range(count):
+        if offset + RECORD_HEADER.size > len(data):
+            raise ValueError('Truncated record header')
+        length, checksum = RECORD_HEADER.unpack_from(data, offset)
+        offset += RECORD_HEADER.size
+        payload = data[offset:offset + length]
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            raise ValueError('Corrupt record')
+        payloads.append(payload)
+        offset += length
+    return payloads
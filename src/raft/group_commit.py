@@ -0,0 +1,71 @@
+from .cluster import GROUP_COMMIT_MAX_DELAY, GROUP_COMMIT_MAX_BATCH, COMMIT_TIMEOUT
+
+
+class GroupCommit:
+    '''
+    Group commit stage in front of the Log
+    Client proposals that arrive within max_batch_delay seconds (or until max_batch_size is reached)
+    are appended to the log with a single write and made durable with a single fsync,
+    then all the waiting callers are released together.
+    The first proposer of a batch leads it: it waits for companions, flushes the batch and wakes the others up
+    '''
+    def __init__(self, log, runtime, max_batch_delay=GROUP_COMMIT_MAX_DELAY, max_batch_size=GROUP_COMMIT_MAX_BATCH, flush_timeout=COMMIT_TIMEOUT):
+        self.log = log
+        self.max_batch_delay = max_batch_delay
+        self.max_batch_size = max_batch_size
+        self.flush_timeout = flush_timeout # companions give up on a batch whose leader is stuck writing
+        self.cond = runtime.Condition()
+        self.batch = _Batch()
+
+    def propose(self, entry, leading):
+        '''
+        Append entry to the log as part of the current batch, return once it is durable
+        A batch only holds entries of one term. Its leader checks leading() right before the write,
+        so that nothing is appended once the proposer stepped down: the log may already hold the next Leader's entries
+        Args:
+            entry: dict. log entry, with the term it is proposed in
+            leading: callable. True while the proposer is still Leader in entry's term
+        Return:
+            log index of entry, None if the batch was not appended (proposer no longer Leader, or the write failed)
+        '''
+        with self.cond:
+            batch = self.batch
+            if len(batch.entries) >= self.max_batch_size or (batch.entries and batch.term != entry['term']):
+                batch = self.batch = _Batch() # current batch is full, or of another term, and about to be flushed
+            if not batch.entries:
+                batch.term = entry['term']
+            position = len(batch.entries)
+            batch.entries.append(entry)
+
+            if position > 0:
+                if len(batch.entries) >= self.max_batch_size:
+                    self.cond.notify_all() # batch full: wake its leader up early
+                self.cond.wait_for(lambda: batch.flushed, timeout=self.flush_timeout)
+                return None if batch.first_index is None else batch.first_index + position
+
+            self.cond.wait_for(lambda: len(batch.entries) >= self.max_batch_size, timeout=self.max_batch_delay)
+
+        # self.cond is not held while writing: proposers keep joining the batch until the previous one is written,
+        # then the next one
+        try:
+            with self.log.lock:
+                with self.cond:
+                    if self.batch is batch:
+                        self.batch = _Batch() # later proposers join the next batch
+                if leading():
+                    first_index = self.log.last_log_index + 1
+                    self.log.append_entries(first_index - 1, batch.entries)
+                    batch.first_index = first_index
+        finally:
+            with self.cond:
+                batch.flushed = True # also on failure, companions must not wait forever
+                self.cond.notify_all()
+        return batch.first_index
+
+
+class _Batch:
+    def __init__(self):
+        self.entries = []
+        self.term = None
+        self.first_index = None # set once appended
+        self.flushed = False
@@ -0,0 +1,103 @@
+import logging
+import itertools
+
+logging.basicConfig(format='%(asctime)s-%(levelname)s: %(message)s', datefmt='%H:%M:%S', level=logging.INFO)
+
+# Subsystems, each with its own logger 'raft.<subsystem>' and level
+ELECTION = 'election' # timers, votes and role changes
+REPLICATION = 'replication' # AppendEntries, heartbeats and commits
+SNAPSHOT = 'snapshot' # snapshots, compaction and InstallSnapshot
+CLIENT = 'client' # client requests and reads
+SUBSYSTEMS = [ELECTION, REPLICATION, SNAPSHOT, CLIENT]
+
+# Defaults of the 'logging' section of config.json, see configure()
+DEFAULT_LEVEL = 'INFO'
+SAMPLE_EVERY = 100 # heartbeat-frequency events: emit 1 in SAMPLE_EVERY
+MAX_FIELD_LENGTH = 200 # characters of a field value, longer ones are truncated
+
+_loggers = {}
+
+
+class Event:
+    '''
+    Log message: event name and key=value fields
+    Formatted only if a handler emits the record, so a disabled or dropped event costs no formatting
+    '''
+    def __init__(self, name, fields, max_length):
+        self.name = name
+        self.fields = fields
+        self.max_length = max_length
+
+    def __str__(self):
+        return ' '.join([self.name] + [f'{key}={truncate(value, self.max_length)}' for key, value in self.fields.items()])
+
+
+def truncate(value, max_length):
+    text = str(value)
+    if len(text) <= max_length:
+        return text
+    return f'{text[:max_length]}...({len(text)} chars)'
+
+
+class StructuredLogger:
+    '''
+    Logger of one subsystem
+        log.info('vote granted', node=self, candidate=candidate_id)
+    Fields are passed as objects, not pre-formatted strings: nothing is formatted below the subsystem's level
+    '''
+    def __init__(self, subsystem):
+        self.logger = logging.getLogger(f'raft.{subsystem}')
+        self.sample_every = SAMPLE_EVERY
+        self.max_field_length = MAX_FIELD_LENGTH
+        self.counters = {} # event name -> count of sampled events seen, see sampled()
+
+    def log(self, level, event, **fields):
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, '%s', Event(event, fields, self.max_field_length))
+
+    def debug(self, event, **fields):
+        self.log(logging.DEBUG, event, **fields)
+
+    def info(self, event, **fields):
+        self.log(logging.INFO, event, **fields)
+
+    def warning(self, event, **fields):
+        self.log(logging.WARNING, event, **fields)
+
+    def sampled(self, level, event, **fields):
+        '''
+        Heartbeat-frequency event: only 1 in sample_every of them is emitted, with the count of events it stands for
+        '''
+        if not self.logger.isEnabledFor(level):
+            return
+        counter = self.counters.get(event)
+        if counter is None:
+            counter = self.counters[event] = itertools.count()
+        if next(counter) % self.sample_every == 0:
+            self.logger.log(level, '%s', Event(event, dict(fields, sampled=self.sample_every), self.max_field_length))
+
+
+def get_logger(subsystem):
+    '''
+    Return: the StructuredLogger of the subsystem, shared by the modules logging for it
+    '''
+    if subsystem not in _loggers:
+        _loggers[subsystem] = StructuredLogger(subsystem)
+    return _loggers[subsystem]
+
+
+def configure(options):
+    '''
+    Apply the 'logging' section of config.json, e.g.
+        {"level": "INFO", "levels": {"replication": "DEBUG"}, "sample_every": 100, "max_field_length": 200}
+    Args:
+        options: dict. level: every subsystem's level; levels: per subsystem overrides;
+            sample_every: see StructuredLogger.sampled(); max_field_length: see truncate()
+    '''
+    level = options.get('level', DEFAULT_LEVEL)
+    levels = options.get('levels', {})
+    for subsystem in SUBSYSTEMS:
+        log = get_logger(subsystem)
+        log.logger.setLevel(levels.get(subsystem, level))
+        log.sample_every = max(1, options.get('sample_every', SAMPLE_EVERY))
+        log.max_field_length = options.get('max_field_length', MAX_FIELD_LENGTH)
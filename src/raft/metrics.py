@@ -0,0 +1,159 @@
+import bisect
+import time
+
+# Bucket upper bounds (seconds) of the latency histograms
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5.)
+
+class Registry:
+    '''
+    Metrics rendered together, in the order they were created
+    '''
+    def __init__(self):
+        self.metrics = []
+
+    def render(self):
+        '''
+        Return: every metric in the Prometheus text exposition format (version 0.0.4)
+        '''
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+_registry = Registry() # metrics of the node, see render()
+
+class Metric:
+    '''
+    Metric exposed in the Prometheus text format, one sample (or histogram) per combination of label values
+    '''
+    type = None
+
+    def __init__(self, name, help, labels=(), registry=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {} # tuple of label values -> value
+        (_registry if registry is None else registry).metrics.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def clear(self):
+        self.values.clear()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        for key, value in sorted(self.values.items()):
+            lines += self.render_samples(dict(zip(self.labels, key)), value)
+        return lines
+
+    def render_samples(self, labels, value):
+        return [f'{self.name}{format_labels(labels)} {format_value(value)}']
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS, registry=None):
+        super(Histogram, self).__init__(name, help, labels, registry)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        if key not in self.values:
+            self.values[key] = _HistogramValue(len(self.buckets))
+        self.values[key].observe(bisect.bisect_left(self.buckets, value), value)
+
+    def time(self, **labels):
+        '''
+        Context manager observing the duration of its block
+        '''
+        return _Timer(self, labels)
+
+    def render_samples(self, labels, value):
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), value.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{format_labels(dict(labels, le=format_value(bound)))} {cumulative}')
+        lines.append(f'{self.name}_sum{format_labels(labels)} {format_value(value.sum)}')
+        lines.append(f'{self.name}_count{format_labels(labels)} {cumulative}')
+        return lines
+
+
+class _HistogramValue:
+    def __init__(self, num_buckets):
+        self.counts = [0] * (num_buckets + 1) # per bucket (not cumulative), the last one is +Inf
+        self.sum = 0.
+
+    def observe(self, bucket, value):
+        self.counts[bucket] += 1
+        self.sum += value
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.monotonic() - self.start, **self.labels)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels.items()) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    '''
+    Return: every metric of the node in the Prometheus text exposition format (version 0.0.4)
+    '''
+    return _registry.render()
+
+
+## Metrics of the node
+COMMIT_LATENCY = Histogram(
+    'raft_commit_latency_seconds', 'Time from proposing a client command to Leader applying it', ('group',))
+APPEND_ENTRIES_RTT = Histogram(
+    'raft_append_entries_rtt_seconds', 'Round trip time of AppendEntries requests to a follower', ('group', 'follower'))
+FOLLOWER_LAG = Gauge(
+    'raft_follower_lag_entries', "Entries of Leader's log not known to be replicated on a follower (log length - match_index)",
+    ('group', 'follower'))
+LOG_SAVE_DURATION = Histogram(
+    'raft_log_save_seconds', 'Duration of writing and fsyncing log records (Log.sync)', ('group',))
+STATE_SAVE_DURATION = Histogram(
+    'raft_state_save_seconds', 'Duration of saving current_term and vote_for (NodeCore.save)', ('group',))
+ELECTIONS = Counter('raft_elections_total', 'Elections started by this node, by outcome', ('group', 'outcome'))
+ELECTION_DURATION = Histogram('raft_election_duration_seconds', 'Duration of elections started by this node', ('group',))
+TERM = Gauge('raft_term', 'Current term', ('group',))
+ROLE = Gauge('raft_is_leader', '1 if this node leads the group', ('group',))
+CLIENT_REQUESTS = Counter('raft_client_requests_total', 'Client requests, by endpoint and status code', ('method', 'endpoint', 'status'))
+CLIENT_REQUEST_DURATION = Histogram(
+    'raft_client_request_duration_seconds', 'Duration of client requests, by endpoint', ('method', 'endpoint'))
@@ -0,0 +1,48 @@
+import time
+import threading
+import gevent
+from gevent import monkey
+
+
+class Runtime:
+    '''
+    Time and concurrency primitives the Raft code runs on: the node's gevent event loop (threads are greenlets
+    once node.py monkey patches threading), or the deterministic event loop of a simulation (see raft.simulation.SimRuntime)
+    Roles, NodeCore and GroupCommit get them from here instead of the time and threading modules
+    '''
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def spawn(self, function, *args):
+        '''
+        Run function(*args) concurrently
+        Return:
+            handle whose join(timeout=None) waits for it to return
+        '''
+        thread = threading.Thread(target=function, args=args, daemon=True)
+        thread.start()
+        return thread
+
+    def run_blocking(self, function, *args):
+        '''
+        Run function(*args), which blocks on disk I/O or the CPU, without holding the other tasks up:
+        on a worker OS thread once threads are greenlets (a greenlet doing file I/O would block the whole event loop)
+        function must not touch state the other tasks use
+        Return:
+            function's result
+        '''
+        if monkey.is_module_patched('threading'):
+            return gevent.get_hub().threadpool.apply(function, args)
+        return function(*args)
+
+    def Condition(self):
+        return threading.Condition()
+
+    def Event(self):
+        return threading.Event()
+
+    def Semaphore(self, value):
+        return threading.BoundedSemaphore(value)
@@ -0,0 +1,652 @@
+'''
+Deterministic in-process simulation of a Raft group
+
+Many nodes run in one process, on virtual time, against a simulated network with configurable latency,
+loss and partitions. Nodes run the real code: TimerThread, Follower/Candidate/Leader, NodeCore (log, snapshot and MQ)
+and GroupCommit, exchanging the real encoded RPCs. Only the two things they are built on are swapped:
+    - the Runtime: SimRuntime runs every "thread" of every node as a greenlet of one event loop on virtual time,
+      switching between them only when they block (sleep, condition, semaphore, RPC), in a deterministic order
+    - the Transport: SimTransport carries the RPCs over SimNetwork instead of HTTP
+Clients go through TimerThread.client_append_entries() and TimerThread.read_MQ(), like node.py's routes.
+A run is a function of its seed, and takes milliseconds of real time per second of virtual time.
+
+    with SimCluster(5, seed=1) as sim:
+        sim.run_until(lambda: sim.leader() is not None, timeout=5)
+        sim.partition([0, 1], [2, 3, 4])
+        sim.propose({'op': 'create_topic', 'topic': 'topic'})
+        sim.run(2)
+        sim.check_safety()
+
+Benchmark/fuzz many scenarios, from src/:
+    > python -m raft.simulation --nodes 5 --scenarios 1000 --loss 0.05
+'''
+import os
+import sys
+import json
+import time
+import heapq
+import random
+import shutil
+import argparse
+import tempfile
+import itertools
+import collections
+import greenlet
+from . import codec
+from . import logger
+from .cluster import Cluster, HEARTBEAT_INTERVAL
+from .client import Transport
+from .runtime import Runtime
+from .NodeCore import NodeCore
+from .timer_thread import TimerThread
+from .MessageQueue import PUT_MESSAGE, CREATE_TOPIC
+
+# One-way network latency (seconds) drawn uniformly in [LATENCY_MIN, LATENCY_MAX]
+LATENCY_MIN = .5 * .001
+LATENCY_MAX = 2 * .001
+
+# Storage of the simulated nodes: in memory when the platform has a tmpfs, so that fsync costs nothing
+SHM_PATH = '/dev/shm'
+
+
+class SimRuntime(Runtime):
+    '''
+    Runtime on virtual time: callbacks scheduled at virtual times run one at a time, in time order (ties in scheduling order),
+    on the driver's greenlet. Tasks (what Runtime.spawn() runs) are greenlets, resumed by such callbacks: a task runs
+    until it blocks, then hands control back to the driver. Each task belongs to a SimProcess, the simulated node,
+    and crashing the process kills its tasks
+    '''
+    def __init__(self):
+        self.now = 0.
+        self.queue = [] # heap of (time, sequence number, callback, args)
+        self.sequence = itertools.count()
+        self.driver = greenlet.getcurrent() # runs the callbacks, and the test or scenario
+        self.current = None # SimTask running, None on the driver
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.park(self.wakeup(), seconds)
+
+    def spawn(self, function, *args):
+        return self.start(self.current.process, function, *args)
+
+    def run_blocking(self, function, *args):
+        return function(*args) # takes no virtual time
+
+    def Condition(self):
+        return SimCondition(self)
+
+    def Event(self):
+        return SimEvent(self)
+
+    def Semaphore(self, value):
+        return SimSemaphore(self, value)
+
+    def start(self, process, function, *args):
+        '''
+        Start a task of process, as soon as the driver gets control back
+        '''
+        task = SimTask(self, process, function, args)
+        if process.alive:
+            process.tasks[task] = None
+            self.schedule(0, self.resume, self.wakeup(task), None)
+        return task
+
+    def kill(self, process):
+        '''
+        Crash process: its tasks are interrupted where they block, and never resumed
+        '''
+        process.alive = False
+        for task in list(process.tasks):
+            self.current = task
+            try:
+                task.greenlet.throw(greenlet.GreenletExit) # unwinds the task, e.g. releases its semaphores
+            finally:
+                self.current = None
+        process.tasks.clear()
+
+    def wakeup(self, task=None):
+        return SimWakeup(task or self.current)
+
+    def park(self, wakeup, timeout=None, timeout_value=None):
+        '''
+        Block the running task until wakeup is resumed, or timeout expires
+        Return:
+            value wakeup is resumed with, timeout_value on timeout
+        '''
+        task = self.current
+        if task is None:
+            raise RuntimeError('Only a task can block, start one with SimRuntime.start()')
+        if not task.process.alive:
+            raise greenlet.GreenletExit
+        if timeout is not None:
+            self.schedule(max(timeout, 0), self.resume, wakeup, timeout_value)
+        return self.driver.switch()
+
+    def resume(self, wakeup, value):
+        '''
+        Resume the task blocked on wakeup, unless it was resumed already (e.g. notified before its timeout) or crashed
+        '''
+        if wakeup.done or not wakeup.task.process.alive:
+            return
+        wakeup.done = True
+        self.current = wakeup.task
+        try:
+            wakeup.task.greenlet.switch(value)
+        finally:
+            self.current = None
+
+    def schedule(self, delay, callback, *args):
+        self.schedule_at(self.now + delay, callback, *args)
+
+    def schedule_at(self, at, callback, *args):
+        heapq.heappush(self.queue, (max(at, self.now), next(self.sequence), callback, args))
+
+    def step(self):
+        '''
+        Run the next callback
+        Return:
+            False if there is none
+        '''
+        if not self.queue:
+            return False
+        self.now, _, callback, args = heapq.heappop(self.queue)
+        callback(*args)
+        return True
+
+    def run_until(self, deadline, predicate=None):
+        '''
+        Run the callbacks due up to deadline, or until predicate() holds
+        Return:
+            True if predicate() holds
+        '''
+        while self.queue and self.queue[0][0] <= deadline:
+            if predicate is not None and predicate():
+                return True
+            self.step()
+        if predicate is not None and predicate():
+            return True
+        self.now = max(self.now, deadline)
+        return False
+
+    def run(self, seconds):
+        self.run_until(self.now + seconds)
+
+
+class SimProcess:
+    def __init__(self):
+        self.alive = True
+        self.tasks = {} # SimTask -> None, running or blocked, in start order
+
+
+class SimTask:
+    def __init__(self, runtime, process, function, args):
+        self.process = process
+        self.greenlet = greenlet.greenlet(self.main, parent=runtime.driver)
+        self.function = function
+        self.args = args
+        self.finished = SimEvent(runtime)
+
+    def main(self, _):
+        try:
+            self.function(*self.args)
+        finally:
+            self.process.tasks.pop(self, None)
+            self.finished.set()
+
+    def join(self, timeout=None):
+        return self.finished.wait(timeout)
+
+
+class SimWakeup:
+    '''
+    One blocking of a task, resumed at most once
+    '''
+    __slots__ = ('task', 'done')
+
+    def __init__(self, task):
+        self.task = task
+        self.done = False
+
+
+class SimCondition:
+    '''
+    threading.Condition for tasks: as tasks only switch when they block, holding the lock is a no-op
+    '''
+    def __init__(self, runtime):
+        self.runtime = runtime
+        self.waiters = [] # SimWakeup, in wait order
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def wait(self, timeout=None):
+        wakeup = self.runtime.wakeup()
+        self.waiters.append(wakeup)
+        try:
+            return self.runtime.park(wakeup, timeout, False)
+        finally:
+            if wakeup in self.waiters: # timed out, or crashed
+                self.waiters.remove(wakeup)
+
+    def wait_for(self, predicate, timeout=None):
+        deadline = None if timeout is None else self.runtime.now + timeout
+        result = predicate()
+        while not result:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - self.runtime.now
+                if remaining <= 0:
+                    break
+            self.wait(remaining)
+            result = predicate()
+        return result
+
+    def notify(self, n=1):
+        woken, self.waiters = self.waiters[:n], self.waiters[n:]
+        for wakeup in woken:
+            self.runtime.schedule(0, self.runtime.resume, wakeup, True)
+
+    def notify_all(self):
+        self.notify(len(self.waiters))
+
+
+class SimEvent:
+    def __init__(self, runtime):
+        self.cond = SimCondition(runtime)
+        self.flag = False
+
+    def is_set(self):
+        return self.flag
+
+    def set(self):
+        self.flag = True
+        self.cond.notify_all()
+
+    def clear(self):
+        self.flag = False
+
+    def wait(self, timeout=None):
+        return self.cond.wait_for(lambda: self.flag, timeout)
+
+
+class SimSemaphore:
+    '''
+    threading.BoundedSemaphore for tasks
+    '''
+    def __init__(self, runtime, value):
+        self.cond = SimCondition(runtime)
+        self.initial_value = value
+        self.value = value
+
+    def acquire(self, blocking=True, timeout=None):
+        if not self.cond.wait_for(lambda: self.value > 0, timeout if blocking else 0):
+            return False
+        self.value -= 1
+        return True
+
+    def release(self):
+        if self.value >= self.initial_value:
+            raise ValueError('Semaphore released too many times')
+        self.value += 1
+        self.cond.notify()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class SimNetwork:
+    '''
+    Network between the simulated nodes, in place of HTTP between node processes
+    A request, and its response, is each delayed by a random latency and lost with probability loss
+    or when its ends are in different partitions. The caller gets no response (None) once its timeout expires,
+    like an HTTP client
+    '''
+    def __init__(self, runtime, rng, latency=(LATENCY_MIN, LATENCY_MAX), loss=0.):
+        self.runtime = runtime
+        self.rng = rng
+        self.latency = latency
+        self.loss = loss
+        self.nodes = {} # node id -> SimNode, for the nodes that are up
+        self.partitions = None # list of sets of node ids, None when the network is whole
+
+    def partition(self, *groups):
+        self.partitions = [set(group) for group in groups]
+
+    def heal(self):
+        self.partitions = None
+
+    def connected(self, src, dst):
+        return self.partitions is None or any(src in group and dst in group for group in self.partitions)
+
+    def transmits(self, src, dst):
+        return self.connected(src, dst) and self.rng.random() >= self.loss
+
+    def call(self, src, dst, rpc, data, timeout):
+        '''
+        RPC from a task of node src to node dst, see Transport.call()
+        '''
+        wakeup = self.runtime.wakeup()
+        if self.transmits(src, dst):
+            self.runtime.schedule(self.rng.uniform(*self.latency), self.deliver, src, dst, rpc, data, wakeup)
+        return self.runtime.park(wakeup, timeout)
+
+    def deliver(self, src, dst, rpc, data, wakeup):
+        node = self.nodes.get(dst)
+        if node is not None: # not crashed
+            self.runtime.start(node.process, self.serve, node, src, rpc, data, wakeup)
+
+    def serve(self, node, src, rpc, data, wakeup):
+        response = node.handle(rpc, data)
+        if self.transmits(node.node.id, src):
+            self.runtime.schedule(self.rng.uniform(*self.latency), self.runtime.resume, wakeup, response)
+
+
+class SimTransport(Transport):
+    '''
+    RPCs of a simulated node, over SimNetwork
+    '''
+    def __init__(self, network, node_id):
+        self.network = network
+        self.node_id = node_id
+
+    def call(self, peer, rpc, data, timeout):
+        return self.network.call(self.node_id, peer.id, rpc, data, timeout)
+
+
+class SimNode(TimerThread):
+    '''
+    Node of a simulated cluster: TimerThread over a NodeCore with SimTransport and SimRuntime,
+    whose timer loop and client requests run as tasks of its SimProcess
+    '''
+    def __init__(self, i, cluster, network, runtime, rng, storage_path, lease_reads=False):
+        core = NodeCore(cluster[i], cluster, SimTransport(network, i), storage_path=storage_path, runtime=runtime)
+        super(SimNode, self).__init__(i, cluster, lease_reads=lease_reads, core=core, rng=rng)
+        self.process = SimProcess()
+        self.elected_terms = [] # terms this node was elected Leader in
+
+    def start(self):
+        '''
+        Override Thread.start(): the timer loop runs as a task
+        '''
+        self.runtime.start(self.process, self.run)
+
+    def crash(self):
+        self.runtime.kill(self.process)
+
+    @property
+    def crashed(self):
+        return not self.process.alive
+
+    def become_leader(self):
+        self.elected_terms.append(self.core.current_term)
+        super(SimNode, self).become_leader()
+
+    def handle(self, rpc, data):
+        '''
+        Serve an RPC, like the /raft/<group>/<rpc> routes of node.py
+        Return:
+            encoded response
+        '''
+        if rpc == 'vote':
+            return codec.encode_vote_result(self.vote(codec.decode_vote_request(data)))
+        if rpc == 'heartbeat':
+            return codec.encode_append_entries_result(self.append_entries(codec.decode_append_entries_request(data)))
+        if rpc == 'snapshot':
+            return codec.encode_install_snapshot_result(self.install_snapshot(codec.decode_install_snapshot_request(data)))
+        if rpc == 'timeout_now':
+            self.timeout_now(codec.decode_timeout_now_request(data))
+            return b''
+        raise ValueError(f'Unknown RPC: {rpc}')
+
+
+class Operation:
+    '''
+    Client request of a simulation, as it was invoked and as it completed
+        - write: command, result is TimerThread.client_append_entries()'s
+        - read: result is the messages of topic, as read by TimerThread.read_MQ(), None if the read failed
+    '''
+    def __init__(self, kind, node_id, invoked_at, command=None, topic=None):
+        self.kind = kind
+        self.node_id = node_id
+        self.command = command
+        self.topic = topic
+        self.invoked_at = invoked_at
+        self.completed_at = None # None while in progress
+        self.result = None
+
+    def __repr__(self):
+        return f'{self.kind}({self.command or self.topic}) on {self.node_id} [{self.invoked_at}, {self.completed_at}] -> {self.result}'
+
+
+class SimCluster:
+    '''
+    Simulated cluster of num_nodes SimNodes sharing one SimRuntime and SimNetwork, seeded by seed
+    '''
+    def __init__(self, num_nodes, seed=0, latency=(LATENCY_MIN, LATENCY_MAX), loss=0., lease_reads=False, storage_path=None):
+        self.rng = random.Random(seed)
+        self.runtime = SimRuntime()
+        self.network = SimNetwork(self.runtime, random.Random(self.rng.random()), latency, loss)
+        self.cluster = Cluster([{"ip": "sim", "port": i} for i in range(num_nodes)])
+        self.lease_reads = lease_reads
+        self.storage_path = storage_path or tempfile.mkdtemp(prefix='raft-sim-', dir=SHM_PATH if os.path.isdir(SHM_PATH) else None)
+        self.instances = [] # every SimNode, including crashed ones, for check_safety()
+        self.history = [] # every client Operation, in invocation order
+        self.nodes = [self.boot(i) for i in range(num_nodes)]
+
+    def boot(self, i):
+        node = SimNode(i, self.cluster, self.network, self.runtime, random.Random(self.rng.random()), self.storage_path, self.lease_reads)
+        self.network.nodes[i] = node
+        self.instances.append(node)
+        node.start()
+        return node
+
+    def crash(self, i):
+        self.nodes[i].crash()
+        self.network.nodes.pop(i, None)
+
+    def restart(self, i):
+        '''
+        Crash node i if it is up, then start it again from what it persisted
+        '''
+        self.crash(i)
+        self.nodes[i] = self.boot(i)
+
+    def partition(self, *groups):
+        self.network.partition(*groups)
+
+    def heal(self):
+        self.network.heal()
+
+    def run(self, seconds):
+        self.runtime.run(seconds)
+
+    def run_until(self, predicate, timeout):
+        return self.runtime.run_until(self.runtime.now + timeout, predicate)
+
+    def leader(self):
+        '''
+        Return: the up node that is Leader in the highest term, None if there is none
+        '''
+        leaders = [node for node in self.nodes if not node.crashed and node.is_leader()]
+        return max(leaders, key=lambda node: node.core.current_term, default=None)
+
+    def propose(self, command, node=None):
+        '''
+        Client write, sent to node (the current Leader by default) and served like node.py does
+        Return:
+            Operation, completed as the simulation runs
+        '''
+        return self.request(Operation('write', self.target(node), self.runtime.now, command=command))
+
+    def read(self, topic, node=None):
+        '''
+        Client linearizable read of topic's messages, sent to node (the current Leader by default)
+        Return:
+            Operation, completed as the simulation runs
+        '''
+        return self.request(Operation('read', self.target(node), self.runtime.now, topic=topic))
+
+    def target(self, node):
+        node = node or self.leader() or self.nodes[0]
+        return node.node.id
+
+    def request(self, operation):
+        self.history.append(operation)
+        node = self.nodes[operation.node_id]
+        self.runtime.start(node.process, self.serve, node, operation)
+        return operation
+
+    def serve(self, node, operation):
+        if operation.kind == 'write':
+            operation.result = node.client_append_entries(operation.command) if node.is_leader() else {'success': False}
+        else:
+            mq = node.read_MQ() if node.is_leader() else None
+            operation.result = None if mq is None else list(mq.topics.get(operation.topic, []))
+        operation.completed_at = self.runtime.now
+
+    def check_safety(self):
+        '''
+        Raise AssertionError unless:
+            - Election Safety: at most one Leader was elected per term
+            - State Machine Safety: nodes agree on every entry they have both committed (and not compacted)
+            - acknowledged writes are durable: no node committed another entry where a write was acknowledged
+            - reads are linearizable: a read returns every message acknowledged, and every message read,
+              before it was invoked (topics are only written to with put_message)
+        '''
+        elected = collections.defaultdict(set)
+        for node in self.instances:
+            for term in node.elected_terms:
+                elected[term].add(node.node.id)
+        for term, leaders in elected.items():
+            assert len(leaders) == 1, f'term {term} has several Leaders: {sorted(leaders)}'
+
+        nodes = [node for node in self.nodes if not node.crashed]
+        for a, b in itertools.combinations(nodes, 2):
+            start = max(a.core.log.start_index, b.core.log.start_index)
+            end = min(a.core.commit_index, b.core.commit_index)
+            for index in range(start, end):
+                assert a.core.log.get_log_term(index) == b.core.log.get_log_term(index) and \
+                    a.core.log.get_log_command(index) == b.core.log.get_log_command(index), \
+                    f'nodes {a.node.id} and {b.node.id} committed different entries at index {index}'
+
+        for operation in self.history:
+            if operation.kind != 'write' or operation.result is None or not operation.result['success']:
+                continue
+            index = operation.result['index']
+            for node in nodes:
+                if node.core.log.start_index <= index < node.core.commit_index:
+                    assert node.core.log.get_log_command(index) == operation.command, \
+                        f'{operation} acknowledged, but node {node.node.id} committed {node.core.log.get_log_command(index)}'
+
+        reads = [operation for operation in self.history if operation.kind == 'read' and operation.result is not None]
+        for read in reads:
+            messages = set(read.result)
+            for operation in self.history:
+                if operation.completed_at is None or operation.completed_at >= read.invoked_at:
+                    continue
+                if operation.kind == 'write' and operation.result['success'] and operation.command['op'] == PUT_MESSAGE \
+                        and operation.command['topic'] == read.topic:
+                    assert operation.command['message'] in messages, f'{read} misses the acknowledged {operation}'
+                elif operation.kind == 'read' and operation.result is not None and operation.topic == read.topic:
+                    assert set(operation.result) <= messages, f'{read} misses messages of the earlier {operation}'
+
+    def close(self):
+        for node in self.nodes:
+            node.crash()
+        shutil.rmtree(self.storage_path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def run_scenario(num_nodes, seed, duration, loss, fault_interval, lease_reads=False):
+    '''
+    Random scenario: Leader election, then duration seconds of client writes and reads under random faults
+    (crash and restart of a node, partition and heal) every fault_interval seconds, then safety checks
+    Return:
+        {'seed', 'first_leader_s', 'leaders_elected', 'committed', 'writes', 'reads'}: writes and reads that succeeded
+    '''
+    with SimCluster(num_nodes, seed=seed, loss=loss, lease_reads=lease_reads) as sim:
+        rng = random.Random(seed)
+        sim.run_until(lambda: sim.leader() is not None, timeout=duration)
+        first_leader_s = sim.runtime.now if sim.leader() is not None else None
+        sim.propose({'op': CREATE_TOPIC, 'topic': 'topic'})
+
+        end = sim.runtime.now + duration
+        next_fault = sim.runtime.now + fault_interval
+        while sim.runtime.now < end:
+            sim.run(HEARTBEAT_INTERVAL)
+            sim.propose({'op': PUT_MESSAGE, 'topic': 'topic', 'message': str(sim.runtime.now)})
+            sim.read('topic')
+            if sim.runtime.now >= next_fault:
+                next_fault += fault_interval
+                fault = rng.choice(['restart', 'partition', 'heal'])
+                if fault == 'restart':
+                    sim.restart(rng.randrange(num_nodes))
+                elif fault == 'partition':
+                    ids = list(range(num_nodes))
+                    rng.shuffle(ids)
+                    cut = rng.randrange(1, num_nodes) if num_nodes > 1 else 1
+                    sim.partition(ids[:cut], ids[cut:])
+                else:
+                    sim.heal()
+        sim.heal()
+        sim.run(fault_interval) # let the cluster settle
+        sim.check_safety()
+        return {
+            'seed': seed,
+            'first_leader_s': first_leader_s,
+            'leaders_elected': sum(len(node.elected_terms) for node in sim.instances),
+            'committed': max(node.core.commit_index for node in sim.nodes),
+            'writes': sum(op.kind == 'write' and op.result is not None and op.result['success'] for op in sim.history),
+            'reads': sum(op.kind == 'read' and op.result is not None for op in sim.history),
+        }
+
+
+## python -m raft.simulation (from src/)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run random Raft scenarios in the deterministic simulation')
+    parser.add_argument('--nodes', type=int, default=5)
+    parser.add_argument('--scenarios', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first scenario, the next ones use the following seeds')
+    parser.add_argument('--duration', type=float, default=1., help='virtual seconds of each scenario')
+    parser.add_argument('--loss', type=float, default=0., help='probability that a message is lost')
+    parser.add_argument('--fault-interval', type=float, default=.25, help='virtual seconds between random faults')
+    parser.add_argument('--lease-reads', action='store_true', help='Leaders serve reads under a lease')
+    parser.add_argument('--output', help='JSON file to write the results of every scenario to')
+    args = parser.parse_args()
+    logger.configure({'level': 'WARNING'})
+
+    started_at = time.perf_counter()
+    results = []
+    for seed in range(args.seed, args.seed + args.scenarios):
+        try:
+            results.append(run_scenario(args.nodes, seed, args.duration, args.loss, args.fault_interval, args.lease_reads))
+        except AssertionError as e:
+            sys.exit(f'scenario with seed {seed} is unsafe: {e}\n'
+                     f'reproduce it with: python -m raft.simulation --nodes {args.nodes} --scenarios 1 --seed {seed} '
+                     f'--duration {args.duration} --loss {args.loss} --fault-interval {args.fault_interval}'
+                     + (' --lease-reads' if args.lease_reads else ''))
+    seconds = time.perf_counter() - started_at
+
+    elections = sorted(result['first_leader_s'] for result in results if result['first_leader_s'] is not None)
+    print(f'{len(results)} scenarios of {args.duration}s with {args.nodes} nodes in {seconds:.1f}s '
+          f'({len(results) / seconds * 60:.0f} scenarios/min), all safe')
+    if elections:
+        print(f'first Leader elected after: p50 {elections[len(elections) // 2] * 1000:.0f}ms, max {elections[-1] * 1000:.0f}ms')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
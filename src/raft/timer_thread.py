@@ -1,67 +1,170 @@
-import time
 import threading
-from random import randrange
+import random
 import logging
-from .cluster import ELECTION_TIMEOUT_MAX, TIMEOUT_SCALER, HEARTBEAT_INTERVAL
+from .cluster import ELECTION_TIMEOUT_MAX, ELECTION_TIMEOUT_MIN, TIMEOUT_SCALER, HEARTBEAT_INTERVAL, COMMIT_TIMEOUT
+from .NodeState import VoteResult
+from .NodeCore import NodeCore
 from .Candidate import Candidate, VoteRequest
 from .Follower import Follower
 from .Leader import Leader, AppenEntriesRequest
+from .client import Peers, HttpTransport
+from .metrics import COMMIT_LATENCY, ELECTIONS, ELECTION_DURATION
+from .logger import get_logger, ELECTION, REPLICATION, SNAPSHOT, CLIENT
 
 
 logging.basicConfig(format='%(asctime)s-%(levelname)s: %(message)s', datefmt='%H:%M:%S', level=logging.INFO)
+election_log = get_logger(ELECTION)
+replication_log = get_logger(REPLICATION)
+snapshot_log = get_logger(SNAPSHOT)
+client_log = get_logger(CLIENT)
 
 class TimerThread(threading.Thread):
-    def __init__(self, i, cluster):
+    def __init__(self, i, cluster, group=0, peers=None, lease_reads=False, core=None, rng=None):
         '''
+        Runs the node's member of one Raft group
         Args:
             i: int. indicate i-th node in cluster
             cluser: List[Node]. e.g. [0 -> http://127.0.0.1:8567, 1 -> http://127.0.0.1:9123, 2 -> http://127.0.0.1:8889]
+            group: int. Raft group id, see Cluster
+            peers: optional, Peers. node's connections to the other nodes, shared by the groups it hosts
+            lease_reads: bool. Leader serves reads locally while it holds a lease, see Leader.lease_read_index()
+            core: optional, NodeCore. loaded from STORAGE_PATH, with RPCs sent over HTTP, if not given
+                (a simulation passes one with its own transport and runtime)
+            rng: optional, random.Random. draws the election timeouts
         Attrs:
             self.cluster: List[Node]
             self.node: i-th Node instance. e.g. 0-th Node: Node(id=0, uri='http://127.0.0.1:8567')
+            self.core: NodeCore. log and hard state, loaded once and kept across role changes
+            self.runtime: Runtime. time and concurrency primitives, the core's
+            self.node_state: Follower, Candidate or Leader, a view over self.core
         '''
-        threading.Thread.__init__(self)
+        threading.Thread.__init__(self, daemon=True) # runs the election timer loop until the node exits
         self.cluster = cluster
         self.node = cluster[i]
-        self.node_state = Follower(self.node, self.cluster)
-        self.election_timeout = float(randrange(ELECTION_TIMEOUT_MAX / 2, ELECTION_TIMEOUT_MAX)) * TIMEOUT_SCALER
-        self.election_timer = threading.Timer(self.election_timeout, self.become_candidate)
+        self.group = group
+        self.lease_reads = lease_reads
+        self.last_heartbeat = float('-inf') # when a request from the current Leader was last received, see in_lease()
+        self.caught_up_at = float('-inf') # when this node last had Leader's commit index applied, for bounded-staleness reads
+        self.rng = rng or random.Random()
+        if core is None:
+            if peers is None:
+                peers = Peers([peer for peer in self.cluster if peer != self.node]) # kept for the node's lifetime
+            core = NodeCore(self.node, self.cluster, HttpTransport(peers, self.group), self.group)
+        self.core = core
+        self.runtime = core.runtime
+        self.node_state = Follower(self.core)
+        if self.lease_reads:
+            # a restarted node may have acknowledged the heartbeat of a Leader still holding its lease: wait it out
+            self.last_heartbeat = self.runtime.monotonic()
+        self.election_timeout = self.random_election_timeout()
+        # Election deadline (runtime.monotonic()), None while no election is due (Leader, or election in progress)
+        # A heartbeat only moves the deadline later, the timer loop in run() checks it once the old one passes
+        self.election_deadline = None
+        self.election_deadline_set = self.runtime.Event() # wakes the timer loop up once a deadline is set, or moved earlier
     
     def run(self):
         '''
         Override Thread.run()
         When a thread/node init, it firstly becomes a Follower
+        Then runs the election timer loop for the node's lifetime:
+        waits until the deadline, and starts an election if it has not moved meanwhile
         '''
         self.become_follower()
+        while True:
+            deadline = self.election_deadline
+            remaining = None if deadline is None else deadline - self.runtime.monotonic()
+            if remaining is None or remaining > 0:
+                self.election_deadline_set.wait(remaining)
+                self.election_deadline_set.clear()
+                continue
+            self.election_deadline = None
+            self.runtime.spawn(self.become_candidate) # runs as long as this node stays Leader
     
     def become_follower(self):
         '''
         Follower becomes Candidate after timeout collapses.
         andomizes timeout in case of >2 nodes timeout at the same time
         '''
-        timeout = float(randrange(ELECTION_TIMEOUT_MAX / 2, ELECTION_TIMEOUT_MAX)) * TIMEOUT_SCALER
+        timeout = self.random_election_timeout()
         if type(self.node_state) != Follower:
-            logging.info(f'{self} now becomes Follower...')
-            self.node_state = Follower(self.node, self.cluster)
-        logging.info(f'{self} reset election timer {timeout}s ...')
-        self.election_timer.cancel() # reset every time it receives heartbeat
-        self.election_timer = threading.Timer(timeout, self.become_candidate)
-        self.election_timer.start()
+            election_log.info('becomes Follower', node=self)
+            if type(self.node_state) == Leader:
+                self.node_state.invalidate_lease()
+                self.node_state.stop()
+            self.node_state = Follower(self.core)
+        election_log.sampled(logging.DEBUG, 'election timer reset', node=self, timeout=timeout)
+        self.reset_election_timer(timeout) # reset every time it receives heartbeat
     
-    def become_candidate(self):
-        logging.warning(f'Heartbeat is timeout: {int(self.election_timeout)}s')
-        logging.info(f'{self} becomes Candidate and starts requesting votes...')
-        self.node_state = Candidate(self.node_state)
-        self.node_state.elect()
-        if self.node_state.win():
+    def reset_election_timer(self, timeout=None):
+        '''
+        Move the election deadline timeout seconds from now
+        Without timeout, no election is due until the deadline is set again
+        '''
+        if timeout is None:
+            self.election_deadline = None
+            return
+        self.election_timeout = timeout
+        deadline = self.runtime.monotonic() + timeout
+        earlier = self.election_deadline is None or deadline < self.election_deadline
+        self.election_deadline = deadline
+        if earlier: # the timer loop waits for the old deadline otherwise
+            self.election_deadline_set.set()
+
+    def random_election_timeout(self):
+        '''
+        Election timeout in [ELECTION_TIMEOUT_MAX/2, ELECTION_TIMEOUT_MAX)
+        With several Raft groups, the group's preferred Leader draws from the lower half of the range and the other nodes
+        from the upper half, so that the groups' Leaders end up spread across nodes
+        '''
+        low, high = ELECTION_TIMEOUT_MAX // 2, ELECTION_TIMEOUT_MAX
+        if len(self.cluster.groups) > 1:
+            middle = (low + high) // 2
+            low, high = (low, middle) if self.cluster.preferred_leader(self.group) == self.node else (middle, high)
+        return float(self.rng.randrange(low, high)) * TIMEOUT_SCALER
+
+    def is_leader(self):
+        return type(self.node_state) == Leader
+
+    def leader_uri(self):
+        '''
+        URI of the group's Leader as far as this node knows, None if unknown
+        '''
+        if self.is_leader():
+            return self.node.uri
+        leader = getattr(self.node_state, 'leader', None) # only Follower knows its Leader
+        return None if leader is None else self.cluster[leader].uri
+
+    def become_candidate(self, leadership_transfer=False):
+        '''
+        Args:
+            leadership_transfer: bool. started on Leader's TimeoutNow request rather than on timeout
+        '''
+        election_log.warning('heartbeat timeout', node=self, timeout=self.election_timeout)
+        election_log.info('becomes Candidate', node=self)
+        # a deadline set since the timer fired (e.g. by a vote granted meanwhile) must not start another election
+        self.reset_election_timer()
+        started_at = self.runtime.monotonic()
+        candidate = Candidate(self.core, leadership_transfer)
+        self.node_state = candidate
+        candidate.elect()
+        won = candidate.win()
+        ELECTION_DURATION.observe(self.runtime.monotonic() - started_at, group=self.group)
+        ELECTIONS.inc(group=self.group, outcome='won' if won else 'lost')
+        if self.node_state is not candidate: # stepped down during the election, already Follower
+            return
+        if won:
             self.become_leader()
         else:
             self.become_follower()
     
     def become_leader(self):
-        logging.info(f'{self} beomes Leader and starts sending heartbeat...')
-        self.node_state = Leader(self.node_state)
-        self.node_state.heartbeat()
+        election_log.info('becomes Leader', node=self)
+        self.reset_election_timer() # Leader has no election due
+        leader = Leader(self.core)
+        self.node_state = leader
+        leader.heartbeat() # returns once Leader stops, right away without followers
+        if self.node_state is leader and leader.stopped: # stopped on its own, on seeing a higher term
+            self.become_follower()
     
 
     def vote(self, vote_request: VoteRequest):
@@ -69,43 +172,100 @@ class TimerThread(threading.Thread):
         As Follower (node_state), vote for Candidate
         Invoked by node.py; Invoke NodeState.vote()
         '''
-        logging.info(f'{self} received vote request: {vote_request}')
+        election_log.info('vote request received', node=self, request=vote_request)
+        if self.lease_reads and not vote_request['leadership_transfer'] and self.in_lease():
+            # Leader's lease relies on no other Leader being elected before the election timeout,
+            # unless Leader hands its leadership over (and gave its lease up, see Leader.maybe_transfer_leadership())
+            election_log.info('vote rejected: Leader alive', node=self, candidate=vote_request['candidate_id'])
+            return VoteResult(False, self.node_state.current_term, self.node.id)
+        term = self.core.current_term
         vote_result = self.node_state.vote(vote_request)
-        logging.info(f'{self} returns vote result: {vote_result}')
+        election_log.info('vote result returned', node=self, result=vote_result)
 
-        if vote_result[0]: # result['vote_granted']
-            self.node_state.current_term = vote_result[1]
+        if vote_result[0] or vote_result[1] > term: # voted, or stepped down to Candidate's term
             self.become_follower()
         return vote_result
+
+    def in_lease(self):
+        '''
+        True if this node is Leader, or heard from Leader less than ELECTION_TIMEOUT_MIN ago
+        '''
+        return type(self.node_state) == Leader or self.runtime.monotonic() - self.last_heartbeat < ELECTION_TIMEOUT_MIN
     
 
     def client_append_entries(self, client_request):
         '''
         Leader rule 2: Leader responding to client
         Add client's PUT request to Leader's local log
+        Respond as soon as the new entry is committed and applied, fail if it is not applied within COMMIT_TIMEOUT,
+        or if Leader stepped down meanwhile: the entry applied at its index may be the next Leader's
         Arg:
-            client_request: str
+            client_request: dict. MQ command, see MessageQueue
+        Return:
+            {'success': <bool>, 'index': <int>, 'message': <str>}: outcome of applying the command to the MQ,
+            message is only set for get_message
         '''
-        result = self.node_state.client_append_entries(client_request)
+        node_state = self.node_state
+        proposed_at = self.runtime.monotonic()
+        result = node_state.client_append_entries(client_request)
+        if not result['success']:
+            return result
 
-        # NOTE: postpone response to client until entry applied to state machine
-        # In experiment, randomizing timeout appears to perform best (fewer failures)
-        timeout = float(randrange(ELECTION_TIMEOUT_MAX / 2, ELECTION_TIMEOUT_MAX)) * TIMEOUT_SCALER
-        time.sleep(timeout)
-        return result
+        if not node_state.wait_for_apply(result['index'], COMMIT_TIMEOUT):
+            client_log.warning('entry not applied in time', node=self, index=result['index'], timeout=COMMIT_TIMEOUT)
+            return {'success': False}
+        if self.node_state is not node_state:
+            client_log.info('Leader stepped down before the entry was applied', node=self, index=result['index'])
+            return {'success': False}
+        COMMIT_LATENCY.observe(self.runtime.monotonic() - proposed_at, group=self.group)
+        apply_result = node_state.pop_apply_result(result['index'], result['term'])
+        if apply_result is None:
+            return {'success': False}
+        success, message = apply_result
+        return {'success': success, 'index': result['index'], 'message': message}
     
-    def fetch_MQ(self):
+    def read_MQ(self):
         '''
-        Leader rule 2: Leader responding to client
-        MQ saved in log, fetch the latest commited (commit_index - 1) MQ from Leader's log
+        Linearizable read with the ReadIndex protocol, without appending anything to the log:
+        wait until Leader's MQ is applied up to the read index, then serve from it
+        In lease mode, Leader holding a lease skips the heartbeat round
+        Return:
+            MessageQueue, None if Leader cannot confirm its leadership or apply up to the read index within COMMIT_TIMEOUT
+        '''
+        node_state = self.node_state
+        read_index = node_state.lease_read_index() if self.lease_reads else None
+        if read_index is None:
+            read_index = node_state.read_index(COMMIT_TIMEOUT)
+        if read_index is None:
+            client_log.warning('leadership not confirmed in time', node=self, timeout=COMMIT_TIMEOUT)
+            return None
+        if not node_state.wait_for_apply(read_index - 1, COMMIT_TIMEOUT):
+            client_log.warning('read index not applied in time', node=self, read_index=read_index, timeout=COMMIT_TIMEOUT)
+            return None
+        return node_state.fetch_MQ()
+
+    def read_stale_MQ(self, min_index=None, max_staleness=None):
+        '''
+        Bounded-staleness read, served by any node from its applied MQ without contacting Leader
+        Args:
+            min_index: optional, int. serve only once at least min_index entries are applied (waits up to COMMIT_TIMEOUT)
+            max_staleness: optional, seconds. serve only if this node had Leader's commit index applied within max_staleness
+        Return:
+            (MessageQueue, served index: number of entries applied), None if the bounds cannot be met
+            Leader serves the read linearizably
         '''
-        # NOTE: postpone until entry applied to state machine
-        # In experiment, randomizing timeout appears to perform best (fewer failures)
-        timeout = float(randrange(ELECTION_TIMEOUT_MAX / 2, ELECTION_TIMEOUT_MAX)) * TIMEOUT_SCALER
-        time.sleep(timeout)
+        node_state = self.node_state
+        if type(node_state) == Leader:
+            mq = self.read_MQ()
+            return None if mq is None else (mq, node_state.last_applied_index)
 
-        result = self.node_state.fetch_MQ()
-        return result
+        if min_index is not None and not node_state.wait_for_apply(min_index - 1, COMMIT_TIMEOUT):
+            client_log.info('stale read refused: index not applied in time', node=self, min_index=min_index, timeout=COMMIT_TIMEOUT)
+            return None
+        if max_staleness is not None and self.runtime.monotonic() - self.caught_up_at > max_staleness:
+            client_log.info('stale read refused: too stale', node=self, max_staleness=max_staleness)
+            return None
+        return node_state.fetch_MQ(), node_state.last_applied_index
 
     
     def append_entries(self, append_entries_request: AppenEntriesRequest):
@@ -113,21 +273,53 @@ class TimerThread(threading.Thread):
         As Follower (node_state), append entries from Leader log or receive heartbeat
         Invoke NodeState.append_entries()
         '''
-        logging.info(f'{self} received append entries request: {append_entries_request}')
+        replication_log.sampled(logging.DEBUG, 'append entries request received', node=self, request=append_entries_request)
         append_result = self.node_state.append_entries(append_entries_request)
-        logging.info(f'{self} returns append entries result: {append_result}')
-        
-        self.node_state.current_term = append_result[1]
+        replication_log.sampled(logging.DEBUG, 'append entries result returned', node=self, result=append_result)
+        if append_result[1] != append_entries_request['term']: # sent by a stale Leader, which must not depose the current one
+            return append_result
+
+        self.last_heartbeat = self.runtime.monotonic()
         self.become_follower() # Follower remains its role
         # set leader id
         self.node_state.leader = append_entries_request['leader_id']
+        if append_result[0] and self.node_state.commit_index >= append_entries_request['leader_commit']:
+            self.caught_up_at = self.runtime.monotonic()
         
         return append_result
 
+    def timeout_now(self, timeout_now_request):
+        '''
+        Leader hands its leadership over to this node: start an election right away instead of waiting for the timeout
+        '''
+        if timeout_now_request['term'] != self.node_state.current_term or type(self.node_state) != Follower:
+            return
+        election_log.info('timeout now received', node=self, leader=timeout_now_request['leader_id'])
+        self.reset_election_timer()
+        self.runtime.spawn(self.become_candidate, True)
+
+    def install_snapshot(self, install_snapshot_request):
+        '''
+        As Follower (node_state), install a chunk of Leader's snapshot
+        Invoke NodeState.install_snapshot()
+        '''
+        snapshot_log.debug('install snapshot request received', node=self, offset=install_snapshot_request['offset'])
+        install_result = self.node_state.install_snapshot(install_snapshot_request)
+        snapshot_log.debug('install snapshot result returned', node=self, result=install_result)
+        if install_result[1] != install_snapshot_request['term']: # sent by a stale Leader, which must not depose the current one
+            return install_result
+
+        self.last_heartbeat = self.runtime.monotonic()
+        self.become_follower() # Follower remains its role
+        # set leader id
+        self.node_state.leader = install_snapshot_request['leader_id']
+
+        return install_result
+
 
     
     def __repr__(self):
-        return f'{type(self).__name__, self.node_state}'
+        return f'{type(self).__name__, self.group, self.node_state}'
 
 
 
@@ -0,0 +1,66 @@
+from test_utils import Swarm
+
+import pytest
+import time
+import requests
+
+import os
+import glob
+
+TEST_TOPIC = "test_topic"
+TEST_TOPIC_DIFFERENT = "test_topic_different"
+PROGRAM_FILE_PATH = "src/node.py"
+ELECTION_TIMEOUT = 0.3
+REQUEST_TIMEOUT = 3
+
+def clean_persistent_data():
+    '''
+    Before starting a test, remove persistent data from the previous test first
+    '''
+    files = glob.glob('./data/*', recursive=True)
+    for f in files:
+        try:
+            os.remove(f)
+        except OSError as e:
+            print("Error: %s : %s" % (f, e.strerror))
+
+@pytest.fixture
+def node_with_test_topics():
+    clean_persistent_data()
+
+    node = Swarm(PROGRAM_FILE_PATH, 1)[0]
+    node.start()
+    time.sleep(ELECTION_TIMEOUT)
+    assert(node.create_topic(TEST_TOPIC).json() == {"success": True})
+    assert(node.create_topic(TEST_TOPIC_DIFFERENT).json() == {"success": True})
+    yield node
+    node.clean()
+
+
+def put_messages(node, messages):
+    data = {"messages": [{"topic": topic, "message": message} for topic, message in messages]}
+    return requests.put(node.address + '/messages', json=data, timeout=REQUEST_TIMEOUT).json()
+
+def get_messages(node, topic, count):
+    return requests.get(node.address + '/messages/' + topic, params={"count": count}, timeout=REQUEST_TIMEOUT).json()
+
+
+def test_put_messages_to_several_topics(node_with_test_topics):
+    messages = [(TEST_TOPIC, "1"), (TEST_TOPIC_DIFFERENT, "a"), (TEST_TOPIC, "2")]
+    assert(put_messages(node_with_test_topics, messages) == {"success": True})
+    assert(node_with_test_topics.get_message(TEST_TOPIC).json() == {"success": True, "message": "1"})
+    assert(node_with_test_topics.get_message(TEST_TOPIC).json() == {"success": True, "message": "2"})
+    assert(node_with_test_topics.get_message(TEST_TOPIC_DIFFERENT).json() == {"success": True, "message": "a"})
+
+
+def test_put_messages_to_missing_topic_puts_nothing(node_with_test_topics):
+    messages = [(TEST_TOPIC, "1"), ("missing_topic", "2")]
+    assert(put_messages(node_with_test_topics, messages) == {"success": False})
+    assert(node_with_test_topics.get_message(TEST_TOPIC).json() == {"success": False})
+
+
+def test_get_messages_up_to_count(node_with_test_topics):
+    assert(put_messages(node_with_test_topics, [(TEST_TOPIC, str(i)) for i in range(5)]) == {"success": True})
+    assert(get_messages(node_with_test_topics, TEST_TOPIC, 3) == {"success": True, "messages": ["0", "1", "2"]})
+    assert(get_messages(node_with_test_topics, TEST_TOPIC, 3) == {"success": True, "messages": ["3", "4"]})
+    assert(get_messages(node_with_test_topics, TEST_TOPIC, 3) == {"success": False})
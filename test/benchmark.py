@@ -0,0 +1,208 @@
+'''
+Throughput and latency benchmark of the RRMQ, on clusters launched with the test Swarm
+
+For each cluster size, it runs three workloads against the Leader, one after the other:
+    - create_topic: PUT /topic for --topics topics
+    - put_message: PUT /message for --messages messages, spread round-robin over the topics
+    - get_message: GET /message/<topic> until the messages are consumed
+with --clients concurrent clients each, then kills the Leader and measures the failover time.
+Results are printed, and written as JSON to --output to compare runs before and after a change.
+
+Run from the root folder of the repository, like pytest:
+    > python test/benchmark.py --nodes 1 3 5 --messages 1000 --clients 8 --output benchmark.json
+'''
+from test_utils import Swarm, LEADER, MESSAGE, TOPIC
+
+import argparse
+import threading
+import subprocess
+import json
+import time
+import glob
+import os
+import requests
+
+PROGRAM_FILE_PATH = "src/node.py"
+ELECTION_TIMEOUT = 0.3
+NUMBER_OF_LOOP_FOR_SEARCHING_LEADER = 10
+REQUEST_TIMEOUT = 3 # seconds, more than the nodes' commit timeout
+FAILOVER_TIMEOUT = 10 # seconds to wait for a new Leader after killing the current one
+PERCENTILES = {'p50': 50, 'p99': 99, 'p999': 99.9}
+
+
+def clean_persistent_data():
+    '''
+    Before starting a cluster, remove persistent data from the previous one first
+    '''
+    files = glob.glob('./data/*', recursive=True)
+    for f in files:
+        try:
+            os.remove(f)
+        except OSError as e:
+            print("Error: %s : %s" % (f, e.strerror))
+
+
+def percentile(sorted_values, p):
+    '''
+    Nearest-rank percentile of already sorted values, None if there are none
+    '''
+    if not sorted_values:
+        return None
+    rank = max(1, int(-(-p * len(sorted_values) // 100))) # ceil(p/100 * n)
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def run_workload(address, requests_to_send, clients):
+    '''
+    Send requests_to_send with clients concurrent clients, each over its own kept-alive connection
+    Args:
+        address: str. node's address
+        requests_to_send: List[(method, path, json body or None)]
+        clients: int
+    Return:
+        {'count', 'errors', 'seconds', 'ops_per_sec', 'p50_ms', 'p99_ms', 'p999_ms'}:
+        latencies are of the successful requests, ops_per_sec counts them over the whole run
+    '''
+    pending = iter(requests_to_send)
+    lock = threading.Lock()
+    latencies, errors = [], [0]
+
+    def client():
+        session = requests.Session()
+        while True:
+            with lock:
+                next_request = next(pending, None)
+            if next_request is None:
+                return
+            method, path, body = next_request
+            started_at = time.perf_counter()
+            try:
+                response = session.request(method, address + path, json=body, timeout=REQUEST_TIMEOUT)
+                success = response.ok and response.json().get('success') == True
+            except (requests.exceptions.RequestException, ValueError):
+                success = False
+            latency = time.perf_counter() - started_at
+            with lock:
+                if success:
+                    latencies.append(latency)
+                else:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    started_at = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - started_at
+
+    latencies.sort()
+    result = {'count': len(latencies), 'errors': errors[0], 'seconds': round(seconds, 3),
+              'ops_per_sec': round(len(latencies) / seconds, 1)}
+    for name, p in PERCENTILES.items():
+        value = percentile(latencies, p)
+        result[f'{name}_ms'] = None if value is None else round(value * 1000, 2)
+    return result
+
+
+def measure_failover(swarm, leader):
+    '''
+    Kill the Leader, then measure how long the remaining nodes take to:
+        - election_ms: have a new Leader
+        - recovery_ms: commit a client write through it
+    Return:
+        {'election_ms', 'recovery_ms'}, None for a step not done within FAILOVER_TIMEOUT
+    '''
+    leader.kill()
+    leader.wait()
+    killed_at = time.perf_counter()
+    result = {'election_ms': None, 'recovery_ms': None}
+    survivors = [node for node in swarm.nodes if node is not leader]
+    new_leader = None
+    while time.perf_counter() - killed_at < FAILOVER_TIMEOUT:
+        if new_leader is None:
+            for node in survivors:
+                try:
+                    if node.get_status().json()['role'] == LEADER:
+                        new_leader = node
+                        result['election_ms'] = round((time.perf_counter() - killed_at) * 1000, 1)
+                except (requests.exceptions.RequestException, ValueError):
+                    continue
+        if new_leader is not None:
+            try:
+                response = requests.put(new_leader.address + MESSAGE, json={'topic': 'topic_0', 'message': 'failover'},
+                                        timeout=REQUEST_TIMEOUT)
+                if response.json()['success']:
+                    result['recovery_ms'] = round((time.perf_counter() - killed_at) * 1000, 1)
+                    return result
+            except (requests.exceptions.RequestException, ValueError):
+                new_leader = None # it may have lost leadership meanwhile
+        time.sleep(0.01)
+    return result
+
+
+def benchmark_cluster(num_nodes, num_topics, num_messages, clients):
+    clean_persistent_data()
+    swarm = Swarm(PROGRAM_FILE_PATH, num_nodes)
+    swarm.start(ELECTION_TIMEOUT)
+    try:
+        leader = swarm.get_leader_loop(NUMBER_OF_LOOP_FOR_SEARCHING_LEADER)
+        if leader is None:
+            raise RuntimeError(f'no Leader elected in a {num_nodes} nodes cluster')
+
+        topics = [f'topic_{i}' for i in range(num_topics)]
+        messages = [(topics[i % num_topics], f'message_{i}') for i in range(num_messages)]
+        operations = {
+            'create_topic': run_workload(leader.address, [('PUT', TOPIC, {'topic': topic}) for topic in topics], clients),
+            'put_message': run_workload(
+                leader.address, [('PUT', MESSAGE, {'topic': topic, 'message': message}) for topic, message in messages], clients),
+            'get_message': run_workload(leader.address, [('GET', f'{MESSAGE}/{topic}', None) for topic, _ in messages], clients),
+        }
+        result = {'nodes': num_nodes, 'operations': operations}
+        if num_nodes > 1:
+            result['failover'] = measure_failover(swarm, leader)
+        return result
+    finally:
+        swarm.clean()
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput and latency benchmark of the RRMQ')
+    parser.add_argument('--nodes', type=int, nargs='+', default=[1, 3, 5], help='cluster sizes to benchmark')
+    parser.add_argument('--topics', type=int, default=4, help='number of topics')
+    parser.add_argument('--messages', type=int, default=500, help='number of messages produced, then consumed')
+    parser.add_argument('--clients', type=int, default=4, help='number of concurrent clients')
+    parser.add_argument('--output', help='JSON file to write the results to')
+    args = parser.parse_args()
+
+    results = {
+        'revision': git_revision(),
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'parameters': {'topics': args.topics, 'messages': args.messages, 'clients': args.clients},
+        'clusters': [],
+    }
+    for num_nodes in args.nodes:
+        cluster_result = benchmark_cluster(num_nodes, args.topics, args.messages, args.clients)
+        results['clusters'].append(cluster_result)
+        for operation, stats in cluster_result['operations'].items():
+            print(f"{num_nodes} nodes {operation}: {stats['ops_per_sec']} ops/s, "
+                  f"p50 {stats['p50_ms']}ms, p99 {stats['p99_ms']}ms, p999 {stats['p999_ms']}ms, errors {stats['errors']}")
+        if 'failover' in cluster_result:
+            print(f"{num_nodes} nodes failover: {cluster_result['failover']}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+    else:
+        print(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+import os
+import sys
+import threading
+import http.server
+import pytest
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from raft.client import Client
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive
+    slow_started = threading.Event() # set once /slow is received
+    release = threading.Event() # set: /slow answers
+    addresses = {} # path -> client address of the connection the request came in on
+
+    def do_POST(self):
+        Handler.addresses[self.path] = self.client_address
+        self.rfile.read(int(self.headers['Content-Length']))
+        if self.path == '/drop': # fail the request: close the connection without answering
+            self.close_connection = True
+            return
+        if self.path == '/slow':
+            Handler.slow_started.set()
+            Handler.release.wait(2)
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{httpd.server_port}'
+    Handler.release.set()
+    httpd.shutdown()
+    Handler.slow_started.clear()
+    Handler.release.clear()
+    Handler.addresses.clear()
+
+
+def test_failure_keeps_kept_alive_connections(server):
+    client = Client()
+    in_flight = []
+    request = threading.Thread(target=lambda: in_flight.append(client.post(server + '/slow', timeout=3, data=b'x')))
+    request.start()
+    assert Handler.slow_started.wait(2) # the slow request holds a connection of the pool
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.post(server + '/drop', timeout=1, data=b'x') # on a second connection, dropped by the server
+    assert client.failures == 1 and client.retry_at > 0
+    assert Handler.addresses['/drop'] != Handler.addresses['/slow']
+
+    Handler.release.set()
+    request.join()
+    assert in_flight[0].content == b'ok'
+    assert client.post(server + '/fast', timeout=1, data=b'x').content == b'ok'
+    assert client.failures == 0
+    assert Handler.addresses['/fast'] == Handler.addresses['/slow'] # the failure did not drop the kept-alive connection
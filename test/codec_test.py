@@ -0,0 +1,65 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from raft import codec
+from raft.Log import Log
+from raft.NodeState import VoteResult, AppendEntriesResult, InstallSnapshotResult
+
+
+class Request:
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+def test_vote_round_trip():
+    vote_request = Request(term=3, candidate_id=1, last_log_index=-1, last_log_term=-1, leadership_transfer=True)
+    assert codec.decode_vote_request(codec.encode_vote_request(vote_request)) == {
+        'term': 3, 'candidate_id': 1, 'last_log_index': -1, 'last_log_term': -1, 'leadership_transfer': True
+    }
+    vote_result = VoteResult(True, 3, 2)
+    assert codec.decode_vote_result(codec.encode_vote_result(vote_result)) == vote_result
+
+
+def test_append_entries_round_trip(tmp_path):
+    log = Log(str(tmp_path / 'log.wal'))
+    entries = [{"command": {"op": "put_message", "topic": "t", "message": str(i)}, "term": 2} for i in range(3)]
+    log.append_entries(-1, entries)
+
+    request = Request(term=2, leader_id=0, prev_log_index=0, prev_log_term=2, leader_commit=1,
+                      entries=log.get_entries(1), records=log.get_records(1, 3))
+    decoded = codec.decode_append_entries_request(codec.encode_append_entries_request(request))
+    assert decoded['prev_log_index'] == 0
+    assert decoded['leader_commit'] == 1
+    assert decoded['entries'] == entries[1:]
+
+    # payloads are written as they are by the receiving log
+    follower_log = Log(str(tmp_path / 'follower.wal'))
+    follower_log.append_entries(-1, entries[:1])
+    follower_log.append_entries(0, decoded['entries'], decoded['payloads'])
+    assert Log(str(tmp_path / 'follower.wal')).entries == entries
+
+    result = AppendEntriesResult(False, 2, 1, 1, 4)
+    assert codec.decode_append_entries_result(codec.encode_append_entries_result(result)) == result
+
+
+def test_install_snapshot_round_trip():
+    request = Request(term=4, leader_id=2, last_included_index=1999, last_included_term=3, offset=65536, done=True, data=b'{"mq":{}}')
+    assert codec.decode_install_snapshot_request(codec.encode_install_snapshot_request(request)) == {
+        'term': 4, 'leader_id': 2, 'last_included_index': 1999, 'last_included_term': 3,
+        'offset': 65536, 'done': True, 'data': b'{"mq":{}}'
+    }
+    result = InstallSnapshotResult(True, 4, 0)
+    assert codec.decode_install_snapshot_result(codec.encode_install_snapshot_result(result)) == result
+
+
+def test_rejects_corrupt_messages():
+    data = codec.encode_vote_result(VoteResult(True, 3, 2))
+    with pytest.raises(ValueError):
+        codec.decode_vote_result(data[:-1])
+    with pytest.raises(ValueError):
+        codec.decode_append_entries_result(data)
+    with pytest.raises(ValueError):
+        codec.decode_vote_result(bytes([codec.WIRE_VERSION + 1]) + data[1:])
@@ -0,0 +1,81 @@
+from test_utils import Swarm
+import pytest
+import requests
+import os
+import glob
+
+PROGRAM_FILE_PATH = "src/node.py"
+TEST_TOPIC = "test_topic"
+TEST_MESSAGE = "Test Message"
+
+NUM_NODES_ARRAY = [3]
+ELECTION_TIMEOUT = .3 # 0.3=300ms
+NUMBER_OF_LOOP_FOR_SEARCHING_LEADER = 3
+REQUEST_TIMEOUT = 3
+
+
+def clean_persistent_data():
+    '''
+    Before starting a test, remove persistent data from the previous test first
+    '''
+    files = glob.glob('./data/*', recursive=True)
+    for f in files:
+        try:
+            os.remove(f)
+        except OSError as e:
+            print("Error: %s : %s" % (f, e.strerror))
+
+@pytest.fixture
+def swarm(num_nodes):
+    clean_persistent_data()
+
+    swarm = Swarm(PROGRAM_FILE_PATH, num_nodes)
+    swarm.start(ELECTION_TIMEOUT)
+    yield swarm
+    swarm.clean()
+
+
+def get_followers(swarm: Swarm, leader):
+    return [node for node in swarm.nodes if node.i != leader.i]
+
+def get(node, path, **params):
+    return requests.get(node.address + path, params=params, timeout=REQUEST_TIMEOUT).json()
+
+
+@pytest.mark.parametrize('num_nodes', NUM_NODES_ARRAY)
+def test_followers_serve_reads_at_min_index(swarm: Swarm, num_nodes: int):
+    leader = swarm.get_leader_loop(NUMBER_OF_LOOP_FOR_SEARCHING_LEADER)
+
+    assert (leader != None)
+    assert (leader.create_topic(TEST_TOPIC).json() == {"success": True})
+    assert (leader.put_message(TEST_TOPIC, TEST_MESSAGE).json() == {"success": True})
+
+    # the leader reports the index its (linearizable) read was served at, in each group
+    result = get(leader, '/topic', min_index=0)
+    assert (result["success"] and result["topics"] == [TEST_TOPIC])
+    indexes = result["index"]
+    assert (len(indexes) == 1) # a single group
+
+    for follower in get_followers(swarm, leader):
+        assert (follower.get_topics().json() == {"success": False, "topics": []})
+        result = get(follower, '/topic', min_index=indexes)
+        assert (result["success"] and result["topics"] == [TEST_TOPIC])
+        assert (len(result["index"]) == 1 and result["index"][0] >= indexes[0])
+        result = get(follower, '/message/' + TEST_TOPIC + '/peek', min_index=indexes[0])
+        assert (result["success"] and result["message"] == TEST_MESSAGE)
+
+    # peeking does not consume the message
+    assert (leader.get_message(TEST_TOPIC).json() == {"success": True, "message": TEST_MESSAGE})
+
+
+@pytest.mark.parametrize('num_nodes', NUM_NODES_ARRAY)
+def test_followers_reject_reads_staler_than_bound(swarm: Swarm, num_nodes: int):
+    leader = swarm.get_leader_loop(NUMBER_OF_LOOP_FOR_SEARCHING_LEADER)
+
+    assert (leader != None)
+    assert (leader.create_topic(TEST_TOPIC).json() == {"success": True})
+
+    for follower in get_followers(swarm, leader):
+        assert (get(follower, '/topic', max_staleness=0)["success"] == False)
+        result = get(follower, '/topic', max_staleness=5)
+        assert (result["success"] and len(result["index"]) == 1)
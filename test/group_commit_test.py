@@ -0,0 +1,125 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from raft.group_commit import GroupCommit
+from raft.simulation import SimRuntime, SimProcess
+
+MAX_DELAY = .002
+
+
+class FakeLog:
+    '''
+    Records each write: (virtual time, entries)
+    '''
+    def __init__(self, runtime, fail=False, write_delay=0.):
+        self.runtime = runtime
+        self.fail = fail
+        self.write_delay = write_delay # a slow disk: other tasks run meanwhile, like with Runtime.run_blocking()
+        self.writes = []
+        self.last_log_index = -1
+        self.lock = runtime.Semaphore(1)
+
+    def append_entries(self, prev_log_index, entries):
+        if self.fail:
+            raise OSError('disk full')
+        self.writes.append((self.runtime.now, [entry['command'] for entry in entries]))
+        self.runtime.sleep(self.write_delay)
+        self.last_log_index = prev_log_index + len(entries)
+
+
+def entry(command, term=1):
+    return {'command': command, 'term': term}
+
+
+def propose_all(group_commit, runtime, entries, leading=lambda: True, delay=0.):
+    '''
+    Propose each entry from its own task, delay seconds apart
+    Return:
+        {command: result of propose(), or the exception it raised}
+    '''
+    results = {}
+    process = SimProcess()
+
+    def propose(e):
+        try:
+            results[e['command']] = group_commit.propose(e, leading)
+        except OSError as error:
+            results[e['command']] = error
+
+    for i, e in enumerate(entries):
+        runtime.schedule(i * delay, runtime.start, process, propose, e)
+    runtime.run(1.)
+    return results
+
+
+def test_concurrent_proposals_share_one_write():
+    runtime = SimRuntime()
+    log = FakeLog(runtime)
+    group_commit = GroupCommit(log, runtime, max_batch_delay=MAX_DELAY, max_batch_size=64)
+
+    results = propose_all(group_commit, runtime, [entry(i) for i in range(5)])
+    assert log.writes == [(MAX_DELAY, [0, 1, 2, 3, 4])] # flushed once the first proposer's delay is over
+    assert results == {i: i for i in range(5)}
+
+
+def test_full_batch_is_flushed_without_waiting():
+    runtime = SimRuntime()
+    log = FakeLog(runtime)
+    group_commit = GroupCommit(log, runtime, max_batch_delay=MAX_DELAY, max_batch_size=2)
+
+    results = propose_all(group_commit, runtime, [entry(i) for i in range(5)])
+    assert log.writes == [(0., [0, 1]), (0., [2, 3]), (MAX_DELAY, [4])]
+    assert results == {i: i for i in range(5)}
+
+
+def test_proposal_after_max_delay_starts_next_batch():
+    runtime = SimRuntime()
+    log = FakeLog(runtime)
+    group_commit = GroupCommit(log, runtime, max_batch_delay=MAX_DELAY, max_batch_size=64)
+
+    results = propose_all(group_commit, runtime, [entry(i) for i in range(3)], delay=.75 * MAX_DELAY)
+    assert [commands for _, commands in log.writes] == [[0, 1], [2]]
+    assert [at for at, _ in log.writes] == pytest.approx([MAX_DELAY, 1.5 * MAX_DELAY + MAX_DELAY])
+    assert results == {0: 0, 1: 1, 2: 2}
+
+
+def test_proposals_join_the_next_batch_while_one_is_written():
+    runtime = SimRuntime()
+    log = FakeLog(runtime, write_delay=5 * MAX_DELAY)
+    group_commit = GroupCommit(log, runtime, max_batch_delay=MAX_DELAY, max_batch_size=64)
+
+    results = propose_all(group_commit, runtime, [entry(i) for i in range(4)], delay=1.25 * MAX_DELAY)
+    assert log.writes == [(MAX_DELAY, [0]), (pytest.approx(6 * MAX_DELAY), [1, 2, 3])] # written once the first write is over
+    assert results == {i: i for i in range(4)}
+
+
+def test_batch_of_stepped_down_leader_is_not_appended():
+    runtime = SimRuntime()
+    log = FakeLog(runtime)
+    group_commit = GroupCommit(log, runtime, max_batch_delay=MAX_DELAY, max_batch_size=64)
+
+    results = propose_all(group_commit, runtime, [entry(i) for i in range(3)], leading=lambda: False)
+    assert log.writes == []
+    assert results == {0: None, 1: None, 2: None}
+
+
+def test_entries_of_different_terms_are_not_batched_together():
+    runtime = SimRuntime()
+    log = FakeLog(runtime)
+    group_commit = GroupCommit(log, runtime, max_batch_delay=MAX_DELAY, max_batch_size=64)
+
+    results = propose_all(group_commit, runtime, [entry(0, term=1), entry(1, term=2), entry(2, term=2)])
+    assert [commands for _, commands in log.writes] == [[0], [1, 2]]
+    assert results == {0: 0, 1: 1, 2: 2}
+
+
+def test_failed_write_releases_companions():
+    runtime = SimRuntime()
+    log = FakeLog(runtime, fail=True)
+    group_commit = GroupCommit(log, runtime, max_batch_delay=MAX_DELAY, max_batch_size=64)
+
+    results = propose_all(group_commit, runtime, [entry(i) for i in range(3)])
+    assert isinstance(results[0], OSError) # the batch leader sees the error
+    assert (results[1], results[2]) == (None, None)
@@ -0,0 +1,145 @@
+import os
+import sys
+import subprocess
+import textwrap
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from raft.Log import Log
+
+
+def entry(term, topic):
+    return {"command": {"op": "create_topic", "topic": topic}, "term": term}
+
+
+def test_append_and_reopen(tmp_path):
+    filename = str(tmp_path / 'log.wal')
+    log = Log(filename)
+    log.append_entries(-1, [entry(1, 'a'), entry(1, 'b')])
+    log.append_entries(log.last_log_index, [entry(2, 'c')])
+
+    reopened = Log(filename)
+    assert reopened.entries == log.entries
+    assert reopened.last_log_index == 2
+    assert reopened.last_log_term == 2
+
+
+def test_conflicting_suffix_truncated_in_place(tmp_path):
+    filename = str(tmp_path / 'log.wal')
+    log = Log(filename)
+    log.append_entries(-1, [entry(1, 'a'), entry(1, 'b'), entry(1, 'c')])
+    size = os.path.getsize(filename)
+
+    # entry 0 matches and is kept, entry 1 conflicts: entries[1:] are replaced
+    log.append_entries(-1, [entry(1, 'a'), entry(2, 'x')])
+    assert [e["command"]["topic"] for e in log.entries] == ['a', 'x']
+    assert os.path.getsize(filename) < size
+    assert Log(filename).entries == log.entries
+
+
+def test_matching_entries_not_rewritten(tmp_path):
+    filename = str(tmp_path / 'log.wal')
+    log = Log(filename)
+    log.append_entries(-1, [entry(1, 'a'), entry(1, 'b')])
+    size = os.path.getsize(filename)
+
+    # a stale request carrying a prefix of the log must not cut the log
+    log.append_entries(-1, [entry(1, 'a')])
+    assert len(log.entries) == 2
+    assert os.path.getsize(filename) == size
+
+
+def test_recover_torn_tail(tmp_path):
+    filename = str(tmp_path / 'log.wal')
+    log = Log(filename)
+    log.append_entries(-1, [entry(1, 'a'), entry(1, 'b')])
+    size = os.path.getsize(filename)
+    with open(filename, 'ab') as f:
+        f.write(b'\x00\x00\x01\x00garbage') # partially written record
+
+    recovered = Log(filename)
+    assert recovered.entries == log.entries
+    assert os.path.getsize(filename) == size
+    recovered.append_entries(recovered.last_log_index, [entry(1, 'c')])
+    assert len(Log(filename).entries) == 3
+
+
+def test_term_boundaries(tmp_path):
+    log = Log(str(tmp_path / 'log.wal'))
+    log.append_entries(-1, [entry(1, 'a'), entry(2, 'b'), entry(2, 'c'), entry(2, 'd'), entry(4, 'e')])
+
+    assert log.get_first_index_of_term(3) == 1
+    assert log.get_first_index_of_term(0) == 0
+    assert log.get_last_index_of_term(2) == 3
+    assert log.get_last_index_of_term(3) == -1
+    assert log.get_last_index_of_term(5) == -1
+
+
+def test_get_entries_bounded(tmp_path):
+    log = Log(str(tmp_path / 'log.wal'))
+    log.append_entries(-1, [entry(1, str(i) * 100) for i in range(10)])
+    record_size = log.get_record_end(1) - log.get_record_end(0)
+
+    assert len(log.get_entries(0)) == 10
+    assert len(log.get_entries(2, max_entries=3)) == 3
+    assert len(log.get_entries(8, max_entries=3)) == 2
+    assert len(log.get_entries(0, max_bytes=record_size * 4)) == 4
+    # the first entry is always shipped, however large
+    assert len(log.get_entries(5, max_bytes=1)) == 1
+    assert log.get_entries(10, max_entries=3, max_bytes=1) == []
+
+
+def test_compact_and_reset(tmp_path):
+    filename = str(tmp_path / 'log.wal')
+    log = Log(filename)
+    log.append_entries(-1, [entry(1, 'a'), entry(1, 'b'), entry(2, 'c'), entry(2, 'd')])
+
+    # entries up to index 1 are covered by a snapshot
+    log.compact(1, 1)
+    assert log.start_index == 2
+    assert log.last_log_index == 3
+    assert log.get_log_term(1) == 1
+    assert log.get_log_term(0) == -1
+    assert log.get_entries(0) == [entry(2, 'c'), entry(2, 'd')]
+    assert log.get_records(2, 4) == Log(filename).get_records(2, 4)
+
+    reopened = Log(filename)
+    assert (reopened.snapshot_index, reopened.snapshot_term) == (1, 1)
+    assert reopened.entries == log.entries
+    # entries covered by the snapshot are skipped, the rest is appended as usual
+    reopened.append_entries(0, [entry(1, 'b'), entry(2, 'c'), entry(2, 'd'), entry(3, 'e')])
+    assert reopened.last_log_index == 4
+
+    reopened.reset(10, 5)
+    assert reopened.entries == []
+    assert reopened.last_log_index == 10
+    assert reopened.last_log_term == 5
+    assert Log(filename).last_log_index == 10
+
+
+def test_save_leaves_the_event_loop_running(tmp_path):
+    # under gevent, like node.py: a greenlet sending heartbeats every 10ms keeps running while an append is fsynced
+    script = textwrap.dedent('''
+        from gevent import monkey
+        monkey.patch_all()
+        import os, sys, time, gevent
+        sys.path.insert(0, sys.argv[1])
+        from raft.Log import Log
+
+        blocking_sleep = monkey.get_original('time', 'sleep')
+        os.fsync = lambda fd: blocking_sleep(.2) # a slow disk
+        sent = []
+        def heartbeat():
+            while True:
+                sent.append(time.monotonic())
+                time.sleep(.01)
+
+        log = Log(sys.argv[2])
+        gevent.spawn(heartbeat)
+        gevent.sleep(0)
+        started = time.monotonic()
+        log.append_entries(-1, [{"command": {"op": "create_topic", "topic": "a"}, "term": 1}])
+        print(sum(started <= at < time.monotonic() for at in sent))
+    ''')
+    src = os.path.join(os.path.dirname(__file__), '..', 'src')
+    output = subprocess.run([sys.executable, '-c', script, src, str(tmp_path / 'log.wal')], capture_output=True, text=True, check=True).stdout
+    assert int(output) >= 10
@@ -0,0 +1,56 @@
+import os
+import sys
+import logging
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from raft import logger
+
+
+@pytest.fixture(autouse=True)
+def restore_loggers():
+    '''
+    configure() changes the subsystem loggers every other test logs to: put them back as they were
+    '''
+    loggers = [logger.get_logger(subsystem) for subsystem in logger.SUBSYSTEMS]
+    saved = [(log.logger.level, log.sample_every, log.max_field_length, dict(log.counters)) for log in loggers]
+    yield
+    for log, (level, sample_every, max_field_length, counters) in zip(loggers, saved):
+        log.logger.setLevel(level)
+        log.sample_every = sample_every
+        log.max_field_length = max_field_length
+        log.counters = counters
+
+
+class Expensive:
+    formatted = 0
+
+    def __str__(self):
+        Expensive.formatted += 1
+        return 'x' * 1000
+
+
+def test_disabled_events_are_not_formatted(caplog):
+    logger.configure({"level": "INFO", "levels": {"replication": "WARNING"}})
+    log = logger.get_logger(logger.REPLICATION)
+    with caplog.at_level(logging.DEBUG, logger='raft'):
+        log.info('append entries accepted', request=Expensive())
+    assert caplog.records == []
+    assert Expensive.formatted == 0
+
+
+def test_fields_truncated(caplog):
+    logger.configure({"level": "INFO", "max_field_length": 10})
+    log = logger.get_logger(logger.ELECTION)
+    with caplog.at_level(logging.INFO, logger='raft'):
+        log.info('vote request received', request=Expensive(), term=3)
+    assert caplog.messages == ['vote request received request=xxxxxxxxxx...(1000 chars) term=3']
+
+
+def test_sampled_events(caplog):
+    logger.configure({"level": "DEBUG", "sample_every": 10})
+    log = logger.get_logger(logger.ELECTION)
+    with caplog.at_level(logging.DEBUG, logger='raft'):
+        for _ in range(25):
+            log.sampled(logging.DEBUG, 'election timer reset')
+    assert caplog.messages == ['election timer reset sampled=10'] * 3
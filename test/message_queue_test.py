@@ -16,7 +16,7 @@ def clean_persistent_data():
     '''
     Before starting a test, remove persistent data from the previous test first
     '''
-    files = glob.glob('./data/*.json', recursive=True)
+    files = glob.glob('./data/*', recursive=True)
     for f in files:
         try:
             os.remove(f)
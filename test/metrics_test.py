@@ -0,0 +1,45 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from raft import metrics
+from raft.Log import Log
+
+
+def test_counter_and_gauge_samples():
+    registry = metrics.Registry() # not the node's
+    counter = metrics.Counter('test_requests_total', 'Requests', ('endpoint',), registry)
+    counter.inc(endpoint='/topic')
+    counter.inc(2, endpoint='/topic')
+    gauge = metrics.Gauge('test_lag_entries', 'Lag', ('group', 'follower'), registry)
+    gauge.set(5, group=0, follower=2)
+
+    text = registry.render()
+    assert '# TYPE test_requests_total counter\ntest_requests_total{endpoint="/topic"} 3\n' in text
+    assert 'test_lag_entries{group="0",follower="2"} 5\n' in text
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = metrics.Histogram('test_latency_seconds', 'Latency', buckets=(.01, .1), registry=metrics.Registry())
+    for value in (.005, .05, .05, 1.):
+        histogram.observe(value)
+
+    lines = histogram.render()
+    assert lines[2:] == [
+        'test_latency_seconds_bucket{le="0.01"} 1',
+        'test_latency_seconds_bucket{le="0.1"} 3',
+        'test_latency_seconds_bucket{le="+Inf"} 4',
+        'test_latency_seconds_sum 1.105',
+        'test_latency_seconds_count 4',
+    ]
+
+
+def test_log_save_duration_by_group(tmp_path):
+    def saves(group):
+        value = metrics.LOG_SAVE_DURATION.values.get((str(group),))
+        return 0 if value is None else sum(value.counts)
+
+    before = saves(2)
+    log = Log(str(tmp_path / 'log.wal'), group=2)
+    log.append_entries(-1, [{"command": {"op": "create_topic", "topic": "a"}, "term": 1}])
+    assert saves(2) == before + 1
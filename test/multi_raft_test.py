@@ -0,0 +1,86 @@
+from test_utils import Swarm, LEADER, CONFIG_PATH
+import pytest
+import time
+import json
+import os
+import glob
+
+PROGRAM_FILE_PATH = "src/node.py"
+TEST_TOPICS = [f"test_topic_{i}" for i in range(8)]
+TEST_MESSAGE = "Test Message"
+
+NUM_NODES_ARRAY = [3]
+NUM_GROUPS = 3
+ELECTION_TIMEOUT = .3 # 0.3=300ms
+NUMBER_OF_LOOP_FOR_SEARCHING_LEADER = 3
+
+
+def clean_persistent_data():
+    '''
+    Before starting a test, remove persistent data from the previous test first
+    '''
+    files = glob.glob('./data/*', recursive=True)
+    for f in files:
+        try:
+            os.remove(f)
+        except OSError as e:
+            print("Error: %s : %s" % (f, e.strerror))
+
+@pytest.fixture
+def swarm(num_nodes):
+    clean_persistent_data()
+
+    swarm = Swarm(PROGRAM_FILE_PATH, num_nodes)
+    # shard topics across NUM_GROUPS Raft groups
+    with open(CONFIG_PATH, 'r') as f:
+        config = json.load(f)
+    config["groups"] = NUM_GROUPS
+    with open(CONFIG_PATH, 'w') as f:
+        json.dump(config, f)
+
+    swarm.start(ELECTION_TIMEOUT)
+    yield swarm
+    swarm.clean()
+
+
+def get_group_leaders(swarm: Swarm, times: int):
+    '''
+    Return: group -> id of the node leading it, once every group has a Leader
+    '''
+    for _ in range(times):
+        leaders = {}
+        for i, status in swarm.get_status().items():
+            for group, group_status in enumerate(status["groups"]):
+                if group_status["role"] == LEADER:
+                    leaders[group] = i
+        if len(leaders) == NUM_GROUPS:
+            return leaders
+        time.sleep(ELECTION_TIMEOUT)
+    return None
+
+
+@pytest.mark.parametrize('num_nodes', NUM_NODES_ARRAY)
+def test_groups_elect_leaders_on_different_nodes(swarm: Swarm, num_nodes: int):
+    leaders = get_group_leaders(swarm, NUMBER_OF_LOOP_FOR_SEARCHING_LEADER)
+
+    assert (leaders != None)
+    assert (len(set(leaders.values())) > 1)
+
+
+@pytest.mark.parametrize('num_nodes', NUM_NODES_ARRAY)
+def test_topics_shared_across_groups(swarm: Swarm, num_nodes: int):
+    assert (get_group_leaders(swarm, NUMBER_OF_LOOP_FOR_SEARCHING_LEADER) != None)
+    node = swarm.get_leader_loop(NUMBER_OF_LOOP_FOR_SEARCHING_LEADER)
+
+    # any node leading a group forwards requests for the other groups to their Leaders
+    for topic in TEST_TOPICS:
+        assert (node.create_topic(topic).json() == {"success": True})
+        assert (node.put_message(topic, TEST_MESSAGE).json() == {"success": True})
+
+    topics = node.get_topics().json()
+    assert (topics["success"] == True)
+    assert (sorted(topics["topics"]) == sorted(TEST_TOPICS))
+
+    for topic in TEST_TOPICS:
+        assert (node.get_message(topic).json() == {"success": True, "message": TEST_MESSAGE})
+        assert (node.get_message(topic).json() == {"success": False})
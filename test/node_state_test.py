@@ -0,0 +1,423 @@
+import os
+import sys
+import time
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from raft.cluster import Cluster, ELECTION_TIMEOUT_MIN, ELECTION_TIMEOUT_MAX, TIMEOUT_SCALER, LEASE_DURATION, PIPELINE_WINDOW, MAX_APPEND_ENTRIES, HEARTBEAT_INTERVAL
+from raft.NodeCore import NodeCore
+from raft.Follower import Follower
+from raft.Candidate import Candidate
+from raft.Leader import Leader, InstallSnapshotRequest
+from raft import codec
+from raft.NodeState import VoteResult, AppendEntriesResult
+from raft.timer_thread import TimerThread
+from raft.client import Transport
+from raft.simulation import SimRuntime, SimProcess
+
+
+ADDRS = [{"ip": "127.0.0.1", "port": 8567}, {"ip": "127.0.0.1", "port": 9123}, {"ip": "127.0.0.1", "port": 8889}]
+
+
+def make_core(tmp_path):
+    cluster = Cluster(ADDRS)
+    return NodeCore(cluster[0], cluster, storage_path=str(tmp_path))
+
+
+def vote_request(term, candidate_id, last_log_index, last_log_term):
+    return {"term": term, "candidate_id": candidate_id, "last_log_index": last_log_index, "last_log_term": last_log_term}
+
+
+def test_roles_share_core_without_io(tmp_path):
+    core = make_core(tmp_path)
+    core.current_term = 3
+    core.save()
+    mtimes = {f: os.stat(tmp_path / f).st_mtime_ns for f in os.listdir(tmp_path)}
+
+    follower = Follower(core)
+    candidate = Candidate(core)
+    assert candidate.log is follower.log is core.log
+    assert candidate.current_term == 3
+
+    # role changes neither read nor write anything
+    assert {f: os.stat(tmp_path / f).st_mtime_ns for f in os.listdir(tmp_path)} == mtimes
+
+    leader = Leader(core)
+    assert core.log.last_log_index == leader.term_start_index == 0 # the no-op, in the shared log
+    follower.current_term = 4 # written through to the core
+    assert leader.current_term == core.current_term == 4
+
+
+def test_vote_adopts_higher_term_but_checks_log(tmp_path):
+    core = make_core(tmp_path)
+    core.log.append_entries(-1, [{"command": {"op": "no_op"}, "term": 2}])
+    core.current_term = 2
+    follower = Follower(core)
+
+    # Candidate's log is behind: higher term adopted, vote not granted
+    result = follower.vote(vote_request(5, 1, -1, -1))
+    assert (result.vote_granted, result.term) == (False, 5)
+    assert core.vote_for is None
+
+    # same last term, log at least as long: granted, and only once per term
+    assert follower.vote(vote_request(5, 1, 0, 2)).vote_granted
+    assert not follower.vote(vote_request(5, 2, 3, 2)).vote_granted
+
+    reloaded = make_core(tmp_path)
+    assert (reloaded.current_term, reloaded.vote_for) == (5, 1)
+
+
+def test_apply_result_is_only_returned_for_the_proposed_entry(tmp_path):
+    core = make_core(tmp_path)
+    core.log.append_entries(-1, [{"command": {"op": "no_op"}, "term": 1}, {"command": {"op": "create_topic", "topic": "t"}, "term": 1}])
+    # a Leader of term 2 replaces the proposed entry at index 1 before it is committed
+    core.log.append_entries(0, [{"command": {"op": "create_topic", "topic": "other"}, "term": 2}])
+    core.commit_index = 2
+
+    assert core.pop_apply_result(1, 1) is None # the waiter of term 1's entry learns nothing about term 2's
+    assert core.pop_apply_result(1, 2) == (True, None)
+    assert list(core.mq.topics) == ['other']
+
+
+def test_deposed_leader_appends_nothing(tmp_path):
+    core = make_core(tmp_path)
+    core.current_term = 1
+    leader = Leader(core)
+    assert leader.client_append_entries({"op": "create_topic", "topic": "t"})['success']
+
+    core.current_term = 2 # a Candidate of term 2 got this node's vote, Leader has not been stopped yet
+    assert leader.client_append_entries({"op": "create_topic", "topic": "lost"}) == {'success': False}
+    leader.stop()
+    assert leader.client_append_entries({"op": "create_topic", "topic": "lost"}) == {'success': False}
+    assert [core.log.get_log_term(i) for i in range(core.log.last_log_index + 1)] == [1, 1]
+    assert Follower(core).client_append_entries({"op": "create_topic", "topic": "lost"}) == {'success': False}
+
+
+def test_lease_read_index(tmp_path):
+    core = make_core(tmp_path)
+    core.current_term = 1
+    leader = Leader(core)
+    assert leader.lease_read_index() is None # the no-op of its term is not applied yet
+    core.commit_index = leader.term_start_index + 1
+    assert leader.lease_read_index() is None # no follower acknowledged anything yet
+
+    now = core.runtime.monotonic()
+    leader.acked_at[1] = now - LEASE_DURATION - .01 # too long ago
+    assert leader.lease_read_index() is None
+    leader.acked_at[2] = now # with Leader, a majority of 3
+    assert leader.lease_read_index() == core.commit_index
+
+    leader.invalidate_lease()
+    assert leader.lease_read_index() is None
+
+
+def test_vote_rejected_in_lease_unless_leadership_transfer(tmp_path):
+    cluster = Cluster(ADDRS)
+    timer_thread = TimerThread(0, cluster, lease_reads=True, core=NodeCore(cluster[0], cluster, storage_path=str(tmp_path)))
+    timer_thread.last_heartbeat = timer_thread.runtime.monotonic() # heard from Leader just now
+
+    request = vote_request(5, 1, -1, -1)
+    assert not timer_thread.vote({**request, 'leadership_transfer': False}).vote_granted
+    assert timer_thread.core.current_term == 0 # the lease check comes first
+    assert timer_thread.vote({**request, 'leadership_transfer': True}).vote_granted
+
+    timer_thread.last_heartbeat = float('-inf')
+    assert timer_thread.vote({**vote_request(6, 2, -1, -1), 'leadership_transfer': False}).vote_granted
+
+
+def test_restarted_node_waits_out_a_lease_it_may_have_acknowledged(tmp_path):
+    cluster = Cluster(ADDRS)
+    runtime = SimRuntime()
+    timer_thread = TimerThread(0, cluster, lease_reads=True, core=NodeCore(cluster[0], cluster, storage_path=str(tmp_path), runtime=runtime))
+
+    assert not timer_thread.vote({**vote_request(5, 1, -1, -1), 'leadership_transfer': False}).vote_granted
+    runtime.run(ELECTION_TIMEOUT_MIN)
+    assert timer_thread.vote({**vote_request(5, 1, -1, -1), 'leadership_transfer': False}).vote_granted
+
+
+def test_higher_term_in_response_deposes_leader_and_candidate(tmp_path):
+    core = make_core(tmp_path)
+    core.current_term = 1
+    leader = Leader(core)
+    request = leader.next_append_entries_request(1)
+    leader.handle_append_entries_result(request, AppendEntriesResult(False, 7, 1))
+    assert leader.stopped and leader.lease_read_index() is None
+    assert (core.current_term, core.vote_for) == (7, None)
+
+    candidate = Candidate(core)
+    candidate.start_election()
+    candidate.receive_vote(VoteResult(False, 9, 2))
+    candidate.receive_vote(VoteResult(True, 8, 1)) # stale
+    assert core.current_term == 9 and not candidate.win()
+
+
+class UnreachableTransport(Transport):
+    def call(self, peer, rpc, data, timeout):
+        return None
+
+
+def test_leadership_transfer_gives_lease_up_and_retries(tmp_path):
+    cluster = Cluster(ADDRS, num_groups=3)
+    core = NodeCore(cluster[0], cluster, UnreachableTransport(), group=1, storage_path=str(tmp_path))
+    core.current_term = 1
+    leader = Leader(core)
+    core.commit_index = leader.term_start_index + 1
+    leader.acked_at[1] = leader.acked_at[2] = core.runtime.monotonic()
+    assert leader.lease_read_index() is not None
+
+    leader.match_index[1] = core.log.last_log_index + 1 # the group's preferred Leader is caught up
+    leader.maybe_transfer_leadership(1)
+    assert leader.lease_read_index() is None
+    deadline = time.monotonic() + 1
+    while leader.transferring and time.monotonic() < deadline: # TimeoutNow is sent from another thread
+        time.sleep(.01)
+    assert not leader.transferring # the preferred Leader was unreachable: the next acknowledgement tries again
+
+
+class SilentTransport(Transport):
+    '''
+    Peers never answer: a call returns None once its timeout expires
+    '''
+    def __init__(self, runtime):
+        self.runtime = runtime
+
+    def call(self, peer, rpc, data, timeout):
+        self.runtime.sleep(timeout)
+        return None
+
+
+def start_timer_thread(tmp_path, runtime, transport):
+    '''
+    TimerThread of node 0 with its timer loop running on runtime, a SimRuntime
+    Return:
+        (timer_thread, process the loop runs in)
+    '''
+    cluster = Cluster(ADDRS)
+    core = NodeCore(cluster[0], cluster, transport, storage_path=str(tmp_path), runtime=runtime)
+    timer_thread = TimerThread(0, cluster, core=core)
+    process = SimProcess()
+    runtime.start(process, timer_thread.run)
+    return timer_thread, process
+
+
+def test_election_starts_within_timeout_range_after_last_heartbeat(tmp_path):
+    runtime = SimRuntime()
+    timer_thread, process = start_timer_thread(tmp_path, runtime, UnreachableTransport())
+    elections = []
+    timer_thread.become_candidate = lambda: elections.append(runtime.now)
+    heartbeats = []
+
+    def receive_heartbeats():
+        while runtime.now < 1:
+            timer_thread.become_follower() # what a heartbeat does, see TimerThread.append_entries()
+            heartbeats.append(runtime.now)
+            runtime.sleep(HEARTBEAT_INTERVAL)
+    runtime.start(process, receive_heartbeats)
+    runtime.run(2)
+
+    assert len(elections) == 1
+    assert ELECTION_TIMEOUT_MIN <= elections[0] - heartbeats[-1] + 1e-9 <= ELECTION_TIMEOUT_MAX * TIMEOUT_SCALER
+
+
+def test_shorter_election_timeout_takes_effect_at_once(tmp_path):
+    runtime = SimRuntime()
+    timer_thread, process = start_timer_thread(tmp_path, runtime, UnreachableTransport())
+    elections = []
+    timer_thread.become_candidate = lambda: elections.append(runtime.now)
+    runtime.run(.01)
+
+    timer_thread.reset_election_timer(.3)
+    runtime.run(.01)
+    timer_thread.reset_election_timer(.05) # the loop waits for the deadline of .3 seconds
+    runtime.run(.5)
+    assert elections == [pytest.approx(.07)]
+
+
+def test_deadline_set_during_election_does_not_start_another(tmp_path):
+    runtime = SimRuntime()
+    timer_thread, process = start_timer_thread(tmp_path, runtime, SilentTransport(runtime)) # vote requests time out after ELECTION_TIMEOUT_MIN
+    runtime.run(.01)
+
+    timer_thread.reset_election_timer(.05) # e.g. set by a vote granted right after the timer fired
+    runtime.start(process, timer_thread.become_candidate)
+    runtime.run(ELECTION_TIMEOUT_MIN - .01)
+    assert type(timer_thread.node_state) == Candidate
+    assert timer_thread.core.current_term == 1 # a single election in progress
+
+    runtime.run(.02)
+    assert type(timer_thread.node_state) == Follower # lost, and waits for its next timeout
+    assert timer_thread.election_deadline > runtime.now
+
+
+def test_install_snapshot_in_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr('raft.Leader.SNAPSHOT_CHUNK_SIZE', 16)
+    leader_core = NodeCore(Cluster(ADDRS)[0], Cluster(ADDRS), storage_path=str(tmp_path / 'leader'))
+    leader_core.current_term = 1
+    leader = Leader(leader_core)
+    leader_core.snapshot.save(9, 1, {'topic': ['a', 'b', 'c']})
+    chunks = []
+    offset = 0
+    while not chunks or not chunks[-1]['done']:
+        request = InstallSnapshotRequest(leader, leader_core.snapshot.data, offset)
+        chunks.append(codec.decode_install_snapshot_request(request.to_bytes()))
+        offset += len(request.data)
+    assert len(chunks) > 2
+
+    core = NodeCore(Cluster(ADDRS)[1], Cluster(ADDRS), storage_path=str(tmp_path / 'follower'))
+    follower = Follower(core)
+    assert not follower.install_snapshot(chunks[1]).success # out of order: Leader starts over
+    for chunk in chunks:
+        assert follower.install_snapshot(chunk).success
+    assert (core.snapshot.last_included_index, core.log.snapshot_index) == (9, 9)
+    assert (core.last_applied_index, core.commit_index) == (10, 10)
+    assert list(core.mq.topics['topic']) == ['a', 'b', 'c']
+    reloaded = NodeCore(Cluster(ADDRS)[1], Cluster(ADDRS), storage_path=str(tmp_path / 'follower'))
+    assert list(reloaded.mq.topics['topic']) == ['a', 'b', 'c'] # durable
+
+
+def make_leader(tmp_path, num_nodes, previous_terms, term, new_entries=0):
+    '''
+    Leader of term over a log holding entries of previous_terms, then its no-op, then new_entries of its own term
+    '''
+    cluster = Cluster([{"ip": "127.0.0.1", "port": 8000 + i} for i in range(num_nodes)])
+    core = NodeCore(cluster[0], cluster, storage_path=str(tmp_path))
+    core.log.append_entries(-1, [{"command": {"op": "no_op"}, "term": t} for t in previous_terms])
+    core.current_term = term
+    leader = Leader(core)
+    core.log.append_entries(core.log.last_log_index, [{"command": {"op": "no_op"}, "term": term}] * new_entries)
+    return leader
+
+
+def test_commit_index_advances_to_majority_match_odd_cluster(tmp_path):
+    leader = make_leader(tmp_path, 3, [1, 1], 2, new_entries=2) # log terms [1, 1, 2, 2, 2]
+    leader.match_index.update({1: 4, 2: 0})
+    leader.update_commit_index()
+    assert leader.commit_index == 4 # Leader and follower 1 hold 4 entries
+    leader.match_index[2] = 5
+    leader.update_commit_index()
+    assert leader.commit_index == 5
+
+
+def test_commit_index_needs_more_than_half_of_even_cluster(tmp_path):
+    leader = make_leader(tmp_path, 4, [1], 2, new_entries=2) # log terms [1, 2, 2, 2]
+    leader.match_index.update({1: 4, 2: 0, 3: 0})
+    leader.update_commit_index()
+    assert leader.commit_index == 0 # 2 of 4 nodes are not a majority
+    leader.match_index[2] = 3
+    leader.update_commit_index()
+    assert leader.commit_index == 3
+
+
+def test_entries_of_earlier_terms_are_not_committed_by_counting(tmp_path):
+    leader = make_leader(tmp_path, 3, [1, 1], 3) # log terms [1, 1, 3]
+    leader.match_index.update({1: 2, 2: 2}) # the term 1 entries are on every node
+    leader.update_commit_index()
+    assert leader.commit_index == 0
+    leader.match_index[1] = 3 # the no-op of term 3 on a majority commits them along
+    leader.update_commit_index()
+    assert leader.commit_index == 3
+
+
+def test_leader_alone_commits_on_its_own(tmp_path):
+    leader = make_leader(tmp_path, 1, [1], 2, new_entries=1)
+    leader.update_commit_index()
+    assert leader.commit_index == 3
+    leader.stop()
+    leader.log.append_entries(leader.log.last_log_index, [{"command": {"op": "no_op"}, "term": 2}])
+    leader.update_commit_index()
+    assert leader.commit_index == 3 # stepped down: commits nothing more
+
+
+class HeldTransport(Transport):
+    '''
+    Holds every AppendEntries request until the test answers it, in any order
+    '''
+    def __init__(self, runtime):
+        self.runtime = runtime
+        self.held = [] # (follower id, decoded request, wakeup of the sender)
+
+    def call(self, peer, rpc, data, timeout):
+        wakeup = self.runtime.wakeup()
+        self.held.append((peer.id, codec.decode_append_entries_request(data), wakeup))
+        return self.runtime.park(wakeup, timeout)
+
+    def answer(self, request, result):
+        held = next(held for held in self.held if held[1] is request)
+        self.held.remove(held)
+        self.runtime.resume(held[2], codec.encode_append_entries_result(result))
+
+    def requests(self, follower_id):
+        return [request for peer_id, request, _ in self.held if peer_id == follower_id]
+
+
+def test_pipeline_window_and_out_of_order_results(tmp_path):
+    runtime = SimRuntime()
+    transport = HeldTransport(runtime)
+    cluster = Cluster(ADDRS)
+    core = NodeCore(cluster[0], cluster, transport, storage_path=str(tmp_path), runtime=runtime)
+    core.current_term = 1
+    leader = Leader(core)
+    core.log.append_entries(0, [{"command": {"op": "no_op"}, "term": 1}] * (PIPELINE_WINDOW + 2) * MAX_APPEND_ENTRIES)
+    leader.next_index.update({1: 0, 2: 0}) # both followers lack the whole log
+    process = SimProcess()
+    runtime.start(process, leader.heartbeat)
+    runtime.run(HEARTBEAT_INTERVAL / 2) # less than the requests' timeout
+
+    in_flight = transport.requests(1)
+    assert len(in_flight) == PIPELINE_WINDOW # no more until one is answered
+    assert [request['prev_log_index'] for request in in_flight] == [i * MAX_APPEND_ENTRIES - 1 for i in range(PIPELINE_WINDOW)]
+
+    # the second request's result arrives first
+    transport.answer(in_flight[1], AppendEntriesResult(True, 1, 1))
+    runtime.run(0)
+    assert leader.match_index[1] == 2 * MAX_APPEND_ENTRIES
+    assert len(transport.requests(1)) == PIPELINE_WINDOW # the freed slot is used right away
+    # the first request's rejection, overtaken by the success: stale, ignored
+    next_index = leader.next_index[1]
+    transport.answer(in_flight[0], AppendEntriesResult(False, 1, 1, -1, 0))
+    runtime.run(0)
+    assert leader.match_index[1] == 2 * MAX_APPEND_ENTRIES
+    assert transport.requests(1)[-1]['prev_log_index'] == next_index - 1 # the freed slot carries on, nothing is resent
+    runtime.kill(process)
+
+
+def test_rejection_rolls_next_index_back_over_optimistic_advances(tmp_path):
+    leader = make_leader(tmp_path, 3, [1] * 10, 2) # log terms [1 x 10, 2]
+    leader.next_index[1] = 4
+    requests = [leader.next_append_entries_request(1) for _ in range(3)] # pipelined, next_index advanced each time
+    assert leader.next_index[1] == 11
+
+    # Follower only holds 2 entries: resume right after them, not after the request's prev_log_index
+    leader.handle_append_entries_result(requests[0], AppendEntriesResult(False, 2, 1, -1, 2))
+    assert leader.next_index[1] == 2
+    # later rejections never move next_index forward again, nor below match_index
+    leader.match_index[1] = 3
+    leader.handle_append_entries_result(requests[1], AppendEntriesResult(False, 2, 1, -1, 6))
+    assert leader.next_index[1] == 3
+
+
+@pytest.mark.parametrize('conflict_term, conflict_index, next_index', [
+    (-1, 3, 3), # follower's log too short: resume at its end
+    (1, 0, 2), # Leader has the conflicting term: resume after its last entry of that term
+    (2, 2, 2), # Leader lacks the conflicting term: skip the follower's whole term
+    (-1, -1, 5), # no hints (e.g. stale term): back up by one entry
+])
+def test_backtrack_follows_conflict_hints(tmp_path, conflict_term, conflict_index, next_index):
+    leader = make_leader(tmp_path, 3, [1, 1, 3, 3, 3], 4) # log terms [1, 1, 3, 3, 3, 4]
+    request = leader.next_append_entries_request(1) # heartbeat after Leader's last entry
+    assert request.prev_log_index == 5
+    assert leader.backtrack(request, AppendEntriesResult(False, 4, 1, conflict_term, conflict_index)) == next_index
+
+
+@pytest.mark.parametrize('prev_log_index, prev_log_term, conflict', [
+    (6, 3, (-1, 4)), # beyond the end of the log
+    (3, 3, (2, 2)), # term 2 there, whose first entry is at 2
+    (0, 2, (1, 0)),
+])
+def test_follower_conflict_hints(tmp_path, prev_log_index, prev_log_term, conflict):
+    core = make_core(tmp_path)
+    core.log.append_entries(-1, [{"command": {"op": "no_op"}, "term": t} for t in [1, 1, 2, 2]])
+    core.current_term = 3
+    request = {'term': 3, 'leader_id': 1, 'prev_log_index': prev_log_index, 'prev_log_term': prev_log_term, 'entries': [], 'leader_commit': 0}
+    result = Follower(core).append_entries(request)
+    assert not result.success and (result.conflict_term, result.conflict_index) == conflict
@@ -0,0 +1,163 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from raft.simulation import SimCluster, run_scenario
+from raft.MessageQueue import CREATE_TOPIC, PUT_MESSAGE
+from raft.cluster import COMMIT_TIMEOUT
+
+ELECTION_TIMEOUT = 1 # virtual seconds to wait for a Leader
+
+
+def put(topic, message):
+    return {'op': PUT_MESSAGE, 'topic': topic, 'message': message}
+
+
+def elect(sim):
+    assert sim.run_until(lambda: sim.leader() is not None, ELECTION_TIMEOUT)
+    return sim.leader()
+
+
+def create_topic(sim, topic):
+    operation = sim.propose({'op': CREATE_TOPIC, 'topic': topic})
+    assert sim.run_until(lambda: operation.completed_at is not None, ELECTION_TIMEOUT)
+    assert operation.result['success']
+
+
+def test_elects_and_replicates():
+    with SimCluster(5, seed=1) as sim:
+        elect(sim)
+        create_topic(sim, 'topic')
+        writes = [sim.propose(put('topic', str(i))) for i in range(10)]
+        sim.run(.5)
+
+        assert all(write.result['success'] for write in writes)
+        assert len({write.result['index'] for write in writes}) == 10
+        for node in sim.nodes:
+            assert list(node.core.mq.topics['topic']) == [str(i) for i in range(10)]
+        read = sim.read('topic')
+        sim.run(.1)
+        assert read.result == [str(i) for i in range(10)]
+        sim.check_safety()
+
+
+def test_same_seed_same_run():
+    def trace(seed):
+        with SimCluster(5, seed=seed, loss=.1) as sim:
+            leader = elect(sim)
+            sim.propose({'op': CREATE_TOPIC, 'topic': 'topic'})
+            sim.run(.5)
+            return leader.node.id, leader.core.current_term, sim.runtime.now, [node.core.commit_index for node in sim.nodes]
+
+    assert trace(7) == trace(7)
+
+
+def test_minority_leader_cannot_commit():
+    with SimCluster(5, seed=2) as sim:
+        old_leader = elect(sim)
+        create_topic(sim, 'topic')
+        minority = [old_leader.node.id, (old_leader.node.id + 1) % 5]
+        sim.partition(minority, [i for i in range(5) if i not in minority])
+        lost = sim.propose(put('topic', 'lost'), old_leader)
+        sim.run(ELECTION_TIMEOUT)
+
+        new_leader = sim.leader()
+        assert new_leader is not old_leader and new_leader.node.id not in minority
+        assert lost.result == {'success': False}
+
+        sim.heal()
+        sim.run(ELECTION_TIMEOUT)
+        assert not old_leader.is_leader()
+        for node in sim.nodes:
+            assert 'lost' not in node.core.mq.topics['topic'] # overwritten by the new Leader
+        sim.check_safety()
+
+
+def test_isolated_leader_write_times_out():
+    with SimCluster(5, seed=2) as sim:
+        old_leader = elect(sim)
+        create_topic(sim, 'topic')
+        sim.partition([old_leader.node.id], [i for i in range(5) if i != old_leader.node.id])
+        lost = sim.propose(put('topic', 'lost'), old_leader)
+        assert sim.run_until(lambda: lost.completed_at is not None, 2 * COMMIT_TIMEOUT)
+
+        # never learns about the new Leader: the entry is not applied within COMMIT_TIMEOUT
+        assert old_leader.is_leader()
+        assert lost.result == {'success': False}
+        assert lost.completed_at - lost.invoked_at >= COMMIT_TIMEOUT
+        sim.check_safety()
+
+
+def test_deposed_leader_does_not_acknowledge_overwritten_write():
+    with SimCluster(5, seed=2) as sim:
+        old_leader = elect(sim)
+        create_topic(sim, 'topic')
+        minority = [old_leader.node.id, (old_leader.node.id + 1) % 5]
+        sim.partition(minority, [i for i in range(5) if i not in minority])
+        lost = sim.propose(put('topic', 'lost'), old_leader)
+        assert sim.run_until(lambda: sim.leader() is not old_leader, ELECTION_TIMEOUT)
+
+        sim.heal() # before the write times out: the new Leader's entries replace it in old Leader's log
+        assert sim.run_until(lambda: lost.completed_at is not None, ELECTION_TIMEOUT)
+        assert lost.result == {'success': False}
+        assert lost.completed_at - lost.invoked_at < COMMIT_TIMEOUT # failed on step-down, not on timeout
+        sim.check_safety()
+
+
+def test_restarted_node_recovers_from_storage():
+    with SimCluster(3, seed=3) as sim:
+        elect(sim)
+        create_topic(sim, 'topic')
+        follower = next(node for node in sim.nodes if not node.is_leader())
+        sim.restart(follower.node.id)
+        sim.propose(put('topic', 'after restart'))
+        sim.run(.5)
+
+        assert list(sim.nodes[follower.node.id].core.mq.topics['topic']) == ['after restart']
+        sim.check_safety()
+
+
+def test_random_scenarios_are_safe():
+    for seed in range(20):
+        result = run_scenario(5, seed, duration=1., loss=.05, fault_interval=.25)
+        assert result['first_leader_s'] is not None
+
+
+def test_random_lease_read_scenarios_are_linearizable():
+    for seed in range(20):
+        result = run_scenario(3, seed, duration=1., loss=.05, fault_interval=.1, lease_reads=True) # check_safety checks the reads
+        assert result['reads'] > 0
+
+
+def test_lease_reads_node_rejoins_after_partition():
+    with SimCluster(3, seed=4, lease_reads=True) as sim:
+        leader = elect(sim)
+        create_topic(sim, 'topic')
+        isolated = next(node for node in sim.nodes if node is not leader)
+        sim.partition([isolated.node.id], [node.node.id for node in sim.nodes if node is not isolated])
+        sim.run(2 * ELECTION_TIMEOUT) # the isolated node keeps raising its term
+
+        sim.heal()
+        assert sim.run_until(lambda: len({node.core.current_term for node in sim.nodes}) == 1 and sim.leader() is not None, 2 * ELECTION_TIMEOUT)
+        create_topic(sim, 'after heal')
+        sim.check_safety()
+
+
+def test_lagging_follower_catches_up_from_snapshot(monkeypatch):
+    monkeypatch.setattr('raft.NodeCore.SNAPSHOT_THRESHOLD', 5)
+    monkeypatch.setattr('raft.Leader.SNAPSHOT_CHUNK_SIZE', 16) # several chunks
+    with SimCluster(3, seed=5) as sim:
+        leader = elect(sim)
+        create_topic(sim, 'topic')
+        lagging = next(node for node in sim.nodes if node is not leader)
+        sim.partition([lagging.node.id], [node.node.id for node in sim.nodes if node is not lagging])
+        writes = [sim.propose(put('topic', str(i))) for i in range(20)]
+        sim.run(.5)
+        assert all(write.result['success'] for write in writes)
+        assert leader.core.log.snapshot_index > lagging.core.log.last_log_index # what lagging lacks is compacted away
+
+        sim.heal()
+        assert sim.run_until(lambda: lagging.core.last_applied_index == leader.core.last_applied_index, ELECTION_TIMEOUT)
+        assert lagging.core.snapshot.last_included_index >= leader.core.log.snapshot_index
+        assert list(lagging.core.mq.topics['topic']) == [str(i) for i in range(20)]
+        sim.check_safety()